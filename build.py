@@ -19,7 +19,7 @@ solver_dir = Path(package_name).joinpath("simulation", "solvers")
 entrypoint = Path(package_name).joinpath('__main__.py')
 info_file = Path(package_name).joinpath('info.py')
 
-hidden_imports = ['simulation.base_solver', 'dill', 'numba', 'xmlrpc.client', 'xmlrpc.server', 'requests', 'pkg_resources.py2_warn']
+hidden_imports = ['simulation.base_solver', 'dill', 'numba', 'numexpr', 'xmlrpc.client', 'xmlrpc.server', 'requests', 'pkg_resources.py2_warn']
 hidden_imports = ('--hidden-import='+s for s in hidden_imports)
 
 excludes = ['FixTk', 'tcl', 'tk', '_tkinter', 'tkinter', 'Tkinter']
@@ -7,10 +7,13 @@ import multiprocessing as mp
 
 logger = logging.getLogger(__name__)
 
+# loadSettings reaches grid and material through the package, import them with it
 try:
     import simulation
+    import simulation.grid, simulation.material
 except:
     from . import simulation
+    from .simulation import grid, material
 
 class Info:
     version = 'none'
@@ -125,6 +128,8 @@ def loadSettings(path=SETTINGS_FILE):
     grid.max_dy = cfg['grid']['max_dy']
     grid.max_dz = cfg['grid']['max_dz']
     grid.slope = cfg['grid']['slope']
+    grid.periodic_y = cfg['grid'].get('periodic_y', False)
+    grid.mirror_y = cfg['grid'].get('mirror_y')
 
     for t in cfg["inclusions"]:
         grid.addInclusion(x=t['x'], y=t['y'], z=t['z'], r=t['r'])
@@ -140,6 +145,7 @@ def loadSettings(path=SETTINGS_FILE):
     )
 
     material.c_max = cfg['simulation']['courant']
+    material.compact = cfg['material'].get('compact', False)
 
     material.setPrimary(cfg['material']['primary'])
     material.setSecondary(cfg['material']['secondary'])
@@ -166,6 +172,8 @@ def saveSettings(path):
         "size_x": grid.size_x,
         "size_y": grid.size_y,
         "size_z": grid.size_z,
+        "periodic_y": grid.periodic_y,
+        "mirror_y": grid.mirror_y,
     }
 
     cfg['inclusions'] = [ {'x': float(row[0]), 'y':float(row[1]), 'z': float(row[2]), 'r':float(row[3])} for row in grid.targets ]
@@ -173,6 +181,7 @@ def saveSettings(path):
     cfg['simulation']['courant'] = material.c_max
     cfg['material']['primary'] = material.primary_key
     cfg['material']['secondary'] = material.secondary_key
+    cfg['material']['compact'] = material.compact
 
     cfg['simulation']['solver'] = solver.name
     cfg['simulation']['cfg'] = solver.cfg
@@ -248,11 +248,9 @@ class Viewer(QWidget):
     def refresh(self):
         if self.hdf_file != None:
             with h5py.File(self.hdf_file, mode='r') as hdf:
-                u = hdf.get(self.u_id)
-                P = hdf.get('density')
-                x = hdf.attrs['x']
-                y = hdf.attrs['y']
-                z = hdf.attrs['z']
+                u = analysis.dataset(hdf, self.u_id)
+                P = analysis.dataset(hdf, 'density')
+                x, y, z = analysis.mesh(hdf)
                 dt = hdf.attrs['dt']
 
                 # Seperate update functions for speed. No need to run all calculations for every change
@@ -273,7 +271,7 @@ class Viewer(QWidget):
                 common.grid.x,
                 common.grid.y,
                 common.grid.z,
-                common.material.P
+                common.material.density()
             )
 
     def layerChange(self):
@@ -4,6 +4,73 @@ from logging import getLogger
 
 logger = getLogger(__name__)
 
+# Parity across the mirror plane of the datasets of a symmetric half domain run, see dataset()
+MIRROR_PARITY = {'ux': 1, 'uy': -1, 'uz': 1, 'phase': 1, 'density': 1, 'elasticity': 1}
+# Datasets stored on the half lines along y
+STAGGERED_Y = ('uy',)
+
+class MirrorDataset:
+    '''
+    Read only view over the whole domain of a dataset written on the half domain below a mirror plane
+    along y (axis 1). The last stored line is the image of the line before the plane and is dropped,
+    indices past the plane are read from their image times sign when the view is indexed.
+    '''
+    def __init__(self, dataset, sign, staggered):
+        self.dataset = dataset
+        self.sign = sign
+        self.n = dataset.shape[1] - 1 # lines up to the mirror plane, or half lines below it
+        ny = 2*self.n if staggered else 2*self.n - 1
+        self.shape = dataset.shape[:1] + (ny,) + dataset.shape[2:]
+        self.ndim = len(self.shape)
+        self.dtype = dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),)*(self.ndim - len(key))
+        j = np.arange(self.shape[1])[key[1]]
+        image = j >= self.n
+        source = np.where(image, self.shape[1]-1-j, j)
+        if np.ndim(j) == 0:
+            data = self.dataset[(key[0], int(source)) + key[2:]]
+            return data*self.sign if image else data
+
+        # HDF datasets are read with increasing indices
+        unique, inverse = np.unique(source, return_inverse=True)
+        data = self.dataset[(key[0], unique) + key[2:]]
+        axis = 0 if isinstance(key[0], (int, np.integer)) else 1
+        data = np.take(data, inverse.ravel(), axis=axis)
+        if self.sign != 1 and image.any():
+            shape = [1]*data.ndim
+            shape[axis] = -1
+            data = data*np.where(image, self.sign, 1).reshape(shape)
+        return data
+
+def dataset(hdf, key):
+    '''
+    Dataset key of an output file over the whole domain, datasets of half domain runs
+    (attribute mirror_y) are mirrored lazily on read, see MirrorDataset
+    '''
+    data = hdf.get(key)
+    mode = hdf.attrs.get('mirror_y', '')
+    if data is None or not mode or key not in MIRROR_PARITY:
+        return data
+    sign = MIRROR_PARITY[key]
+    if mode == 'antisymmetric' and key in ('ux', 'uy', 'uz'):
+        sign = -sign
+    return MirrorDataset(data, sign, key in STAGGERED_Y)
+
+def mesh(hdf):
+    '''
+    Mesh lines x, y and z of an output file over the whole domain
+    '''
+    x, y, z = (np.array(hdf.attrs[key]) for key in ('x', 'y', 'z'))
+    if hdf.attrs.get('mirror_y', ''):
+        y = np.concatenate((y[:-1], 2*y[-2] - y[-3::-1]))
+    return x, y, z
+
 
 def nonlinspace(spacing):
     '''
@@ -56,8 +123,8 @@ def spectrum(file, u_id, z_index, y_index, x_index=None):
     else:
         raise TypeError
     try:
-        u = hdf.get(u_id)
-        assert u != None
+        u = dataset(hdf, u_id)
+        assert u is not None
         if u_id == 'ux':
             x = nonlinspace(hdf.attrs["fdx"][:,0,0])
         else:
@@ -18,12 +18,106 @@ if __name__ == '__main__':
     sys.path.append(str(file.parents[1]))
 
 from simulation import material, grid
+from simulation.grid import GHOST
 from gui.worker import WorkerSignals
 
 #https://support.hdfgroup.org/HDF5/doc/RM/H5P/H5Pset_cache.htm
 #RDCC_NSLOTS = np.array((521, 1009, 2003, 3001, 4001, 5003, 6007, 7001)) # Should be prime number for best performance
 
-DTYPE = np.float64
+
+def difference(a, b, r, out):
+    '''
+    Evaluates (a - b) * r into out without allocating temporary arrays
+    r is the reciprocal grid spacing, see BaseSolver.initCoefficients
+    '''
+    np.subtract(a, b, out=out)
+    np.multiply(out, r, out=out)
+    return out
+
+def contract(c, du, out, tmp):
+    '''
+    Evaluates out = c[0]*du[0] + c[1]*du[1] + c[2]*du[2] in place
+    c holds one row of the stiffness tensor, tmp is used as scratch space
+    '''
+    np.multiply(c[0], du[0], out=out)
+    out += np.multiply(c[1], du[1], out=tmp)
+    out += np.multiply(c[2], du[2], out=tmp)
+    return out
+
+def fold(surface, interior, n):
+    '''
+    Coefficient of n planes along z, the surface value at k = 0 followed by the interior values
+    Lets one pass evaluate the traction free surface together with the interior
+    '''
+    interior = np.asarray(interior)
+    out = np.empty(interior.shape[:2] + (n,))
+    out[:,:,0] = surface
+    out[:,:,1:] = interior
+    return out
+
+def part(a, region):
+    '''
+    Coefficient a restricted to region, axes without an extent (and None) are kept
+    '''
+    if np.ndim(a) == 0:
+        return a
+    return a[tuple(s if n > 1 else slice(None) for s, n in zip(region, a.shape))]
+
+def accumulate(out, c, corr, tmp):
+    '''
+    out += c*corr in place, c is None when it is already folded into corr
+    '''
+    if c is None:
+        out += corr
+    else:
+        out += np.multiply(c, corr, out=tmp)
+
+def rows(a, start, stop):
+    '''
+    Coefficient a restricted to the x planes start .. stop-1, x is the third axis from the end
+    so that leading batch axes are kept. Coefficients without an x extent (scalars, the (1,) arrays
+    of a uniform mesh, or None) are returned as they are
+    '''
+    if np.ndim(a) < 3 or a.shape[-3] == 1:
+        return a
+    return a[...,start:stop,:,:]
+
+def wrapLines(a, phase):
+    '''
+    Bloch images of the first and last y lines, a[:,0] = a[:,-2]/phase and a[:,-1] = a[:,1]*phase
+    '''
+    np.multiply(a[...,:,-2,:], np.conj(phase), out=a[...,:,0,:])
+    np.multiply(a[...,:,1,:], phase, out=a[...,:,-1,:])
+
+def wrapHalfLines(a, phase):
+    '''
+    Bloch image of the first half line along y, a[:,0] = a[:,-1]/phase
+    '''
+    np.multiply(a[...,:,-1,:], np.conj(phase), out=a[...,:,0,:])
+
+def mirrorLines(a, sign):
+    '''
+    Image of the y line -3 across the mirror plane at line -2 into the line -1, times sign.
+    An odd field (sign -1) is zero on the mirror plane.
+    '''
+    if sign < 0:
+        a[...,:,-2,:] = 0
+    np.multiply(a[...,:,-3,:], sign, out=a[...,:,-1,:])
+
+def mirrorHalfLines(a, sign):
+    '''
+    Image of the half line -2 across the mirror plane into the half line -1, times sign
+    '''
+    np.multiply(a[...,:,-2,:], sign, out=a[...,:,-1,:])
+
+def absorb(out, u_in, u_new_in, u_edge, c):
+    '''
+    First order absorbing boundary, out = u_in + c*(u_new_in - u_edge) in place
+    '''
+    np.subtract(u_new_in, u_edge, out=out)
+    out *= c
+    out += u_in
+    return out
 
 class TestDefaults:
     '''
@@ -74,6 +168,8 @@ class Writer:
     Writes standardized HDF files for simulation results
     After being started using start(), grid and timestep data can be added using
     Writer.put((grid, tt)) where grid and tt are inside a tuple.
+    tt may be a single time index or a slice, in which case the grid holds one frame
+    per step along its last axis.
     Once the simulation is finished the thread can be killed using Writer.kill.set()
     The HDF file will be flushed to disk on thread exit
     '''
@@ -111,26 +207,54 @@ class Writer:
         logger.info("Writing HDF to file {}".format(file))
         self.file = file
         with h5.File(file, mode='w') as hdf:
-            self.ux = hdf.create_dataset("ux", (x-1,y,z,t), chunks=(x-1,y,z,1), dtype=DTYPE)
-            self.uy = hdf.create_dataset("uy", (x,y-1,z,t), chunks=(x,y-1,z,1), dtype=DTYPE)
-            self.uz = hdf.create_dataset("uz", (x,y,z-1,t), chunks=(x,y,z-1,1), dtype=DTYPE)
-            hdf.create_dataset("density", data=material.P, chunks=material.P.shape, dtype=DTYPE)
-            hdf.create_dataset("elasticity", data=material.C, chunks=material.C.shape, dtype=DTYPE)
-
-            hdf.attrs["x"] = grid.x
-            hdf.attrs["y"] = grid.y
-            hdf.attrs["z"] = grid.z
-            hdf.attrs["sdx"] = grid.sdx
-            hdf.attrs["sdy"] = grid.sdy
-            hdf.attrs["sdz"] = grid.sdz
-            hdf.attrs["fdx"] = grid.fdx
-            hdf.attrs["fdy"] = grid.fdy
-            hdf.attrs["fdz"] = grid.fdz
-            hdf.attrs["steps"] = steps
-            hdf.attrs["dt"] = material.dt
-            hdf.attrs["prim_material"] = material.primary['name']
-            hdf.attrs["sec_material"] = material.secondary['name']
-            hdf.attrs["solver_cfg"] = json.dumps(cfg)
+            # Datasets are stored in the precision the solver runs in
+            dtype = grid.ux.dtype
+            # one chunk per frame, a grid with a single line along an axis (see solver_plane)
+            # has no staggered positions along it and its dataset is left empty
+            create = lambda key, shape: hdf.create_dataset(key, shape + (t,), chunks=shape + (1,) if all(shape) else None, dtype=dtype)
+            self.ux = create("ux", (x-1,y,z))
+            self.uy = create("uy", (x,y-1,z))
+            self.uz = create("uz", (x,y,z-1))
+            # the material is real when the displacement is complex, see BaseSolver.stateType
+            self.writeMetadata(hdf, steps, material, grid, cfg, np.finfo(dtype).dtype)
+
+    @staticmethod
+    def writeMetadata(hdf, steps, material, grid, cfg, dtype):
+        '''
+        Writes the material datasets and the grid attributes shared by every output file
+        Only reads the mesh lines and spacing of grid, not its state arrays
+        '''
+        x, y, z = grid.x.size, grid.y.size, grid.z.size
+        hdf.create_dataset("phase", data=material.phase, chunks=material.phase.shape, dtype=np.uint8)
+        hdf.create_dataset("phase_density", data=material.phases['p'], dtype=dtype)
+        hdf.create_dataset("phase_elasticity", data=material.phases['c'], dtype=dtype)
+        if material.compact:
+            # Per cell elasticity is only stored for dense materials, density is
+            # expanded one z slice at a time so it stays readable by the analysis tab
+            density = hdf.create_dataset("density", (x,y,z), chunks=(x,y,1), dtype=dtype)
+            for k in range(z):
+                density[:,:,k] = material.phases['p'][material.phase[:,:,k]]
+        else:
+            hdf.create_dataset("density", data=material.P, chunks=material.P.shape, dtype=dtype)
+            hdf.create_dataset("elasticity", data=material.C, chunks=material.C.shape, dtype=dtype)
+
+        hdf.attrs["x"] = grid.x
+        hdf.attrs["y"] = grid.y
+        hdf.attrs["z"] = grid.z
+        hdf.attrs["sdx"] = grid.sdx
+        hdf.attrs["sdy"] = grid.sdy
+        hdf.attrs["sdz"] = grid.sdz
+        hdf.attrs["fdx"] = grid.fdx
+        hdf.attrs["fdy"] = grid.fdy
+        hdf.attrs["fdz"] = grid.fdz
+        hdf.attrs["periodic_y"] = getattr(grid, 'periodic_y', False)
+        # half domain below the mirror plane, read back as the whole domain by analysis.dataset
+        hdf.attrs["mirror_y"] = getattr(grid, 'mirror', None) or ''
+        hdf.attrs["steps"] = steps
+        hdf.attrs["dt"] = material.dt
+        hdf.attrs["prim_material"] = material.primary['name']
+        hdf.attrs["sec_material"] = material.secondary['name']
+        hdf.attrs["solver_cfg"] = json.dumps(cfg)
 
     @staticmethod
     def run(file, queue_obj):
@@ -189,7 +313,12 @@ class BaseSolver:
         self.logger = logger
         self.cfg = {'wave': 'ricker',
                     'wave_args': {'f': 100},
-                    'write_mode': 'process'}
+                    'write_mode': 'process',
+                    'sync_interval': 1,
+                    'precision': 'float64',
+                    # phase k*size_y across a periodic unit cell, see apply_T_pbc
+                    'bloch_phase': 0}
+        self.frames = None
 
     def init(self, grid, material, steps):
         '''
@@ -203,14 +332,33 @@ class BaseSolver:
         logger.info("Initializing {} with settings: {}".format(self.logger.name, self.cfg))
 
         self.g.buildMesh()
-        self.g.update()
-        self.m.update()
-
+        self.g.update(dtype=self.stateType())
+        self.m.grid = self.g
+        self.m.update(dtype=self.precision())
+        # Select the scalar coefficients of the numpy kernels, see initCoefficients
+        self.uniform, self.homogeneous = self.g.uniform(), self.m.homogeneous()
+        logger.info("Uniform spacing: {}, homogeneous material: {}".format(self.uniform, self.homogeneous))
+        if not self.phaseKernels():
+            if self.m.compact:
+                # the numpy kernels read per cell coefficients, expand them once per run
+                self.m.setStiffness()
+            self.initScratch()
+        self.initCoefficients()
+        self.initWriter()
+
+    def initWriter(self):
+        '''
+        Start a writer for the output file of the run, buffering sync_interval frames of the grid
+        Called from init(), can be overwritten by child class
+        '''
         if self.writer.is_alive():
             self.writer.notify_finished()
             self.writer.join(timeout=1)
 
+        # Frames are buffered between writer calls, see run()
+        self.frames = None
         if self.cfg['write_mode'] != 'off':
+            self.frames = self.g.frameBuffer(self.syncInterval())
             self.writer = Writer(self.cfg['write_mode'])
             self.writer.init(
                 steps = self.t,
@@ -221,16 +369,140 @@ class BaseSolver:
             )
             self.writer.start()
 
+    def phaseKernels(self):
+        '''
+        True if the kernels read Material.phase and the per phase tables directly,
+        in which case the per cell coefficient arrays and numpy scratch buffers are not built.
+        Can be overwritten by child class
+        '''
+        return False
+
+    def initCoefficients(self):
+        '''
+        Precompute the stencil coefficients that stay constant for the whole run,
+        so that the kernels multiply instead of dividing each step.
+        r* hold the reciprocal grid spacings, rho holds dt**2/P per material phase,
+        ux/uy/uz hold dt**2/P over the region of the displacement update and abc the absorbing boundary constants.
+        The numpy kernels update the z = 0 surface in the same pass as the interior, <a>_<b> holds
+        the spacing coefficient of the difference of <b> in the update of <a> (T for T1 .. T3),
+        with the traction free surface expressions of the reference solver at k = 0.
+        With uniform spacing these collapse to a z profile, or a scalar where the surface
+        matches the interior. With a homogeneous material dt**2/P is a scalar folded into the
+        coefficients of update_u, ux/uy/uz are then not set.
+        '''
+        g, m = self.g, self.m
+        dt = m.dt
+
+        coef = {'r'+key: 1/getattr(g, key) for key in ('sdx', 'sdy', 'sdz', 'fdx', 'fdy', 'fdz')}
+        coef['rho'] = dt**2/m.phases['p']
+        if not self.phaseKernels():
+            if not self.homogeneous:
+                P = m.density()
+                # the surface update of uz reads z = 0, the interior z = k + 1
+                coef['ux'] = dt**2/P[1:,1:-1,:-1]
+                coef['uy'] = dt**2/P[1:-1,1:,:-1]
+                coef['uz'] = dt**2/np.concatenate((P[1:-1,1:-1,:1], P[1:-1,1:-1,2:]), axis=2)
+
+            r = {key: value for key, value in coef.items() if key[0] == 'r'}
+            terms = {
+                'T_ux': (r['rsdx'][0,0,0], r['rsdx']),
+                'T_uy': (r['rsdy'][0,0,0], r['rsdy']),
+                'T_uz': (r['rsdz'][0,0,0], r['rsdz']),
+                'T4_uy': (r['rfdy'][0,0,0], r['rfdz'][:,:,1:]),
+                'T4_uz': (r['rfdz'][0,0,0], r['rfdy']),
+                'T5_ux': (r['rfdx'][0,0,0], r['rfdz'][:,:,1:]),
+                'T5_uz': (r['rfdz'][0,0,0], r['rfdx']),
+                'T6_ux': (r['rfdx'][0,0,0], r['rfdy']),
+                'T6_uy': (r['rfdz'][0,0,0], r['rfdx']),
+                'ux_T1': (r['rfdx'][0,0,0], r['rfdx']),
+                'ux_T6': (r['rsdy'][0,0,0], r['rsdy']),
+                'ux_T5': (r['rsdz'][0,0,0], r['rsdz']),
+                'uy_T6': (r['rsdx'][0,0,0], r['rsdx']),
+                'uy_T2': (r['rfdy'][0,0,0], r['rfdy']),
+                'uy_T4': (r['rsdz'][0,0,0], r['rsdz']),
+                'uz_T5': (r['rsdx'][0,0,0], r['rsdx']),
+                'uz_T4': (r['rsdy'][0,0,0], r['rsdy']),
+                # T3 is zero at the surface, so T3[1] - T3[0] matches T3[1] - T3[0]*rfdz[0]
+                'uz_T3': (1, r['rfdz'][:,:,1:]),
+            }
+            coef.update({key: fold(*value, g.z.size-1) for key, value in terms.items()})
+            if self.uniform:
+                for key in terms:
+                    profile = coef[key][:1,:1,:]
+                    coef[key] = profile[0,0,0] if (profile == profile[0,0,0]).all() else profile
+            if self.homogeneous:
+                rho = coef['rho'][m.phase.flat[0]]
+                for key in terms:
+                    if key[0] == 'u':
+                        coef[key] = coef[key]*rho
+        coef = {key: np.ascontiguousarray(value, dtype=self.precision()) for key, value in coef.items()}
+        coef['abc'] = self.absorbingCoefficients()
+        self.coef = coef
+
+    def absorbingCoefficients(self):
+        '''
+        Constants of the absorbing boundary on each face, see apply_u_abc
+        '''
+        g, m = self.g, self.m
+        dt = m.dt
+
+        # Boundary constants use the material at the origin
+        c, p = m.phases['c'][m.phase[0,0,0]], m.phases['p'][m.phase[0,0,0]]
+        vl = np.sqrt(c[0,0]/p) # parallel
+        vt = np.sqrt(c[3,3]/p) # transverse
+        const = lambda v, d: self.precision().type((v*dt - d)/(v*dt + d))
+        return {
+            'clx': const(vl, g.sdx[-1,0,0]),
+            'ctx': const(vt, g.fdx[-1,0,0]),
+            'cly0': const(vl, g.sdy[0,0,0]),
+            'cty0': const(vt, g.fdy[0,0,0]),
+            'cly1': const(vl, g.sdy[0,-1,0]),
+            'cty1': const(vt, g.fdy[0,-1,0]),
+            'clz': const(vl, g.sdz[0,0,-1]),
+            'ctz': const(vt, g.fdz[0,0,-1]),
+        }
+
+    def initScratch(self):
+        '''
+        Allocate reusable buffers for intermediate results of the numpy kernels,
+        so that the time stepping loop does not allocate any arrays.
+        '''
+        self.scratch = self.scratchBuffers(0, self.g.x.size-1)
+
+    def scratchBuffers(self, i0, i1):
+        '''
+        Scratch buffers of the numpy kernels for the x planes i0 .. i1-1, see update_T
+        '''
+        y, z, b = self.g.y.size, self.g.z.size, self.g.batch
+        # T1 .. T4, uy and uz are updated from x plane 1 on
+        x, x1 = i1-i0, i1-max(i0, 1)
+        shapes = {
+            'dux': (x1, y-2, z-1),
+            'duy': (x1, y-2, z-1),
+            'duz': (x1, y-2, z-1),
+            'T': (x1, y-2, z-1),
+            'T4': (x1, y-1, z-1),
+            'T5': (x, y-2, z-1),
+            'T6': (x, y-1, z-1),
+            'ux': (x, y-2, z-1),
+            'uy': (x1, y-1, z-1),
+            'uz': (x1, y-2, z-1),
+        }
+        dtype = self.stateType()
+        return {key: np.zeros(b + shape, dtype=dtype) for key, shape in shapes.items()}
+
     def run(self, *args, **kwargs):
         '''
+        Main simulation loop. The solver is advanced sync_interval steps at a time,
+        cancellation, progress and the writer are only handled between these blocks.
         '''
 
         default = {'signals': WorkerSignals()}
         kwargs = {**default, **kwargs}
         signals = kwargs['signals']
 
-        wave_fn = {'sin': self.update_sin,
-                   'ricker': self.update_ricker}[self.cfg['wave']]
+        source = self.source()
+        interval = self.syncInterval()
 
         signals.status.emit("Solver starting..")
         self.running.set()
@@ -242,25 +514,17 @@ class BaseSolver:
         progress = 0
         signals.progress.emit(0)
 
-        for tt in range(self.t):
+        for t0 in range(0, self.t, interval):
             if not self.running.is_set():
                 self.logger.warning("Simulation cancelled.")
                 break
 
-            # apply wave to input face of simulation
-            self.g.uz[0, :, 0] = wave_fn(tt = tt, **self.cfg['wave_args'])
-            self.update_T()
-            self.update_T_BC()
-            self.update_u()
-            self.update_u_BC()
-            self.time_step()
-
-            if self.cfg['write_mode'] != 'off':
-                cache = (self.g.freezeData(), tt)
-                self.writer.put(cache)
+            n = min(interval, self.t - t0)
+            self.advance(source, t0, n)
+            self.record(t0, n)
 
             if progress < 99:
-                progress = min(99, int(((tt+1)/self.t)*100))
+                progress = min(99, int(((t0+n)/self.t)*100))
                 if progress % 1 == 0:
                     #print(progress)
                     signals.progress.emit(progress)
@@ -268,6 +532,26 @@ class BaseSolver:
         # Cleanup
         logger.debug("solver loop ended.")
         self.running.clear()
+        self.finish()
+
+        etime = time()-stime
+        signals.status.emit("Simulation finished in {:.2f}s.".format(etime))
+        signals.progress.emit(100)
+
+    def record(self, t0, n):
+        '''
+        Hand the frames of the n steps starting at t0 to the writer
+        Called from run() after each block, can be overwritten by child class
+        '''
+        if self.cfg['write_mode'] != 'off':
+            cache = (self.frames.head(n), slice(t0, t0+n))
+            self.writer.put(cache)
+
+    def finish(self):
+        '''
+        Wait for the writer to flush the output file
+        Called from run() once the loop ended, can be overwritten by child class
+        '''
         if self.cfg['write_mode'] != 'off':
             self.writer.notify_finished()
             t1 = time()
@@ -275,10 +559,6 @@ class BaseSolver:
             t2 = time()-t1
             logger.debug("Waited {:.4f}s for writer to end.".format(t2))
 
-        etime = time()-stime
-        signals.status.emit("Simulation finished in {:.2f}s.".format(etime))
-        signals.progress.emit(100)
-
     def cancel(self):
         if self.running.is_set():
             self.running.clear()
@@ -291,6 +571,66 @@ class BaseSolver:
         )
         self.run()
 
+    def syncInterval(self):
+        return max(1, int(self.cfg['sync_interval']))
+
+    def precision(self):
+        '''
+        Floating point type of the grid, material and coefficient arrays, "float64" or "float32"
+        '''
+        return np.dtype(self.cfg['precision'])
+
+    def stateType(self):
+        '''
+        Type of the displacement and stress arrays, complex of the same precision
+        when a periodic grid has a Bloch phase, see apply_T_pbc
+        '''
+        if self.g.periodic_y and self.cfg.get('bloch_phase', 0) != 0:
+            return np.result_type(self.precision(), np.complex64)
+        return self.precision()
+
+    def blochPhase(self):
+        '''
+        Factor between a field and its image one unit cell further along y
+        '''
+        phase = self.cfg.get('bloch_phase', 0)
+        return np.exp(1j*phase) if phase != 0 else 1
+
+    def source(self):
+        '''
+        Precompute the wave applied to the input face for every time step
+        '''
+        return np.ascontiguousarray(self.wave(self.cfg), dtype=self.precision())
+
+    def wave(self, cfg):
+        '''
+        Source wave selected by cfg['wave'] and cfg['wave_args'] at every time step
+        '''
+        wave_fn = {'sin': self.update_sin,
+                   'ricker': self.update_ricker}[cfg['wave']]
+        tt = np.arange(self.t)
+        return wave_fn(tt = tt, **cfg['wave_args'])
+
+    def advance(self, source, t0, n):
+        '''
+        Advance n time steps starting at step t0, recording frames if writing is enabled
+        Called from run(), can be overwritten by child class to run the block in compiled code
+        '''
+        for s in range(n):
+            self.drive(source[t0+s])
+            self.step()
+            if self.frames is not None:
+                self.frames.ux[..., s] = self.g.ux
+                self.frames.uy[..., s] = self.g.uy
+                self.frames.uz[..., s] = self.g.uz
+
+    def drive(self, value):
+        '''
+        Apply the source value to the input line at x = 0 on the z = 0 surface
+        Called from advance(), can be overwritten by child class
+        '''
+        self.g.uz[..., 0, :, 0] = value
+
     def update_sin(self, tt, f, **kwargs):
         ''' f: frequency in Hz
         **kwargs: accepts additional arguments intended for other wave functions'''
@@ -320,255 +660,266 @@ class BaseSolver:
             delta = 0
         return delta
 
-    def update_T(self):
+    def step(self):
+        '''
+        Advance the stress and displacement fields by one time step
+        Called from run(), can be overwritten by child class to fuse the update phases
+        '''
+        self.update_T()
+        self.update_T_BC()
+        self.update_u()
+        self.update_u_BC()
+        self.time_step()
+
+    def update_T(self, i0=0, i1=None, scratch=None):
         '''
-        Update each component of the stress tensor
+        Update each component of the stress tensor, including the traction free surface at z = 0
+        Only the x planes i0 .. i1-1 are updated if given, using the buffers of scratchBuffers(i0, i1)
         Called from run(), can be overwritten by child class
         '''
+        g, C, c = self.g, self.m.stiffness, self.coef
+        s = self.scratch if scratch is None else scratch
+        i1 = g.x.size-1 if i1 is None else i1
+        a = max(i0, 1) # T1 .. T4 are updated from x plane 1 on
+        uz = g.uz_pad[...,GHOST-1:] # starts at the ghost plane above the surface
 
-        self.g.T1[1:-1,1:-1,1:-1] = \
-          self.m.C[1:-1,1:-1,1:-1,0,0]*(self.g.ux[1:,1:-1,1:-1] - self.g.ux[:-1,1:-1,1:-1]) \
-        / self.g.sdx \
-        + self.m.C[1:-1,1:-1,1:-1,0,1]*(self.g.uy[1:-1,1:,1:-1] - self.g.uy[1:-1,:-1,1:-1]) \
-        / self.g.sdy \
-        + self.m.C[1:-1,1:-1,1:-1,0,2]*(self.g.uz[1:-1,1:-1,1:] - self.g.uz[1:-1,1:-1,:-1]) \
-        / self.g.sdz
-
-        self.g.T2[1:-1,1:-1,1:-1] = \
-          self.m.C[1:-1,1:-1,1:-1,1,0]*(self.g.ux[1:,1:-1,1:-1] - self.g.ux[:-1,1:-1,1:-1]) \
-        / self.g.sdx \
-        + self.m.C[1:-1,1:-1,1:-1,1,1]*(self.g.uy[1:-1,1:,1:-1] - self.g.uy[1:-1,:-1,1:-1]) \
-        / self.g.sdy \
-        + self.m.C[1:-1,1:-1,1:-1,1,2]*(self.g.uz[1:-1,1:-1,1:] - self.g.uz[1:-1,1:-1,:-1]) \
-        / self.g.sdz
-
-        self.g.T3[1:-1,1:-1,1:-1] = \
-            self.m.C[1:-1,1:-1,1:-1,2,0]*(self.g.ux[1:,1:-1,1:-1] - self.g.ux[:-1,1:-1,1:-1]) \
-            / self.g.sdx \
-            + self.m.C[1:-1,1:-1,1:-1,2,1]*(self.g.uy[1:-1,1:,1:-1] - self.g.uy[1:-1,:-1,1:-1]) \
-            / self.g.sdy \
-            + self.m.C[1:-1,1:-1,1:-1,2,2]*(self.g.uz[1:-1,1:-1,1:] - self.g.uz[1:-1,1:-1,:-1]) \
-            / self.g.sdz
-
-        self.g.T4[1:-1,:,:] = self.m.C[1:-1,1:,1:,3,3]*( \
-            (self.g.uy[1:-1,:,1:] - self.g.uy[1:-1,:,:-1]) \
-            / self.g.fdz \
-            + (self.g.uz[1:-1,1:,:] - self.g.uz[1:-1,:-1,:]) \
-            / self.g.fdy
-        )
+        dux = difference(g.ux[...,a:i1,1:-1,:-1], g.ux[...,a-1:i1-1,1:-1,:-1], rows(c['T_ux'], a-1, i1-1), s['dux'])
+        duy = difference(g.uy[...,a:i1,1:,:-1], g.uy[...,a:i1,:-1,:-1], c['T_uy'], s['duy'])
+        duz = difference(uz[...,a:i1,1:-1,1:], uz[...,a:i1,1:-1,:-1], c['T_uz'], s['duz'])
+        du = (dux, duy, duz)
 
-        self.g.T5[:,1:-1,:] = self.m.C[1:,1:-1,1:,4,4]*( \
-            (self.g.ux[:,1:-1,1:] - self.g.ux[:,1:-1,:-1]) \
-            / self.g.fdz \
-            + (self.g.uz[1:,1:-1,:] - self.g.uz[:-1,1:-1,:])
-            / self.g.fdx
-        )
+        for T, row in ((g.T1, 1), (g.T2, 2), (g.T3, 3)):
+            Crow = [rows(C['c{}{}'.format(row, col)], a-1, i1-1) for col in (1, 2, 3)]
+            contract(Crow, du, T[...,a:i1,1:-1,:-1], s['T'])
 
-        self.g.T6[:,:,1:-1] = self.m.C[1:,1:,1:-1,5,5]*( \
-            (self.g.ux[:,1:,1:-1] - self.g.ux[:,:-1,1:-1]) \
-            / self.g.fdy \
-            + (self.g.uy[1:,:,1:-1] - self.g.uy[:-1,:,1:-1]) \
-            / self.g.fdx
-        )
+        T4 = difference(g.uy[...,a:i1,:,1:], g.uy[...,a:i1,:,:-1], c['T4_uy'], g.T4[...,a:i1,:,:])
+        T4 += difference(g.uz[...,a:i1,1:,:], g.uz[...,a:i1,:-1,:], c['T4_uz'], s['T4'])
+        T4 *= rows(C['c44'], a-1, i1-1)
+
+        T5 = difference(g.ux[...,i0:i1,1:-1,1:], g.ux[...,i0:i1,1:-1,:-1], c['T5_ux'], g.T5[...,i0:i1,1:-1,:])
+        T5 += difference(g.uz[...,i0+1:i1+1,1:-1,:], g.uz[...,i0:i1,1:-1,:], rows(c['T5_uz'], i0, i1), s['T5'])
+        T5 *= rows(C['c55'], i0, i1)
+
+        T6 = difference(g.ux[...,i0:i1,1:,:-1], g.ux[...,i0:i1,:-1,:-1], c['T6_ux'], g.T6[...,i0:i1,:,:-1])
+        T6 += difference(g.uy[...,i0+1:i1+1,:,:-1], g.uy[...,i0:i1,:,:-1], rows(c['T6_uy'], i0, i1), s['T6'])
+        T6 *= rows(C['c66'], i0, i1)
 
     def update_T_BC(self):
         '''
         Update stress tensor using boundary conditions
-        TODO: Add Bloch periodic boundary conditions
         '''
-
-        # self.apply_T_pbc(g)
+        self.apply_T_ybc()
         self.apply_T_tfbc()
 
-    def apply_T_pbc(self):
+    def apply_T_ybc(self, i0=0, i1=None):
         '''
-        ARCHIVED: Not currently used. To be updated for Bloch periodic BC
+        Images of the outer y lines of a periodic or mirrored grid, for the x planes i0 .. i1-1 if given
+        Called from update_T_BC(), can be overwritten by child class
         '''
+        if self.g.periodic_y:
+            self.apply_T_pbc(i0, i1)
+        elif self.g.mirror is not None:
+            self.apply_T_mirror(i0, i1)
 
-        self.g.T1[:,0,:] = self.g.T1[:,-2,:]
-        self.g.T2[:,0,:] = self.g.T2[:,-2,:]
-        self.g.T3[:,0,:] = self.g.T3[:,-2,:]
-        # self.g.T4[:,0,:] = self.g.T4[:,-2,:]
-        self.g.T5[:,0,:] = self.g.T5[:,-2,:]
-        # self.g.T6[:,0,:] = self.g.T6[:,-2,:]
+    def apply_T_pbc(self, i0=0, i1=None):
+        '''
+        Bloch periodic BC along y for a unit cell grid, see Grid.buildMesh.
+        The first and last y lines are images of the lines -2 and 1 one cell away, the half lines
+        0 and -1 of T4 and T6 are the same half line. A field one cell further along y is
+        multiplied by the Bloch phase exp(i*bloch_phase), the fields are complex unless it is zero.
+        Each x plane only reads itself, only the planes i0 .. i1-1 are updated if given
+        Called from apply_T_ybc(), can be overwritten by child class
+        '''
+        g, phase, x = self.g, self.blochPhase(), slice(i0, i1)
+        for T in (g.T1_pad, g.T2_pad, g.T3_pad, g.T5_pad):
+            wrapLines(T[...,x,:,:], phase)
+        for T in (g.T4_pad, g.T6_pad):
+            wrapHalfLines(T[...,x,:,:], phase)
 
-        # self.g.T1[:,-1,:] = self.g.T1[:,1,:]
-        # self.g.T2[:,-1,:] = self.g.T2[:,1,:]
-        # self.g.T3[:,-1,:] = self.g.T3[:,1,:]
-        self.g.T4[:,-1,:] = self.g.T4[:,1,:]
-        # self.g.T5[:,-1,:] = self.g.T5[:,1,:]
-        self.g.T6[:,-1,:] = self.g.T6[:,1,:]
+    def apply_T_mirror(self, i0=0, i1=None):
+        '''
+        Mirror BC at y = size_y/2 for a half domain grid, see Grid.buildMesh. The mirror plane is the
+        y line -2, the line -1 and the half line -1 are the images of the line -3 and half line -2.
+        In symmetric mode ux, uz, T1, T2, T3 and T5 are even and uy, T4 and T6 are odd across the plane,
+        antisymmetric mode swaps the parities. Only the x planes i0 .. i1-1 are updated if given
+        Called from apply_T_ybc(), can be overwritten by child class
+        '''
+        g, sign, x = self.g, self.mirrorSign(), slice(i0, i1)
+        for T in (g.T1_pad, g.T2_pad, g.T3_pad, g.T5_pad):
+            mirrorLines(T[...,x,:,:], sign)
+        for T in (g.T4_pad, g.T6_pad):
+            mirrorHalfLines(T[...,x,:,:], -sign)
+
+    def mirrorSign(self):
+        '''
+        Parity of ux and uz across the mirror plane
+        '''
+        return 1 if self.g.mirror == 'symmetric' else -1
 
     def apply_T_tfbc(self):
         '''
-        Update stress tensor using traction free BC
+        Traction free BC, the shear stress above the surface is zero.
+        Fills the ghost layer of T4 and T5 read by update_u, the surface itself is updated by update_T
         Called from apply_T_BC(), can be overwritten by child class
         '''
+        self.g.T4_pad[...,:GHOST] = 0
+        self.g.T5_pad[...,:GHOST] = 0
 
-        self.g.T1[1:-1,1:-1,0] = \
-            self.m.C[1:-1,1:-1,0,0,0]*(self.g.ux[1:,1:-1,0] - self.g.ux[:-1,1:-1,0]) / self.g.sdx[0,:,:] \
-            + self.m.C[1:-1,1:-1,0,0,1]*(self.g.uy[1:-1,1:,0] - self.g.uy[1:-1,:-1,0]) / self.g.sdy[:,0,:] \
-            + self.m.C[1:-1,1:-1,0,0,2]*(self.g.uz[1:-1,1:-1,0] - 0) / self.g.sdz[:,:,0]
-
-        self.g.T2[1:-1,1:-1,0] = \
-            self.m.C[1:-1,1:-1,0,1,0]*(self.g.ux[1:,1:-1,0] - self.g.ux[:-1,1:-1,0]) / self.g.sdx[0,:,:] \
-            + self.m.C[1:-1,1:-1,0,1,1]*(self.g.uy[1:-1,1:,0] - self.g.uy[1:-1,:-1,0]) / self.g.sdy[:,0,:] \
-            + self.m.C[1:-1,1:-1,0,1,2]*(self.g.uz[1:-1,1:-1,0] - 0) / self.g.sdz[:,:,0]
-
-        self.g.T3[1:-1,1:-1,0] = 0
-
-        self.g.T4[1:-1,:,0] = \
-            self.m.C[1:-1,1:,0,3,3] \
-            * ((self.g.uy[1:-1,:,1] - self.g.uy[1:-1,:,0]) / self.g.fdy[:,0,:] \
-            + (self.g.uz[1:-1,1:,0] - self.g.uz[1:-1,:-1,0]) / self.g.fdz[:,:,0])
-
-        self.g.T5[:,1:-1,0] = \
-            self.m.C[1:,1:-1,0,4,4] \
-            * ((self.g.ux[:,1:-1,1] - self.g.ux[:,1:-1,0]) / self.g.fdx[0,:,:] \
-            + (self.g.uz[1:,1:-1,0] - self.g.uz[:-1,1:-1,0]) / self.g.fdz[:,:,0])
-
-        self.g.T6[:,:,0] = \
-            self.m.C[1:,1:,0,5,5] \
-            * ((self.g.ux[:,1:,0] - self.g.ux[:,:-1,0]) / self.g.fdx[0,:,:] \
-            + (self.g.uy[1:,:,0] - self.g.uy[:-1,:,0]) / self.g.fdz[:,:,0])
-
-    def update_u(self):
+    def update_u(self, i0=0, i1=None, scratch=None):
         '''
-        Update displacement vectors based on stress tensor
+        Update displacement vectors based on stress tensor, including the traction free surface at z = 0
+        Only the x planes i0 .. i1-1 are updated if given, using the buffers of scratchBuffers(i0, i1)
         Called from run(), can be overwritten by child class
         '''
-
-        self.g.ux_new[:,1:-1,1:-1] = 2*self.g.ux[:,1:-1,1:-1] \
-            - self.g.ux_old[:,1:-1,1:-1] \
-            + (self.m.dt**2/self.m.P[1:,1:-1,1:-1]) \
-            * ((self.g.T1[1:,1:-1,1:-1] - self.g.T1[:-1,1:-1,1:-1]) / self.g.fdx \
-                + (self.g.T6[:,1:,1:-1] - self.g.T6[:,:-1,1:-1]) / self.g.sdy \
-                + (self.g.T5[:,1:-1,1:] - self.g.T5[:,1:-1,:-1]) / self.g.sdz \
-            )
-
-        self.g.uy_new[1:-1,:,1:-1] = 2*self.g.uy[1:-1,:,1:-1] \
-            - self.g.uy_old[1:-1,:,1:-1] \
-            + (self.m.dt**2/self.m.P[1:-1,1:,1:-1]) \
-            * ((self.g.T6[1:,:,1:-1] - self.g.T6[:-1,:,1:-1]) / self.g.sdx \
-                + (self.g.T2[1:-1,1:,1:-1] - self.g.T2[1:-1,:-1,1:-1]) / self.g.fdy \
-                + (self.g.T4[1:-1,:,1:] - self.g.T4[1:-1,:,:-1]) / self.g.sdz \
-            )
-
-        self.g.uz_new[1:-1,1:-1,:] = 2*self.g.uz[1:-1,1:-1,:] \
-            - self.g.uz_old[1:-1,1:-1,:] \
-            + (self.m.dt**2/self.m.P[1:-1,1:-1,1:]) \
-            * ((self.g.T5[1:,1:-1,:] - self.g.T5[:-1,1:-1,:]) / self.g.sdx \
-                + (self.g.T4[1:-1,1:,:] - self.g.T4[1:-1,:-1,:]) / self.g.sdy \
-                + (self.g.T3[1:-1,1:-1,1:] - self.g.T3[1:-1,1:-1,:-1]) / self.g.fdz \
-            )
+        g, c = self.g, self.coef
+        s = self.scratch if scratch is None else scratch
+        i1 = g.x.size-1 if i1 is None else i1
+        a = max(i0, 1) # uy and uz are updated from x plane 1 on
+        # start at the ghost plane above the surface
+        T4, T5 = g.T4_pad[...,GHOST-1:], g.T5_pad[...,GHOST-1:]
+
+        ux = difference(g.T1[...,i0+1:i1+1,1:-1,:-1], g.T1[...,i0:i1,1:-1,:-1], rows(c['ux_T1'], i0, i1), g.ux_new[...,i0:i1,1:-1,:-1])
+        ux += difference(g.T6[...,i0:i1,1:,:-1], g.T6[...,i0:i1,:-1,:-1], c['ux_T6'], s['ux'])
+        ux += difference(T5[...,i0:i1,1:-1,1:], T5[...,i0:i1,1:-1,:-1], c['ux_T5'], s['ux'])
+        self.leapfrog(ux, g.ux[...,i0:i1,1:-1,:-1], g.ux_old[...,i0:i1,1:-1,:-1], rows(c.get('ux'), i0, i1), s['ux'])
+
+        uy = difference(g.T6[...,a:i1,:,:-1], g.T6[...,a-1:i1-1,:,:-1], rows(c['uy_T6'], a-1, i1-1), g.uy_new[...,a:i1,:,:-1])
+        uy += difference(g.T2[...,a:i1,1:,:-1], g.T2[...,a:i1,:-1,:-1], c['uy_T2'], s['uy'])
+        uy += difference(T4[...,a:i1,:,1:], T4[...,a:i1,:,:-1], c['uy_T4'], s['uy'])
+        self.leapfrog(uy, g.uy[...,a:i1,:,:-1], g.uy_old[...,a:i1,:,:-1], rows(c.get('uy'), a-1, i1-1), s['uy'])
+
+        uz = difference(g.T5[...,a:i1,1:-1,:], g.T5[...,a-1:i1-1,1:-1,:], rows(c['uz_T5'], a-1, i1-1), g.uz_new[...,a:i1,1:-1,:])
+        uz += difference(g.T4[...,a:i1,1:,:], g.T4[...,a:i1,:-1,:], c['uz_T4'], s['uz'])
+        uz += difference(g.T3[...,a:i1,1:-1,1:], g.T3[...,a:i1,1:-1,:-1], c['uz_T3'], s['uz'])
+        self.leapfrog(uz, g.uz[...,a:i1,1:-1,:], g.uz_old[...,a:i1,1:-1,:], rows(c.get('uz'), a-1, i1-1), s['uz'])
+
+    def leapfrog(self, out, u, u_old, r, tmp):
+        '''
+        Completes out = 2*u - u_old + r * out in place, r is dt**2/P at the displacement positions
+        or None if it is already folded into out, tmp is used as scratch space
+        '''
+        if r is not None:
+            out *= r
+        np.multiply(u, 2, out=tmp)
+        tmp -= u_old
+        out += tmp
 
     def update_u_BC(self):
         '''
         Update displacement vectors using boundary conditions
         Called from run()
-        TODO: Add Bloch periodic boundary conditions
         '''
-        # self.apply_u_pbc()
         self.apply_u_tfbc()
         self.apply_u_abc()
+        self.apply_u_ybc()
 
-    def apply_u_pbc(self):
+    def apply_u_ybc(self, i0=0, i1=None):
         '''
-        ARCHIVED: Not in use. To be updated for Bloch peridoic BC
+        Images of the outer y lines of the new displacement of a periodic or mirrored grid.
+        Applied after the absorbing BC of the same x planes so the images also hold the x and z faces
+        Called from update_u_BC, can be overwritten by child class
         '''
+        if self.g.periodic_y:
+            self.apply_u_pbc(i0, i1)
+        elif self.g.mirror is not None:
+            self.apply_u_mirror(i0, i1)
 
-        self.g.ux_new[:,0,:] = self.g.ux_new[:,-2,:]
-        # self.g.uy_new[:,0,:] = self.g.uy_new[:,-2,:]
-        self.g.uz_new[:,0,:] = self.g.uz_new[:,-2,:]
+    def apply_u_pbc(self, i0=0, i1=None):
+        '''
+        Bloch periodic BC along y of the new displacement of the x planes i0 .. i1-1, see apply_T_pbc
+        Called from apply_u_ybc, can be overwritten by child class
+        '''
+        g, phase, x = self.g, self.blochPhase(), slice(i0, i1)
+        wrapLines(g.ux_new_pad[...,x,:,:], phase)
+        wrapLines(g.uz_new_pad[...,x,:,:], phase)
+        wrapHalfLines(g.uy_new_pad[...,x,:,:], phase)
 
-        # self.g.ux_new[:,-1,:] = self.g.ux_new[:,1,:]
-        self.g.uy_new[:,-1,:] = self.g.uy_new[:,1,:]
-        # self.g.uz_new[:,-1,:] = self.g.uz_new[:,1,:]
+    def apply_u_mirror(self, i0=0, i1=None):
+        '''
+        Mirror BC of the new displacement of the x planes i0 .. i1-1, see apply_T_mirror
+        Called from apply_u_ybc, can be overwritten by child class
+        '''
+        g, sign, x = self.g, self.mirrorSign(), slice(i0, i1)
+        mirrorLines(g.ux_new_pad[...,x,:,:], sign)
+        mirrorLines(g.uz_new_pad[...,x,:,:], sign)
+        mirrorHalfLines(g.uy_new_pad[...,x,:,:], -sign)
 
     def apply_u_tfbc(self):
         '''
-        Update displacement vectors using traction free BC
+        Traction free BC, the displacement above the surface is zero.
+        Fills the ghost layer of uz read by update_T, the surface itself is updated by update_u
         Called from update_u_BC, can be overwritten by child class
         '''
-
-        # affects z = 0 index only
-        self.g.ux_new[:,1:-1,0] = 2*self.g.ux[:,1:-1,0] \
-            - self.g.ux_old[:,1:-1,0] \
-            + (self.m.dt**2/self.m.P[1:,1:-1,0]) \
-            * ((self.g.T1[1:,1:-1,0] - self.g.T1[:-1,1:-1,0]) / self.g.fdx[0,:,:] \
-                + (self.g.T6[:,1:,0] - self.g.T6[:,:-1,0]) / self.g.sdy[:,0,:] \
-                + (self.g.T5[:,1:-1,0] - 0) / self.g.sdz[:,:,0] \
-            )
-
-        self.g.uy_new[1:-1,:,0] = 2*self.g.uy[1:-1,:,0] \
-            - self.g.uy_old[1:-1,:,0] \
-            + (self.m.dt**2/self.m.P[1:-1,1:,0]) \
-            * ((self.g.T6[1:,:,0] - self.g.T6[:-1,:,0]) / self.g.sdx[0,:,:] \
-                + (self.g.T2[1:-1,1:,0] - self.g.T2[1:-1,:-1,0]) / self.g.fdy[:,0,:] \
-                + (self.g.T4[1:-1,:,0] - 0) / self.g.sdz[:,:,0] \
-            )
-
-        self.g.uz_new[1:-1,1:-1,0] = 2*self.g.uz[1:-1,1:-1,0] \
-            - self.g.uz_old[1:-1,1:-1,0] \
-            + (self.m.dt**2/self.m.P[1:-1,1:-1,0]) \
-            * ((self.g.T5[1:,1:-1,0] - self.g.T5[:-1,1:-1,0]) / self.g.sdx[0,:,:] \
-                + (self.g.T4[1:-1,1:,0] - self.g.T4[1:-1,:-1,0]) / self.g.sdy[:,0,:] \
-                + self.g.T3[1:-1,1:-1,1] - self.g.T3[1:-1,1:-1,0] / self.g.fdz[:,:,0] \
-            )
+        self.g.uz_new_pad[...,:GHOST] = 0
 
     def apply_u_abc(self):
         '''
         Update displacement vectors using absorbing BC
         Called from update_u_BC, can be overwritten by child class
         '''
+        self.apply_u_abc_x()
+        self.apply_u_abc_yz()
 
-        c11 = self.m.C[0,0,0,0,0]
-        c44 = self.m.C[0,0,0,3,3]
-        vl = np.sqrt(c11/self.m.P[0,0,0]) # parallel
-        vt = np.sqrt(c44/self.m.P[0,0,0]) # transverse
+    def apply_u_abc_x(self):
+        '''
+        Absorbing BC on the x max face, reads the two last x planes of the new displacement
+        '''
+        g, abc = self.g, self.coef['abc']
+        clx, ctx = abc['clx'], abc['ctx']
 
-        ctx = ((vt*self.m.dt-self.g.fdx)/(vt*self.m.dt+self.g.fdx))[:,0,0] # shifted transverse constant
-        clx = ((vl*self.m.dt-self.g.sdx)/(vl*self.m.dt+self.g.sdx))[:,0,0] # shifted parallel constant
+        # YZ face
+        absorb(g.ux_new[...,-1,:,:], g.ux[...,-2,:,:], g.ux_new[...,-2,:,:], g.ux[...,-1,:,:], clx)
+        absorb(g.uy_new[...,-1,:,:], g.uy[...,-2,:,:], g.uy_new[...,-2,:,:], g.uy[...,-1,:,:], ctx)
+        absorb(g.uz_new[...,-1,:,:], g.uz[...,-2,:,:], g.uz_new[...,-2,:,:], g.uz[...,-1,:,:], ctx)
 
-        cty = ((vt*self.m.dt-self.g.fdy)/(vt*self.m.dt+self.g.fdy))[0,:,0]
-        cly = ((vl*self.m.dt-self.g.sdy)/(vl*self.m.dt+self.g.sdy))[0,:,0]
+    def apply_u_abc_yz(self, i0=0, i1=None):
+        '''
+        Absorbing BC on the y and z faces of the x planes i0 .. i1-1 (all by default)
+        Each plane only reads itself, applied after apply_u_abc_x to the last three planes
+        '''
+        self.apply_u_abc_y(i0, i1)
+        self.apply_u_abc_z(i0, i1)
 
-        ctz = ((vt*self.m.dt-self.g.fdz)/(vt*self.m.dt+self.g.fdz))[0,0,:]
-        clz = ((vl*self.m.dt-self.g.sdz)/(vl*self.m.dt+self.g.sdz))[0,0,:]
+    def apply_u_abc_y(self, i0=0, i1=None):
+        '''
+        Absorbing BC on the y faces of the x planes i0 .. i1-1, see apply_u_abc_yz
+        The y faces of a periodic grid and the mirror plane are set by apply_u_ybc instead
+        '''
+        g, abc = self.g, self.coef['abc']
+        cly, cty = (abc['cly0'], abc['cly1']), (abc['cty0'], abc['cty1'])
+        x = slice(i0, i1)
 
-        # YZ face
-        self.g.ux_new[-1,:,:] = self.g.ux[-2,:,:] + clx[-1]*(self.g.ux_new[-2,:,:]-self.g.ux[-1,:,:])
-        self.g.uy_new[-1,:,:] = self.g.uy[-2,:,:] + ctx[-1]*(self.g.uy_new[-2,:,:]-self.g.uy[-1,:,:])
-        self.g.uz_new[-1,:,:] = self.g.uz[-2,:,:] + ctx[-1]*(self.g.uz_new[-2,:,:]-self.g.uz[-1,:,:])
+        if not g.periodic_y:
+            absorb(g.ux_new[...,x,0,:], g.ux[...,x,1,:], g.ux_new[...,x,1,:], g.ux[...,x,0,:], cty[0])
+            absorb(g.uy_new[...,x,0,:], g.uy[...,x,1,:], g.uy_new[...,x,1,:], g.uy[...,x,0,:], cly[0])
+            absorb(g.uz_new[...,x,0,:], g.uz[...,x,1,:], g.uz_new[...,x,1,:], g.uz[...,x,0,:], cty[0])
 
-        self.g.ux_new[:,0,:] = self.g.ux[:,1,:] + cty[0]*(self.g.ux_new[:,1,:]-self.g.ux[:,0,:])
-        self.g.uy_new[:,0,:] = self.g.uy[:,1,:] + cly[0]*(self.g.uy_new[:,1,:]-self.g.uy[:,0,:])
-        self.g.uz_new[:,0,:] = self.g.uz[:,1,:] + cty[0]*(self.g.uz_new[:,1,:]-self.g.uz[:,0,:])
+        if not g.periodic_y and g.mirror is None:
+            absorb(g.ux_new[...,x,-1,:], g.ux[...,x,-2,:], g.ux_new[...,x,-2,:], g.ux[...,x,-1,:], cty[-1])
+            absorb(g.uy_new[...,x,-1,:], g.uy[...,x,-2,:], g.uy_new[...,x,-2,:], g.uy[...,x,-1,:], cly[-1])
+            absorb(g.uz_new[...,x,-1,:], g.uz[...,x,-2,:], g.uz_new[...,x,-2,:], g.uz[...,x,-1,:], cty[-1])
 
-        self.g.ux_new[:,-1,:] = self.g.ux[:,-2,:] + cty[-1]*(self.g.ux_new[:,-2,:]-self.g.ux[:,-1,:])
-        self.g.uy_new[:,-1,:] = self.g.uy[:,-2,:] + cly[-1]*(self.g.uy_new[:,-2,:]-self.g.uy[:,-1,:])
-        self.g.uz_new[:,-1,:] = self.g.uz[:,-2,:] + cty[-1]*(self.g.uz_new[:,-2,:]-self.g.uz[:,-1,:])
+    def apply_u_abc_z(self, i0=0, i1=None):
+        '''
+        Absorbing BC on the z max face of the x planes i0 .. i1-1, see apply_u_abc_yz
+        '''
+        g, abc = self.g, self.coef['abc']
+        clz, ctz = abc['clz'], abc['ctz']
+        x = slice(i0, i1)
 
-        self.g.ux_new[:,:,-1] = self.g.ux[:,:,-2] + ctz[-1]*(self.g.ux_new[:,:,-2]-self.g.ux[:,:,-1])
-        self.g.uy_new[:,:,-1] = self.g.uy[:,:,-2] + ctz[-1]*(self.g.uy_new[:,:,-2]-self.g.uy[:,:,-1])
-        self.g.uz_new[:,:,-1] = self.g.uz[:,:,-2] + clz[-1]*(self.g.uz_new[:,:,-2]-self.g.uz[:,:,-1])
+        absorb(g.ux_new[...,x,:,-1], g.ux[...,x,:,-2], g.ux_new[...,x,:,-2], g.ux[...,x,:,-1], ctz)
+        absorb(g.uy_new[...,x,:,-1], g.uy[...,x,:,-2], g.uy_new[...,x,:,-2], g.uy[...,x,:,-1], ctz)
+        absorb(g.uz_new[...,x,:,-1], g.uz[...,x,:,-2], g.uz_new[...,x,:,-2], g.uz[...,x,:,-1], clz)
 
     def time_step(self):
         '''
         Update the time step, shift displacement matrices
         '''
 
-        self.g.ux_temp[:,:,:] = self.g.ux
-        self.g.uy_temp[:,:,:] = self.g.uy
-        self.g.uz_temp[:,:,:] = self.g.uz
-
-        self.g.ux[:,:,:] = self.g.ux_new
-        self.g.uy[:,:,:] = self.g.uy_new
-        self.g.uz[:,:,:] = self.g.uz_new
-
-        self.g.ux_old[:,:,:] = self.g.ux_temp
-        self.g.uy_old[:,:,:] = self.g.uy_temp
-        self.g.uz_old[:,:,:] = self.g.uz_temp
+        self.g.rotate()
+        # The source line is never written by the update, clear the value
+        # left in the recycled buffer from the source applied two steps ago
+        self.g.uz_new[..., 0, :, 0] = 0
 
 if __name__ == '__main__':
     import logging
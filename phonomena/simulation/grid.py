@@ -18,13 +18,55 @@ from threading import Lock
 
 from gui.worker import WorkerSignals
 
+import logging
+logger = logging.getLogger(__name__)
+
 DTYPE = np.float64
 
+# Zero planes stored ahead of the z = 0 surface of every state array, see Grid.update
+GHOST = 1
+
+# Relative spread of the spacing along an axis below which Grid.uniform treats it as constant
+UNIFORM_RTOL = 1e-9
+
+# Spacing growth away from the inclusions, selected by Grid.init. Module level so that a
+# pickled grid does not carry a closure over another grid (see solver_remote)
+SPACING_FNS = {'linear': lambda x, slope: abs(x * slope)}
+
 class FrozenGrid:
     ux = None
     uy = None
     uz = None
 
+    def head(self, n):
+        '''
+        Returns a copy of the first n frames of a frame buffer (see Grid.frameBuffer)
+        '''
+        fg = FrozenGrid()
+        fg.ux = np.copy(self.ux[..., :n])
+        fg.uy = np.copy(self.uy[..., :n])
+        fg.uz = np.copy(self.uz[..., :n])
+        return fg
+
+
+def ringBuffer(name, offset):
+    '''
+    Property resolving to one slot of a ring of padded displacement buffers (see Grid.rotate)
+    '''
+    def get(self):
+        return getattr(self, name)[(self.ring + offset) % 3]
+    def set(self, value):
+        getattr(self, name)[(self.ring + offset) % 3] = value
+    return property(get, set)
+
+def interior(name):
+    '''
+    Property resolving to a padded state array without its ghost layer
+    '''
+    def get(self):
+        return getattr(self, name)[...,GHOST:]
+    return property(get)
+
 
 class Grid:
 
@@ -32,6 +74,34 @@ class Grid:
     Grid class stores mesh information and includes function for building a non-uniform mesh.
     '''
 
+    # Current, new and old displacements are views into a ring of three buffers
+    ux_pad = ringBuffer('ux_ring', 0)
+    uy_pad = ringBuffer('uy_ring', 0)
+    uz_pad = ringBuffer('uz_ring', 0)
+    ux_new_pad = ringBuffer('ux_ring', 1)
+    uy_new_pad = ringBuffer('uy_ring', 1)
+    uz_new_pad = ringBuffer('uz_ring', 1)
+    ux_old_pad = ringBuffer('ux_ring', 2)
+    uy_old_pad = ringBuffer('uy_ring', 2)
+    uz_old_pad = ringBuffer('uz_ring', 2)
+
+    # State arrays without the ghost layer, as read by the writer and the solvers
+    ux = interior('ux_pad')
+    uy = interior('uy_pad')
+    uz = interior('uz_pad')
+    ux_new = interior('ux_new_pad')
+    uy_new = interior('uy_new_pad')
+    uz_new = interior('uz_new_pad')
+    ux_old = interior('ux_old_pad')
+    uy_old = interior('uy_old_pad')
+    uz_old = interior('uz_old_pad')
+    T1 = interior('T1_pad')
+    T2 = interior('T2_pad')
+    T3 = interior('T3_pad')
+    T4 = interior('T4_pad')
+    T5 = interior('T5_pad')
+    T6 = interior('T6_pad')
+
     def __init__(self):
         '''
         Basic object creation. init() method should also be called to setup the grid object
@@ -44,6 +114,10 @@ class Grid:
         self.slope = 1
 
         self.SI_conversion = 1 # all variables stored in mm
+        self.batch = () # leading shape of the state arrays, see update()
+        self.periodic_y = False # single unit cell repeated along y, see buildMesh()
+        self.mirror_y = None # 'symmetric', 'antisymmetric' or 'auto', mesh the half domain below y = size_y/2
+        self.mirror = None # mode of the mirror plane of the current mesh, see mirrorMode()
 
         self.clearMesh() # Initialize mesh arrays
         self.clearInclusions() # Initialize targets array
@@ -54,13 +128,12 @@ class Grid:
         Future versions can add additional spacing functions (x**2, exp, 1/x, etc.)
         '''
 
-        spacing_fns = {'linear': lambda x: abs(x * self.slope)}
-
         self.size_x = int(size_x)
         self.size_y = int(size_y)
         self.size_z = int(size_z)
 
-        self.spacing_fn = spacing_fns[fn]
+        assert fn in SPACING_FNS
+        self.spacing_fn = fn
 
         self.buildMesh()
         self.update()
@@ -76,38 +149,70 @@ class Grid:
         fg.uz = np.copy(self.uz)
         return fg
 
-    def update(self):
+    def rotate(self, n=1):
+        '''
+        Shift the displacement buffers n time steps: new becomes current, current becomes old
+        and the old buffer is recycled as the next new buffer. No data is copied.
+        '''
+        self.ring = (self.ring + n) % 3
+
+    def frameBuffer(self, n):
+        '''
+        Returns a FrozenGrid holding n displacement frames, with time along the last axis
+        Used to hand several time steps to the writer at once
+        '''
+        fg = FrozenGrid()
+        fg.ux = np.zeros(self.ux.shape + (n,), dtype=self.ux.dtype)
+        fg.uy = np.zeros(self.uy.shape + (n,), dtype=self.uy.dtype)
+        fg.uz = np.zeros(self.uz.shape + (n,), dtype=self.uz.dtype)
+        return fg
+
+    def update(self, dtype=DTYPE, batch=()):
         '''
         Create mesh data used in simualtion once all variables are set (manually and using buildMesh())
+        dtype sets the precision of the displacement and stress arrays,
+        batch is prepended to the shape of every state array to advance several simulations at once
+        State arrays are stored with GHOST zero planes ahead of the z = 0 surface (*_pad),
+        so stencils crossing the traction free surface read zeros instead of needing a separate update.
         '''
         x = self.x.size
         y = self.y.size
         z = self.z.size
 
         # Displacement matrices (Highest precision)
-        self.ux = np.zeros((x-1, y, z), dtype=DTYPE)
-        self.uy = np.zeros((x, y-1, z), dtype=DTYPE)
-        self.uz = np.zeros((x, y, z-1), dtype=DTYPE)
+        # Old, current and new time steps, accessed through ux, ux_new, ux_old etc.
+        self.ring = 0
+        self.batch = b = tuple(batch)
+        self.ux_ring = [np.zeros(b + (x-1, y, z+GHOST), dtype=dtype) for i in range(3)]
+        self.uy_ring = [np.zeros(b + (x, y-1, z+GHOST), dtype=dtype) for i in range(3)]
+        self.uz_ring = [np.zeros(b + (x, y, z-1+GHOST), dtype=dtype) for i in range(3)]
 
-        self.ux_new = np.zeros((x-1, y, z), dtype=DTYPE)
-        self.uy_new = np.zeros((x, y-1, z), dtype=DTYPE)
-        self.uz_new = np.zeros((x, y, z-1), dtype=DTYPE)
+        # Stress tensor
+        self.T1_pad = np.zeros(b + (x, y, z+GHOST), dtype=dtype)
+        self.T2_pad = np.zeros(b + (x, y, z+GHOST), dtype=dtype)
+        self.T3_pad = np.zeros(b + (x, y, z+GHOST), dtype=dtype)
+        self.T4_pad = np.zeros(b + (x, y-1, z-1+GHOST), dtype=dtype)
+        self.T5_pad = np.zeros(b + (x-1, y, z-1+GHOST), dtype=dtype)
+        self.T6_pad = np.zeros(b + (x-1, y-1, z+GHOST), dtype=dtype)
 
-        self.ux_old = np.zeros((x-1, y, z), dtype=DTYPE)
-        self.uy_old = np.zeros((x, y-1, z), dtype=DTYPE)
-        self.uz_old = np.zeros((x, y, z-1), dtype=DTYPE)
+        self.updateSpacing()
 
-        self.ux_temp = np.zeros((x-1, y, z), dtype=DTYPE)
-        self.uy_temp = np.zeros((x, y-1, z), dtype=DTYPE)
-        self.uz_temp = np.zeros((x, y, z-1), dtype=DTYPE)
+    def clearState(self):
+        '''
+        Drop the state arrays of update(), keeping the mesh lines and spacing
+        '''
+        self.ux_ring = self.uy_ring = self.uz_ring = None
+        self.T1_pad = self.T2_pad = self.T3_pad = None
+        self.T4_pad = self.T5_pad = self.T6_pad = None
 
-        # Stress tensor
-        self.T1 = np.zeros((x, y, z), dtype=DTYPE)
-        self.T2 = np.zeros((x, y, z), dtype=DTYPE)
-        self.T3 = np.zeros((x, y, z), dtype=DTYPE)
-        self.T4 = np.zeros((x, y-1, z-1), dtype=DTYPE)
-        self.T5 = np.zeros((x-1, y, z-1), dtype=DTYPE)
-        self.T6 = np.zeros((x-1, y-1, z), dtype=DTYPE)
+    def updateSpacing(self):
+        '''
+        Full (fd*) and staggered (sd*) spacing arrays of the current mesh lines,
+        called by update(). Can be called on its own when the state arrays are not needed.
+        '''
+        x = self.x.size
+        y = self.y.size
+        z = self.z.size
 
         # fd and sd must be in SI units for calculation. Converted here.
         x_SI = self.x * self.SI_conversion
@@ -127,6 +232,12 @@ class Grid:
         self.sdz = np.mean([self.fdz[:,:,1:], self.fdz[:,:,:-1]], axis=0)
         #print(self.sdz.shape)
 
+    def uniform(self):
+        '''
+        True if the spacing is constant along each axis, the solvers can then use scalar spacings
+        '''
+        return all(np.ptp(d) <= UNIFORM_RTOL*np.abs(d).max() for d in (self.fdx, self.fdy, self.fdz))
+
     def clearMesh(self):
         '''
         Clear mesh data. Resets dimesnion arrays
@@ -174,6 +285,37 @@ class Grid:
             I.append((yx, z))
         return I
 
+    def mirrorSymmetric(self):
+        '''
+        True if the inclusions are symmetric about the plane y = size_y/2
+        '''
+        t = self.targets
+        for x, y, z, r in t:
+            image = np.isclose(t['x'], x) & np.isclose(t['y'], self.size_y - y) & np.isclose(t['z'], z) & np.isclose(t['r'], r)
+            if not image.any():
+                return False
+        return True
+
+    def mirrorMode(self):
+        '''
+        Boundary at the mirror plane y = size_y/2 selected by mirror_y, None to mesh the whole domain.
+        'auto' is symmetric when the inclusions are, the source excites the whole x = 0 face
+        and is always symmetric. The coefficients of the half lines along y are sampled from the
+        line above them, so a whole domain run is not exactly symmetric across the edges of the
+        inclusions, the half domain solves the image of its lower half.
+        '''
+        if not self.mirror_y:
+            return None
+        if self.periodic_y:
+            raise Exception("A periodic grid can not be mirrored along y")
+        symmetric = self.mirrorSymmetric()
+        if self.mirror_y == 'auto':
+            return 'symmetric' if symmetric else None
+        assert self.mirror_y in ('symmetric', 'antisymmetric')
+        if not symmetric:
+            logger.warning("Inclusions are not symmetric about y = {}, meshing half of the domain anyway.".format(self.size_y/2))
+        return self.mirror_y
+
     def buildMesh(self, *args, **kwargs):
 
         def appendSorted(arr, values):
@@ -187,7 +329,7 @@ class Grid:
             fine_mesh = np.array((0,))
             dx = 0
             while dx < max_d:
-                dx = self.spacing_fn(fine_mesh[-1] + self.min_d) + self.min_d
+                dx = SPACING_FNS[self.spacing_fn](fine_mesh[-1] + self.min_d, self.slope) + self.min_d
                 if dx < max_d:
                     fine_mesh = np.append(fine_mesh, fine_mesh[-1] + dx)
 
@@ -295,6 +437,17 @@ class Grid:
             self.y = appendSorted(self.y, functionMesh('y'))
             self.y = removeClose(self.y)
         self.y = appendSorted(self.y, closestFit('y'))
+        if self.periodic_y:
+            # Unit cell, y = 0 and y = size_y are the same line. The first line is the image of the
+            # last line of the cell below y = 0, the solver keeps both outer lines as Bloch images
+            self.y = np.insert(self.y, 0, self.y[-2] - self.size_y)
+        self.mirror = self.mirrorMode()
+        if self.mirror is not None:
+            # Half domain, the line before last is the mirror plane and the last line is the image
+            # of the line below the plane, the solver keeps it as a mirror image
+            mid = self.size_y/2
+            self.y = np.append(self.y[self.y < mid - self.min_d/2], mid)
+            self.y = np.append(self.y, 2*mid - self.y[-2])
 
         # Add/update Z lines. Uniform constant mesh spacing
         n = int(self.size_z / self.max_dz)
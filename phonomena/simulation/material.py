@@ -19,6 +19,9 @@ logger = logging.getLogger(__name__)
 
 DYTPE = np.float64
 
+# Indices into Material.phases, stored per cell in Material.phase
+PRIMARY, SECONDARY = 0, 1
+
 class Material:
 
     def __init__(self):
@@ -30,8 +33,15 @@ class Material:
         self.c_max = 0.5 #courant number
         self.dt = 0
 
+        # compact: only keep the phase map and the per phase coefficients,
+        # C, P and stiffness are left as None / empty
+        self.compact = False
+        self.phase = np.zeros((0,0,0), dtype=np.uint8)
+        self.phases = {'c': np.zeros((0,6,6)), 'p': np.zeros(0)}
+
         self.C = np.zeros((0,0,0,6,6))
         self.P = np.zeros((0,0,0))
+        self.stiffness = {}
 
     def init(self, grid, properties):
         self.grid = grid
@@ -45,22 +55,83 @@ class Material:
         self.setPrimary(keys[0])
         self.setSecondary(keys[0])
 
-    def update(self):
-        self.C = np.zeros((self.grid.x.size, self.grid.y.size, self.grid.z.size, 6, 6))
-        self.P = np.zeros((self.grid.x.size, self.grid.y.size, self.grid.z.size))
+    def update(self, dtype=DYTPE):
+        '''
+        dtype sets the precision of the coefficient arrays used by the solvers
+        '''
+        self.phase = np.zeros((self.grid.x.size, self.grid.y.size, self.grid.z.size), dtype=np.uint8)
 
         self.setTimeStep()
-        self.setConstants()
+        self.setPhases(dtype)
+        if self.compact:
+            self.C, self.P, self.stiffness = None, None, {}
+        else:
+            self.setConstants()
+            self.setStiffness()
 
-    def setConstants(self):
-        self.C[:,:,:] = np.array(self.primary['c'])
-        self.P[:,:,:] = float(self.primary['p'])
+    def setPhases(self, dtype=DYTPE):
+        self.phases = {
+            'c': np.array([self.primary['c'], self.secondary['c']], dtype=dtype),
+            'p': np.array([self.primary['p'], self.secondary['p']], dtype=dtype),
+        }
+        self.phase[:,:,:] = PRIMARY
 
         I = self.grid.inclusionIndices()
         for yx, z in I:
             for y, x in yx:
-                self.C[x,y,z] = np.array(self.secondary['c'])
-                self.P[x,y,z] = float(self.secondary['p'])
+                self.phase[x,y,z] = SECONDARY
+
+    def setConstants(self):
+        self.C = self.phases['c'][self.phase]
+        self.P = self.phases['p'][self.phase]
+
+    def density(self):
+        '''
+        Per cell density, expanded from the phase map in compact mode
+        '''
+        if self.P is None:
+            return self.phases['p'][self.phase]
+        return self.P
+
+    def homogeneous(self):
+        '''
+        True if every cell has the same coefficients,
+        either both phases are the same material or a single phase fills the grid
+        '''
+        c, p = self.phases['c'], self.phases['p']
+        if np.array_equal(c[PRIMARY], c[SECONDARY]) and p[PRIMARY] == p[SECONDARY]:
+            return True
+        return bool((self.phase == self.phase.flat[0]).all())
+
+    def setStiffness(self):
+        '''
+        Expand the stiffness coefficients used by the solvers into contiguous arrays,
+        sliced to the staggered positions of the stress component they update.
+        Called by update(), and by solvers that need them for a compact material.
+        c11 .. c33 are at the T1, T2, T3 positions, c44, c55, c66 at T4, T5, T6.
+        The first z plane (k = 0) holds the coefficients of the traction free surface
+        and the interior follows from k = 1, c31 .. c33 are zero at the surface.
+        A homogeneous material only keeps a (1, 1, z) profile, broadcast by the kernels.
+        '''
+        c, phase = self.phases['c'], self.phase
+        homogeneous = self.homogeneous()
+        if homogeneous:
+            phase = np.full((3, 3, phase.shape[2]), phase.flat[0], dtype=phase.dtype)
+        # the surface update of T4 and T5 reads z = 0, the interior z = k + 1
+        surface = lambda p: np.concatenate((p[:,:,:1], p[:,:,2:]), axis=2)
+        stiffness = {}
+        for a in range(3):
+            for b in range(3):
+                key = 'c{}{}'.format(a+1, b+1)
+                stiffness[key] = c[phase[1:-1,1:-1,:-1],a,b]
+                if a == 2:
+                    stiffness[key][:,:,0] = 0
+        stiffness['c44'] = c[surface(phase[1:-1,1:,:]),3,3]
+        stiffness['c55'] = c[surface(phase[1:,1:-1,:]),4,4]
+        stiffness['c66'] = c[phase[1:,1:,:-1],5,5]
+        if homogeneous:
+            stiffness = {key: value[:1,:1,:] for key, value in stiffness.items()}
+        self.stiffness = {key: np.ascontiguousarray(value) for key, value in stiffness.items()}
 
     def setPrimary(self, m):
         if m in self.properties.keys():
@@ -76,21 +147,26 @@ class Material:
         else:
             raise Exception()
 
+    @staticmethod
+    def velocities(c, p):
+        '''
+        Parallel and transverse bulk velocities of the stiffness c and density p
+        '''
+        vl = np.sqrt(c[0][0]/p) # parallel
+        vt = np.sqrt(c[3][3]/p) # transverse
+        return vl, vt
+
+    def maxVelocity(self):
+        '''
+        Fastest bulk velocity of the primary and secondary materials,
+        sets the time step and the damping of absorbing layers
+        '''
+        return max(max(self.velocities(m['c'], m['p'])) for m in (self.primary, self.secondary))
+
     ''' Set simulation timestep based on Courant–Friedrichs–Lewy condition '''
     def setTimeStep(self):
-        def calcDt(c, p):
-            c11 = c[0][0]
-            c44 = c[3][3]
-            vl = np.sqrt(c11/p) # parallel
-            vt = np.sqrt(c44/p) # transverse
-            vmax = max((vl, vt))
-            dxmin = min((np.amin(self.grid.fdx),np.amin(self.grid.fdy), np.amin(self.grid.fdz)))*self.grid.SI_conversion
-            dt = self.c_max*dxmin/vmax
-            return dt
-
-        dt1 = calcDt(self.primary['c'], self.primary['p'])
-        dt2 = calcDt(self.secondary['c'], self.secondary['p'])
-        self.dt = min((dt1, dt2))
+        dxmin = min((np.amin(self.grid.fdx),np.amin(self.grid.fdy), np.amin(self.grid.fdz)))*self.grid.SI_conversion
+        self.dt = self.c_max*dxmin/self.maxVelocity()
 
 
 if __name__ == '__main__':
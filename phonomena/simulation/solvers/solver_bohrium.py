@@ -23,18 +23,22 @@ class Solver(base_solver.BaseSolver):
         assert cfg['bh_stack'] in ['openmp', 'opencl', 'cuda']
         os.environ["BH_STACK"] = self.cfg['bh_stack']
 
-        grid.T1 = bohrium.array(grid.T1)
-        grid.T2 = bohrium.array(grid.T2)
-        grid.T3 = bohrium.array(grid.T3)
-        grid.T4 = bohrium.array(grid.T4)
-        grid.T5 = bohrium.array(grid.T5)
-        grid.T6 = bohrium.array(grid.T6)
-
-        grid.ux_new = bohrium.array(grid.ux_new)
-        grid.uy_new = bohrium.array(grid.uy_new)
-        grid.uz_new = bohrium.array(grid.uz_new)
-
-        material.C = bohrium.array(material.C)
-        material.P = bohrium.array(material.P)
-
+        # Convert after BaseSolver.init, which copies and rebuilds the grid arrays
         super().init(grid, material, steps)
+
+        self.g.T1_pad = bohrium.array(self.g.T1_pad)
+        self.g.T2_pad = bohrium.array(self.g.T2_pad)
+        self.g.T3_pad = bohrium.array(self.g.T3_pad)
+        self.g.T4_pad = bohrium.array(self.g.T4_pad)
+        self.g.T5_pad = bohrium.array(self.g.T5_pad)
+        self.g.T6_pad = bohrium.array(self.g.T6_pad)
+
+        # Whole ring is converted so rotated views stay on the bohrium stack
+        self.g.ux_ring = [bohrium.array(u) for u in self.g.ux_ring]
+        self.g.uy_ring = [bohrium.array(u) for u in self.g.uy_ring]
+        self.g.uz_ring = [bohrium.array(u) for u in self.g.uz_ring]
+
+        # Arrays read by the BaseSolver kernels
+        self.m.stiffness = {key: bohrium.array(c) for key, c in self.m.stiffness.items()}
+        self.coef.update({key: bohrium.array(c) for key, c in self.coef.items() if key != 'abc'})
+        self.scratch = {key: bohrium.array(s) for key, s in self.scratch.items()}
@@ -1,9 +1,19 @@
 from simulation import base_solver
 
+import numpy as np
+
 import logging
 logger = logging.getLogger(__name__)
 
-cfg = {}
+cfg = {
+    # only update the x planes reached by the wave, see step()
+    'active_region': False,
+    # displacement below this fraction of the peak source amplitude is treated as zero
+    'active_tolerance': 1e-9,
+}
+
+# x planes a disturbance can travel in one step, one for each of the stress and displacement updates
+RADIUS = 2
 
 class Solver(base_solver.BaseSolver):
 
@@ -26,6 +36,9 @@ class Solver(base_solver.BaseSolver):
         '''
         cfg = self.cfg
         super().init(grid, material, steps)
+        # planes from front on are still at rest
+        self.front = 0 if self.cfg['active_region'] else None
+        self.tolerance = self.cfg['active_tolerance']*np.abs(self.source()).max()
 
     def run(self, *args, **kwargs):
         '''
@@ -33,3 +46,37 @@ class Solver(base_solver.BaseSolver):
         Function inputs must mirror the default and forward all args amd kwargs
         '''
         super().run(*args, **kwargs)
+
+    def step(self):
+        '''
+        With active_region the stress and displacement are only updated up to RADIUS planes
+        past the wave front, the front advances once the displacement ahead of it exceeds
+        the tolerance. The whole grid is updated once the front gets close to the x max face.
+        '''
+        nx = self.g.x.size
+        if self.front is not None and self.front + RADIUS >= nx-1:
+            logger.debug("Wave front reached the x max face, updating the whole grid.")
+            self.front = None
+        if self.front is None:
+            super().step()
+            return
+
+        i1 = self.front + RADIUS
+        # views of the whole grid scratch buffers sized for the planes 0 .. i1-1, see scratchBuffers
+        scratch = {key: s[...,:s.shape[-3]-(nx-1-i1),:,:] for key, s in self.scratch.items()}
+        self.update_T(0, i1, scratch)
+        self.update_T_BC()
+        self.update_u(0, i1, scratch)
+        self.update_u_BC()
+        self.advanceFront(i1)
+        self.time_step()
+
+    def advanceFront(self, i1):
+        '''
+        Move the front past the last plane before i1 where the new displacement exceeds the tolerance
+        '''
+        g, front = self.g, self.front
+        for u in (g.ux_new, g.uy_new, g.uz_new):
+            above = np.nonzero(np.abs(u[front:i1]).max(axis=(1, 2)) > self.tolerance)[0]
+            if above.size:
+                self.front = max(self.front, front + above[-1] + 1)
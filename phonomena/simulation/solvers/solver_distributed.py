@@ -0,0 +1,520 @@
+import socket
+import struct
+import json
+import copy
+import time
+import weakref
+import multiprocessing as mp
+from pathlib import Path
+
+import h5py as h5
+import numpy as np
+
+if __name__ == '__main__':
+    import sys
+    file = Path(__file__).resolve()
+    sys.path.append(str(file.parents[2]))
+
+from simulation import base_solver, grid, material
+from simulation.base_solver import rows
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    # host:port of each rank, ordered along x
+    'ranks': ['localhost:6100', 'localhost:6101'],
+    # start the localhost ranks as child processes instead of connecting to running servers
+    'launch_local': True,
+}
+
+# Message types, each message is a HEADER followed by its payload
+CONTROL, PEER, SETUP, ADVANCE, FINISH, STOP, DONE, ERROR = range(8)
+HEADER = struct.Struct('!BQ')
+# ADVANCE payload: t0, n and record, followed by the n source values
+BLOCK = struct.Struct('!QQ?')
+
+# Seconds to wait for a rank server to accept connections
+CONNECT_TIMEOUT = 30
+
+# Interface of a rank server started without a host, see serve()
+LOOPBACK = '127.0.0.1'
+
+# SETUP payload: the size of the JSON header, followed by the header and the array data, see pack()
+HEADER_SIZE = struct.Struct('!Q')
+ARRAY = '__array__'
+
+def send(sock, command, payload=b''):
+    sock.sendall(HEADER.pack(command, len(payload)))
+    if payload:
+        sock.sendall(payload)
+
+def receive(sock):
+    '''
+    Read one message, returns (command, payload)
+    '''
+    command, size = HEADER.unpack(receiveExact(sock, HEADER.size))
+    return command, receiveExact(sock, size)
+
+def receiveExact(sock, size):
+    buffer = bytearray(size)
+    receiveInto(sock, memoryview(buffer))
+    return bytes(buffer)
+
+def receiveInto(sock, view):
+    '''
+    Fill a writable buffer from the socket, halo planes are received in place
+    '''
+    view = view.cast('B')
+    while view.nbytes:
+        n = sock.recv_into(view)
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        view = view[n:]
+
+def pack(message):
+    '''
+    Data only encoding of a SETUP message, the ranks never unpickle what they receive.
+    Numpy arrays and scalars are replaced by {ARRAY: [dtype, shape, offset]} in a JSON header
+    followed by their raw bytes, any other object that JSON cannot encode is refused.
+    '''
+    blobs, offset = [], 0
+    def encode(value):
+        nonlocal offset
+        if isinstance(value, (np.ndarray, np.generic)):
+            a = np.ascontiguousarray(value)
+            if a.dtype.hasobject:
+                raise Exception("Object arrays cannot be sent to the ranks")
+            blobs.append(a.tobytes())
+            offset += a.nbytes
+            return {ARRAY: [a.dtype.str, a.shape, offset - a.nbytes]}
+        if isinstance(value, dict):
+            return {key: encode(v) for key, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        return value
+    header = json.dumps(encode(message)).encode()
+    return b''.join([HEADER_SIZE.pack(len(header)), header] + blobs)
+
+def unpack(payload):
+    '''
+    Decode a SETUP payload of pack(), 0-d arrays are returned as numpy scalars
+    '''
+    size, = HEADER_SIZE.unpack_from(payload)
+    data = HEADER_SIZE.size + size
+    def decode(value):
+        if isinstance(value, dict) and ARRAY in value:
+            dtype, shape, offset = value[ARRAY]
+            dtype = np.dtype(dtype)
+            if dtype.hasobject:
+                raise Exception("Object arrays are not accepted")
+            a = np.frombuffer(payload, dtype=dtype, count=int(np.prod(shape)), offset=data+offset)
+            a = a.reshape(shape).copy()
+            return a[()] if a.ndim == 0 else a
+        if isinstance(value, dict):
+            return {key: decode(v) for key, v in value.items()}
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        return value
+    return decode(json.loads(payload[HEADER_SIZE.size:data]))
+
+def connect(address, timeout=CONNECT_TIMEOUT):
+    '''
+    Connect to host:port, retrying while the server is starting
+    '''
+    host, port = address.rsplit(':', 1)
+    t1 = time.time()
+    while True:
+        try:
+            sock = socket.create_connection((host, int(port)))
+            break
+        except ConnectionRefusedError:
+            if time.time()-t1 > timeout:
+                raise
+            time.sleep(0.1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def stop(links, local):
+    '''
+    Send STOP over the control connections, close them and wait for the local ranks, see Solver.shutdown()
+    '''
+    for sock in links:
+        try:
+            send(sock, STOP)
+        except OSError:
+            pass
+        sock.close()
+    for p in local:
+        p.join(timeout=5)
+
+def serve(port, host=LOOPBACK):
+    '''
+    Rank server, runs one Rank per control connection until STOP is received.
+    Only listens on the loopback interface unless the host of its address in cfg['ranks'] is given,
+    the connections are not authenticated, so the host should be on a trusted network.
+    Started with: python solver_distributed.py <port> [<host>]
+    '''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen()
+    logger.info("Rank server listening on {}:{}".format(host, port))
+    stop = False
+    while not stop:
+        sock, _ = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        command, _ = receive(sock)
+        if command != CONTROL:
+            sock.close()
+            continue
+        rank = Rank(listener)
+        try:
+            stop = rank.serve(sock)
+        except ConnectionError as e:
+            logger.warning("Control connection lost: {}".format(e))
+        rank.close()
+        sock.close()
+    listener.close()
+
+
+class Rank(base_solver.BaseSolver):
+    '''
+    One x slab of the grid, stored with a one plane halo on each side.
+    Runs the numpy kernels of BaseSolver on its slab and exchanges the halo planes
+    with the neighbouring ranks through direct sockets, two times per step.
+    '''
+
+    def __init__(self, listener):
+        super().__init__(logger)
+        self.listener = listener
+        self.left, self.right = None, None
+        self.hdf = None
+
+    def serve(self, sock):
+        '''
+        Handle the commands of the coordinator, returns True once STOP is received
+        '''
+        while True:
+            command, payload = receive(sock)
+            if command == STOP:
+                return True
+            try:
+                if command == SETUP:
+                    self.setup(unpack(payload))
+                elif command == ADVANCE:
+                    t0, n, record = BLOCK.unpack_from(payload)
+                    source = np.frombuffer(payload, dtype=self.precision(), count=n, offset=BLOCK.size)
+                    self.advance(source, t0, n, record)
+                elif command == FINISH:
+                    self.closeFile()
+            except Exception as e:
+                logger.error("Rank failed: {}".format(e))
+                self.closeLinks()
+                send(sock, ERROR, str(e).encode())
+                continue
+            send(sock, DONE)
+
+    def setup(self, message):
+        '''
+        Build the slab grid, material and coefficients and connect to the neighbouring ranks
+        '''
+        self.closeFile()
+        self.closeLinks()
+        self.cfg = message['cfg']
+        rank, slabs = message['rank'], message['slabs']
+        nx = message['x'].size
+        i0, i1 = slabs[rank]
+        lo, hi = max(i0-1, 0), min(i1+1, nx)
+        self.rank = rank
+        self.first, self.last = rank == 0, rank == len(slabs)-1
+        # slab planes in local indices, the first local plane is the left halo except on the first rank
+        self.slab = (i0-lo, i1-lo)
+
+        g = grid.Grid()
+        g.x, g.y, g.z = message['x'], message['y'], message['z']
+        g.SI_conversion = message['SI_conversion']
+        g.periodic_y, g.mirror = message['periodic_y'], message['mirror']
+        m = material.Material()
+        m.grid = g
+        m.compact = True
+        m.C, m.P = None, None
+        m.phase = message['phase']
+        m.phases = message['phases']
+        m.dt = message['dt']
+        m.setStiffness()
+        self.g, self.m = g, m
+        self.uniform, self.homogeneous = message['uniform'], message['homogeneous']
+
+        # The spacing coefficients are built from the whole mesh, as the surface terms read
+        # its first planes, then cut to the slab. dt**2/P is built from the slab phase map.
+        g.updateSpacing()
+        self.initCoefficients()
+        density = ('ux', 'uy', 'uz', 'rho')
+        self.coef = {key: value if key in density else rows(value, lo, None) for key, value in self.coef.items()}
+        self.coef['abc'] = message['abc']
+
+        g.x = message['x'][lo:hi]
+        g.update(dtype=self.stateType())
+        self.scratch = self.scratchBuffers(*self.slab)
+
+        # Connect to the left rank first, it is waiting in accept() for this rank
+        if not self.first:
+            self.left = connect(message['ranks'][rank-1])
+            send(self.left, PEER)
+        if not self.last:
+            self.right, _ = self.listener.accept()
+            self.right.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            command, _ = receive(self.right)
+            if command != PEER:
+                raise Exception("Expected a connection from rank {}".format(rank+1))
+
+        if message['file'] is not None:
+            self.openFile(message['file'], message['steps'])
+
+    def openFile(self, file, steps):
+        '''
+        Part file holding the displacement planes owned by this rank, see Solver.combine
+        '''
+        g, (i0, i1) = self.g, self.slab
+        self.own = {'ux': slice(i0, i1), 'uy': slice(i0, None if self.last else i1)}
+        self.own['uz'] = self.own['uy']
+        self.hdf = h5.File(file, mode='w')
+        self.datasets = {}
+        for key, x in self.own.items():
+            shape = getattr(g, key)[x].shape
+            self.datasets[key] = self.hdf.create_dataset(key, shape + (steps,), chunks=shape + (1,), dtype=self.stateType())
+        self.frames = None
+
+    def closeFile(self):
+        if self.hdf is not None:
+            self.hdf.close()
+            self.hdf = None
+
+    def closeLinks(self):
+        for sock in (self.left, self.right):
+            if sock is not None:
+                sock.close()
+        self.left, self.right = None, None
+
+    def close(self):
+        self.closeFile()
+        self.closeLinks()
+
+    def exchange(self, send_left, receive_left, send_right, receive_right):
+        '''
+        Swap halo planes with both neighbours. Links from an even rank to its right neighbour
+        are served first, the lower rank of each link sends first, so blocking sends cannot deadlock.
+        '''
+        links = [(self.left, send_left, receive_left, False), (self.right, send_right, receive_right, True)]
+        if self.rank % 2 == 0:
+            links.reverse()
+        for sock, out, into, lower in links:
+            if sock is None:
+                continue
+            if lower:
+                for plane in out:
+                    sock.sendall(plane)
+            for plane in into:
+                receiveInto(sock, memoryview(plane))
+            if not lower:
+                for plane in out:
+                    sock.sendall(plane)
+
+    def advance(self, source, t0, n, record):
+        g, (i0, i1) = self.g, self.slab
+        if record and self.frames is None:
+            self.frames = {key: np.zeros(getattr(g, key)[x].shape + (self.syncInterval(),), dtype=self.stateType())
+                for key, x in self.own.items()}
+        for s in range(n):
+            if self.first:
+                g.uz[0, :, 0] = source[s]
+            # padded planes are contiguous, they are sent and received in place
+            self.exchange([g.uy_pad[i0], g.uz_pad[i0]], [g.ux_pad[0]], [g.ux_pad[i1-1]], [g.uy_pad[i1], g.uz_pad[i1]])
+            self.update_T(i0, i1, self.scratch)
+            self.update_T_BC()
+            self.exchange([g.T1_pad[i0]], [g.T5_pad[0], g.T6_pad[0]], [g.T5_pad[i1-1], g.T6_pad[i1-1]], [g.T1_pad[i1]])
+            self.update_u(i0, i1, self.scratch)
+            self.apply_u_tfbc()
+            # the x face reads the last planes before their y and z faces are updated
+            if self.last:
+                self.apply_u_abc_x()
+            self.apply_u_abc_yz(i0, None if self.last else i1)
+            self.apply_u_ybc(i0, None if self.last else i1)
+            self.time_step()
+            if record:
+                for key, x in self.own.items():
+                    self.frames[key][..., s] = getattr(g, key)[x]
+        if record:
+            for key, frames in self.frames.items():
+                self.datasets[key][..., t0:t0+n] = frames[..., :n]
+
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Distributed solver, the grid is split along x across rank servers on one or several hosts.
+    Each rank only stores its slab, exchanges one plane halos of u and T with its neighbours
+    over a binary socket protocol every step and writes its planes to its own part file.
+    The output file combines the part files through HDF5 virtual datasets, so the part files
+    must be on a filesystem shared with this process. Connections and local ranks are kept between runs.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "distributed"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+        self.ranks = []
+        self.links = []
+        self.local = []
+        self.active = []
+        self.stop_ranks = None
+
+    def init(self, grid, material, steps):
+        '''
+        Only the mesh lines, spacing and phase map of the whole grid are built here,
+        the state and per cell coefficient arrays are built by the ranks for their slab.
+        '''
+        self.g = copy.deepcopy(grid)
+        self.m = copy.deepcopy(material)
+        self.t = copy.deepcopy(steps)
+
+        logger.info("Initializing {} with settings: {}".format(self.logger.name, self.cfg))
+
+        g, m = self.g, self.m
+        g.buildMesh()
+        g.updateSpacing()
+        m.compact = True
+        m.update(dtype=self.precision())
+        self.uniform, self.homogeneous = g.uniform(), m.homogeneous()
+        self.connect()
+
+        # every slab needs two planes, the absorbing boundary reads the two last planes
+        nx = g.x.size
+        num_ranks = min(len(self.links), max(1, (nx-1)//2))
+        if num_ranks < len(self.links):
+            logger.warning("Mesh too small for {} ranks, using {}".format(len(self.links), num_ranks))
+        slabs = [(int(p[0]), int(p[-1])+1) for p in np.array_split(np.arange(nx-1), num_ranks)]
+
+        parts = [None]*num_ranks
+        if self.cfg['write_mode'] != 'off':
+            parts = ['{}.part{}'.format(self.file, r) for r in range(num_ranks)]
+            self.combine(parts, slabs)
+
+        abc = self.absorbingCoefficients()
+        for r, (i0, i1) in enumerate(slabs):
+            lo, hi = max(i0-1, 0), min(i1+1, nx)
+            message = {
+                'rank': r,
+                'slabs': slabs,
+                'ranks': self.ranks[:num_ranks],
+                'cfg': self.cfg,
+                'x': g.x, 'y': g.y, 'z': g.z,
+                'SI_conversion': g.SI_conversion,
+                'periodic_y': g.periodic_y,
+                'mirror': g.mirror,
+                'phase': m.phase[lo:hi],
+                'phases': m.phases,
+                'dt': m.dt,
+                'abc': abc,
+                'uniform': self.uniform,
+                'homogeneous': self.homogeneous,
+                'file': parts[r],
+                'steps': self.t,
+            }
+            send(self.links[r], SETUP, pack(message))
+        self.active = self.links[:num_ranks]
+        self.wait(self.active)
+
+    def connect(self):
+        '''
+        Open the control connections, launching the local ranks if enabled
+        '''
+        ranks = list(self.cfg['ranks'])
+        if ranks == self.ranks:
+            return
+        self.shutdown()
+        # stops the ranks once the solver is garbage collected or at exit, see shutdown()
+        self.stop_ranks = weakref.finalize(self, stop, self.links, self.local)
+        if self.cfg['launch_local']:
+            # spawned as in the application, see common.configMultiprocessing
+            ctx = mp.get_context('spawn')
+            for address in ranks:
+                host, port = address.rsplit(':', 1)
+                if host in ('localhost', '127.0.0.1'):
+                    p = ctx.Process(target=serve, args=(int(port), host))
+                    p.daemon = True
+                    p.start()
+                    self.local.append(p)
+        for address in ranks:
+            sock = connect(address)
+            send(sock, CONTROL)
+            self.links.append(sock)
+        self.ranks = ranks
+
+    def wait(self, links):
+        '''
+        Wait for every rank to complete the last command
+        '''
+        errors = []
+        for r, sock in enumerate(links):
+            command, payload = receive(sock)
+            if command == ERROR:
+                errors.append("rank {}: {}".format(r, payload.decode()))
+        if errors:
+            raise Exception("Distributed solver failed, {}".format(", ".join(errors)))
+
+    def combine(self, parts, slabs):
+        '''
+        Output file in the format of Writer, the displacement datasets map the part files of the ranks
+        '''
+        g, m, t = self.g, self.m, self.t
+        x, y, z = g.x.size, g.y.size, g.z.size
+        dtype = self.stateType()
+        shapes = {'ux': (x-1,y,z), 'uy': (x,y-1,z), 'uz': (x,y,z-1)}
+        logger.info("Writing HDF to file {}".format(self.file))
+        with h5.File(self.file, mode='w') as hdf:
+            for key, shape in shapes.items():
+                layout = h5.VirtualLayout(shape=shape + (t,), dtype=dtype)
+                for r, (part, (i0, i1)) in enumerate(zip(parts, slabs)):
+                    # the last rank also owns the x max plane of uy and uz
+                    i1 = shape[0] if r == len(slabs)-1 else i1
+                    layout[i0:i1] = h5.VirtualSource(str(Path(part).resolve()), key, shape=(i1-i0,) + shape[1:] + (t,))
+                hdf.create_virtual_dataset(key, layout)
+            base_solver.Writer.writeMetadata(hdf, t, m, g, self.cfg, self.precision())
+
+    def advance(self, source, t0, n):
+        '''
+        Run n steps on every rank, the ranks record their frames into their part files
+        '''
+        block = BLOCK.pack(t0, n, self.cfg['write_mode'] != 'off')
+        payload = block + np.ascontiguousarray(source[t0:t0+n]).tobytes()
+        for sock in self.active:
+            send(sock, ADVANCE, payload)
+        self.wait(self.active)
+
+    def record(self, t0, n):
+        '''
+        The frames are written by the ranks, see advance()
+        '''
+        pass
+
+    def finish(self):
+        '''
+        Close the part files of the ranks
+        '''
+        for sock in self.active:
+            send(sock, FINISH)
+        self.wait(self.active)
+
+    def shutdown(self):
+        '''
+        Stop the ranks and close the connections
+        '''
+        if self.stop_ranks is not None:
+            self.stop_ranks()
+        self.ranks, self.links, self.local, self.active = [], [], [], []
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    serve(int(sys.argv[1]), *sys.argv[2:3])
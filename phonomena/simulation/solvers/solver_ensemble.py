@@ -0,0 +1,136 @@
+import copy
+from time import time
+import numpy as np
+
+from simulation import base_solver
+from simulation.grid import FrozenGrid
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    # settings overridden by each member, 'primary' and 'secondary' select its materials
+    'members': [{'wave_args': {'f': 100}}, {'wave_args': {'f': 200}}],
+}
+
+def stack(values, shape=None):
+    '''
+    Stack the per member values of a coefficient along a leading member axis,
+    values shared by every member are returned as they are.
+    Values are broadcast to a common shape of at least three axes, or to shape if given.
+    '''
+    first = values[0]
+    if all(np.shape(v) == np.shape(first) and np.array_equal(v, first) for v in values[1:]):
+        return first
+    if shape is None:
+        shape = np.broadcast_shapes((1, 1, 1), *(np.shape(v) for v in values))
+    return np.stack([np.broadcast_to(v, shape) for v in values])
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Advances several members on the same mesh in one run, the grid state arrays carry a leading
+    member axis and the numpy kernels of BaseSolver update every member in one pass.
+    The spacing coefficients are shared, stiffness, density, absorbing boundary and source are per member.
+    Members share the time step, the smallest stable step of their materials.
+    Each member is written to its own HDF file, see files.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "ensemble"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+        self.writers = []
+        self.files = []
+
+    def init(self, grid, material, steps):
+        self.g = copy.deepcopy(grid)
+        self.t = copy.deepcopy(steps)
+
+        logger.info("Initializing {} with settings: {}".format(self.logger.name, self.cfg))
+
+        common = {key: value for key, value in self.cfg.items() if key != 'members'}
+        self.members = [{**common, **member} for member in self.cfg['members']]
+        n = len(self.members)
+        dtype = self.precision()
+
+        self.g.buildMesh()
+        self.g.update(dtype=self.stateType(), batch=(n,))
+
+        self.materials = []
+        for member in self.members:
+            m = copy.deepcopy(material)
+            if 'primary' in member:
+                m.setPrimary(member['primary'])
+            if 'secondary' in member:
+                m.setSecondary(member['secondary'])
+            m.update(dtype=dtype)
+            self.materials.append(m)
+        dt = min(m.dt for m in self.materials)
+        for m in self.materials:
+            m.dt = dt
+
+        # Coefficients of each member, stacked along the member axis
+        self.uniform = self.g.uniform()
+        self.homogeneous = all(m.homogeneous() for m in self.materials)
+        coefs, stiffness = [], []
+        for m in self.materials:
+            if m.compact:
+                m.setStiffness()
+            self.m = m
+            self.initCoefficients()
+            coefs.append(self.coef)
+            stiffness.append(m.stiffness)
+        self.coef = {key: stack([c[key] for c in coefs]) for key in coefs[0] if key != 'abc'}
+        # the absorbing boundary constants multiply faces with the member axis first
+        self.coef['abc'] = {key: stack([c['abc'][key] for c in coefs], shape=(1, 1)) for key in coefs[0]['abc']}
+        self.m = copy.copy(self.materials[0])
+        self.m.stiffness = {key: stack([s[key] for s in stiffness]) for key in stiffness[0]}
+        self.initScratch()
+
+        for writer in self.writers:
+            if writer.is_alive():
+                writer.notify_finished()
+                writer.join(timeout=1)
+
+        self.frames = None
+        self.writers = []
+        # the first member is written to file, loaded by the analysis tab
+        self.files = [self.file] + ['{}.member{}'.format(self.file, i) for i in range(1, n)]
+        if self.cfg['write_mode'] != 'off':
+            self.frames = self.g.frameBuffer(self.syncInterval())
+            for member, m, file in zip(self.members, self.materials, self.files):
+                writer = base_solver.Writer(self.cfg['write_mode'])
+                writer.init(
+                    steps = self.t,
+                    file = file,
+                    grid = self.g,
+                    cfg = member,
+                    material = m
+                )
+                writer.start()
+                self.writers.append(writer)
+
+    def source(self):
+        '''
+        Wave of each member, shaped (steps, members, 1) to broadcast over the input face
+        '''
+        waves = np.stack([self.wave(member) for member in self.members], axis=1)
+        return np.ascontiguousarray(waves[:, :, None], dtype=self.precision())
+
+    def record(self, t0, n):
+        if self.cfg['write_mode'] != 'off':
+            frames = self.frames.head(n)
+            for i, writer in enumerate(self.writers):
+                member = FrozenGrid()
+                member.ux, member.uy, member.uz = frames.ux[i], frames.uy[i], frames.uz[i]
+                writer.put((member, slice(t0, t0+n)))
+
+    def finish(self):
+        if self.cfg['write_mode'] != 'off':
+            t1 = time()
+            for writer in self.writers:
+                writer.notify_finished()
+            for writer in self.writers:
+                writer.join(timeout=5*60)
+            logger.debug("Waited {:.4f}s for writers to end.".format(time()-t1))
@@ -0,0 +1,181 @@
+import copy
+import numpy as np
+
+from simulation import base_solver
+from simulation.base_solver import part, accumulate
+from simulation.grid import GHOST
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {}
+
+# The weights of the uniform fourth order stencil sum to 7/6 of the second order ones in magnitude,
+# the Courant number is scaled down by the same ratio to stay stable
+STABILITY = 6/7
+
+# Fourth order differences, see initStencils:
+# axis, 'fh' from full to half lines or 'hf' from half to full lines, first corrected entry, updated block
+STENCILS = {
+    'T_ux': (0, 'hf', 1, 'T'),
+    'T_uy': (1, 'hf', 1, 'T'),
+    'T_uz': (2, 'hf', 2, 'T'),
+    'T4_uy': (2, 'fh', 1, 'uy'),
+    'T4_uz': (1, 'fh', 1, 'uy'),
+    'T5_ux': (2, 'fh', 1, 'ux'),
+    'T5_uz': (0, 'fh', 1, 'ux'),
+    'T6_ux': (1, 'fh', 1, 'T6'),
+    'T6_uy': (0, 'fh', 1, 'T6'),
+    'ux_T1': (0, 'fh', 1, 'ux'),
+    'ux_T6': (1, 'hf', 1, 'ux'),
+    'ux_T5': (2, 'hf', 2, 'ux'),
+    'uy_T6': (0, 'hf', 1, 'uy'),
+    'uy_T2': (1, 'fh', 1, 'uy'),
+    'uy_T4': (2, 'hf', 2, 'uy'),
+    'uz_T5': (0, 'hf', 1, 'T'),
+    'uz_T4': (1, 'hf', 1, 'T'),
+    'uz_T3': (2, 'fh', 1, 'T'),
+}
+
+def lagrange(src, dst):
+    '''
+    Weights of the first derivative at dst of the cubic through the four points src (4, n)
+    '''
+    w = np.empty(src.shape)
+    for j in range(4):
+        others = [m for m in range(4) if m != j]
+        den = np.prod([src[j] - src[m] for m in others], axis=0)
+        num = sum(np.prod([dst - src[l] for l in others if l != m], axis=0) for m in others)
+        w[j] = num/den
+    return w
+
+def corrections(L):
+    '''
+    Correction weights of the fourth order staggered differences along an axis of lines L,
+    the fourth order weights less the second order (-1/d, 1/d) of the two inner points.
+    Returns the weights from the full lines to the half lines 1 .. N-3 (fh)
+    and from the half lines to the full lines 2 .. N-3 (hf), each (4, n)
+    '''
+    H = (L[1:] + L[:-1])/2
+    N = L.size
+
+    j = np.arange(1, N-2)
+    fh = lagrange(np.stack([L[j-1+k] for k in range(4)]), H[j])
+    r = 1/(L[j+1] - L[j])
+    fh[1] += r
+    fh[2] -= r
+
+    j = np.arange(2, N-2)
+    hf = lagrange(np.stack([H[j-2+k] for k in range(4)]), L[j])
+    r = 1/(H[j] - H[j-1])
+    hf[1] += r
+    hf[2] -= r
+    return fh, hf
+
+def stencil(e, taps, out, tmp):
+    '''
+    Evaluates out = e[0]*taps[0] + .. + e[3]*taps[3] in place, tmp is used as scratch space
+    '''
+    np.multiply(e[0], taps[0], out=out)
+    for k in (1, 2, 3):
+        out += np.multiply(e[k], taps[k], out=tmp)
+    return out
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Fourth order staggered differences in space. The second order kernels of BaseSolver run first,
+    then each difference is corrected to the four point stencil of the (non uniform) mesh where
+    both outer points exist. The surface plane, the planes next to the traction free and absorbing
+    boundaries and the boundary conditions keep the second order update.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "fourth"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+
+    def init(self, grid, material, steps):
+        material = copy.copy(material)
+        material.c_max = material.c_max*STABILITY
+        super().init(grid, material, steps)
+        if self.g.periodic_y or self.g.mirror is not None:
+            raise Exception("Fourth order stencils do not support periodic or mirrored grids.")
+        self.initStencils()
+
+    def initStencils(self):
+        '''
+        Correction weights of each difference of update_T and update_u, keyed as the coefficients of
+        BaseSolver.initCoefficients, with the region of the updated block they apply to.
+        Along the difference axis the region skips the first (or first two when the window starts at
+        the ghost plane) and the last entry, the z = 0 surface is skipped along x and y.
+        The density is folded into the weights of the displacement update of a homogeneous material.
+        '''
+        g, m = self.g, self.m
+        nx, ny, nz = g.x.size, g.y.size, g.z.size
+        blocks = {
+            'T': (nx-2, ny-2, nz-1),
+            'ux': (nx-1, ny-2, nz-1),
+            'uy': (nx-2, ny-1, nz-1),
+            'T6': (nx-1, ny-1, nz-1),
+        }
+        weights = [corrections(lines*g.SI_conversion) for lines in (g.x, g.y, g.z)]
+        rho = self.coef['rho'][m.phase.flat[0]]
+
+        self.stencils = {}
+        for key, (axis, kind, lo, block) in STENCILS.items():
+            shape = blocks[block]
+            fh, hf = weights[axis]
+            e = fh if kind == 'fh' else hf
+            if self.homogeneous and key[0] == 'u':
+                e = e*rho
+            e = e.reshape((4,) + tuple(-1 if i == axis else 1 for i in range(3)))
+            region = [slice(None), slice(None), slice(1, None)]
+            region[axis] = slice(lo, shape[axis]-1)
+            self.stencils[key] = (axis, lo-1, np.ascontiguousarray(e, dtype=self.precision()), tuple(region), shape)
+
+        dtype = self.precision()
+        self.scratch4 = {shape: (np.zeros(shape, dtype=dtype), np.zeros(shape, dtype=dtype)) for shape in blocks.values()}
+
+    def correction(self, a, key):
+        '''
+        Fourth order correction of the difference key of the window a, see initStencils.
+        Returns the region of the updated block, the correction over it and a free scratch buffer of the same shape
+        '''
+        axis, start, e, region, shape = self.stencils[key]
+        corr, tmp = (buffer[region] for buffer in self.scratch4[shape])
+        n = corr.shape[axis]
+        taps = [a[tuple(slice(start+k, start+k+n) if i == axis else s for i, s in enumerate(region))] for k in range(4)]
+        return region, stencil(e, taps, corr, tmp), tmp
+
+    def update_T(self):
+        super().update_T()
+        g, C = self.g, self.m.stiffness
+        uz = g.uz_pad[...,GHOST-1:] # starts at the ghost plane above the surface
+
+        for key, a, col in (('T_ux', g.ux[:,1:-1,:-1], 1), ('T_uy', g.uy[1:-1,:,:-1], 2), ('T_uz', uz[1:-1,1:-1,:], 3)):
+            region, corr, tmp = self.correction(a, key)
+            for T, row in ((g.T1, 1), (g.T2, 2), (g.T3, 3)):
+                accumulate(T[1:-1,1:-1,:-1][region], part(C['c{}{}'.format(row, col)], region), corr, tmp)
+
+        for T, c, terms in (
+                (g.T4[1:-1,:,:], C['c44'], (('T4_uy', g.uy[1:-1,:,:]), ('T4_uz', g.uz[1:-1,:,:]))),
+                (g.T5[:,1:-1,:], C['c55'], (('T5_ux', g.ux[:,1:-1,:]), ('T5_uz', g.uz[:,1:-1,:]))),
+                (g.T6[:,:,:-1], C['c66'], (('T6_ux', g.ux[:,:,:-1]), ('T6_uy', g.uy[:,:,:-1])))):
+            for key, a in terms:
+                region, corr, tmp = self.correction(a, key)
+                accumulate(T[region], part(c, region), corr, tmp)
+
+    def update_u(self):
+        super().update_u()
+        g, c = self.g, self.coef
+        # start at the ghost plane above the surface
+        T4, T5 = g.T4_pad[...,GHOST-1:], g.T5_pad[...,GHOST-1:]
+
+        for u, r, terms in (
+                (g.ux_new[:,1:-1,:-1], c.get('ux'), (('ux_T1', g.T1[:,1:-1,:-1]), ('ux_T6', g.T6[:,:,:-1]), ('ux_T5', T5[:,1:-1,:]))),
+                (g.uy_new[1:-1,:,:-1], c.get('uy'), (('uy_T6', g.T6[:,:,:-1]), ('uy_T2', g.T2[1:-1,:,:-1]), ('uy_T4', T4[1:-1,:,:]))),
+                (g.uz_new[1:-1,1:-1,:], c.get('uz'), (('uz_T5', g.T5[:,1:-1,:]), ('uz_T4', g.T4[1:-1,:,:]), ('uz_T3', g.T3[1:-1,1:-1,:])))):
+            for key, a in terms:
+                region, corr, tmp = self.correction(a, key)
+                accumulate(u[region], part(r, region), corr, tmp)
@@ -0,0 +1,217 @@
+from time import time
+import inspect
+import numpy as np
+import h5py as h5
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+from simulation import base_solver
+from gui.worker import WorkerSignals
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    # 'direct' sparse LU, or 'iterative' GMRES preconditioned by an incomplete LU
+    'method': 'direct',
+    # settings of the iterative method
+    'tol': 1e-8,
+    'maxiter': 1000,
+    'restart': 50,
+    'drop_tol': 1e-5,
+    'fill_factor': 10,
+}
+
+# Lines along each axis a displacement reaches in one step, including the boundary conditions
+# (the mirror image of a line two lines from the plane)
+RADIUS = 4
+# Displacements of the same probe are at least PERIOD lines apart, see assemble
+PERIOD = 2*RADIUS + 1
+
+KEYS = ('ux', 'uy', 'uz')
+
+# Relative tolerance keyword of gmres, SciPy < 1.12 names it tol
+GMRES_TOL = 'rtol' if 'rtol' in inspect.signature(spla.gmres).parameters else 'tol'
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Steady state response to the sin wave of frequency wave_args f, solved in the frequency domain.
+    The displacement is u = Im(U exp(i*w*n*dt)) at step n, U solves the time step of BaseSolver
+    (kernels and boundary conditions) with u_old = U/z and u_new = z*U, z = exp(i*w*dt),
+    so it is the steady state of a time domain run on the same mesh.
+    The system is assembled column by column from the kernels, probing displacements PERIOD lines
+    apart at once, and solved as a sparse complex system.
+    The output holds the steady state frames of every step as the time domain solvers,
+    and the complex amplitudes as ux_harmonic, uy_harmonic and uz_harmonic.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "harmonic"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+        self.U = None
+
+    def init(self, grid, material, steps):
+        if self.cfg['wave'] != 'sin':
+            logger.warning("The harmonic solver drives a sin wave of wave_args f, ignoring wave {}.".format(self.cfg['wave']))
+        super().init(grid, material, steps)
+        self.z = np.exp(1j*self.frequency()*self.m.dt)
+
+        shapes = [getattr(self.g, key).shape for key in KEYS]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        self.shapes, self.offsets = shapes, np.cumsum([0] + sizes)
+        # the source line uz[0, :, 0] is prescribed
+        uz = np.arange(sizes[2]).reshape(shapes[2])
+        self.drive = self.offsets[2] + uz[0, :, 0].ravel()
+
+    def initWriter(self):
+        # the file is written once solved, see write
+        self.frames = None
+
+    def stateType(self):
+        return np.result_type(self.precision(), np.complex64)
+
+    def frequency(self):
+        '''
+        Angular frequency of the drive
+        '''
+        return 2*np.pi*self.cfg['wave_args']['f']
+
+    def unpack(self, x):
+        '''
+        Displacements ux, uy and uz of the packed vector x
+        '''
+        return [x[a:b].reshape(shape) for a, b, shape in zip(self.offsets[:-1], self.offsets[1:], self.shapes)]
+
+    def apply(self, x):
+        '''
+        Row of the system of each displacement of the packed vector x,
+        the new displacement less z times x, and x itself on the source line
+        '''
+        g, z = self.g, self.z
+        for key, u in zip(KEYS, self.unpack(x)):
+            getattr(g, key)[...] = u
+            np.divide(u, z, out=getattr(g, key+'_old'))
+        self.update_T()
+        self.update_T_BC()
+        self.update_u()
+        self.update_u_BC()
+        y = np.concatenate([getattr(g, key+'_new').ravel() for key in KEYS])
+        y -= z*x
+        y[self.drive] = x[self.drive]
+        return y
+
+    def assemble(self, signals=None):
+        '''
+        Sparse matrix of apply. Each probe sets the displacements of one component whose indices
+        match modulo PERIOD, these are more than 2*RADIUS lines apart so each row they reach
+        belongs to a single one of them. An axis no longer than PERIOD (or the y axis of a periodic
+        grid, whose BC wraps around) is probed one line at a time.
+        '''
+        g = self.g
+        n = self.offsets[-1]
+        extent = np.max(self.shapes, axis=0)
+        period = [PERIOD if e > PERIOD else e for e in extent]
+        if g.periodic_y:
+            period[1] = extent[1]
+        # component and axis indices of every row
+        rows = [np.indices(shape).reshape(3, -1) for shape in self.shapes]
+        component = np.concatenate([np.full(int(np.prod(shape)), q) for q, shape in enumerate(self.shapes)])
+        index = np.concatenate(rows, axis=1)
+
+        probes = [(q, c) for q in range(3) for c in np.ndindex(*period)]
+        row, col, val = [], [], []
+        for p, (q, c) in enumerate(probes):
+            if not self.running.is_set():
+                return None
+            members = (component == q) & np.all(index % np.reshape(period, (3, 1)) == np.reshape(c, (3, 1)), axis=0)
+            if not members.any():
+                continue
+            x = np.zeros(n, dtype=self.stateType())
+            x[members] = 1
+            y = self.apply(x)
+            r = np.flatnonzero(y)
+            # column of the probe each row reads, the closest index congruent to c along each axis
+            j = np.empty((3, r.size), dtype=int)
+            for axis in range(3):
+                i = index[axis, r]
+                if period[axis] >= extent[axis]:
+                    j[axis] = c[axis]
+                else:
+                    j[axis] = i + (c[axis] - i + RADIUS) % period[axis] - RADIUS
+            shape = np.reshape(self.shapes[q], (3, 1))
+            valid = np.all((j >= 0) & (j < shape), axis=0)
+            row.append(r[valid])
+            col.append(self.offsets[q] + np.ravel_multi_index(j[:, valid], self.shapes[q]))
+            val.append(y[r[valid]])
+            if signals is not None:
+                signals.progress.emit(int(90*(p+1)/len(probes)))
+        return sp.csc_matrix((np.concatenate(val), (np.concatenate(row), np.concatenate(col))), shape=(n, n))
+
+    def solve(self, A):
+        '''
+        Packed complex amplitudes of the unit drive
+        '''
+        b = np.zeros(A.shape[0], dtype=A.dtype)
+        b[self.drive] = 1
+        if self.cfg['method'] == 'direct':
+            return spla.spsolve(A, b)
+
+        ilu = spla.spilu(A, drop_tol=self.cfg['drop_tol'], fill_factor=self.cfg['fill_factor'])
+        M = spla.LinearOperator(A.shape, ilu.solve, dtype=A.dtype)
+        tol = {GMRES_TOL: self.cfg['tol'], 'atol': 0}
+        x, info = spla.gmres(A, b, M=M, restart=self.cfg['restart'], maxiter=self.cfg['maxiter'], **tol)
+        if info < 0:
+            raise Exception("GMRES failed on the harmonic system ({}).".format(info))
+        if info > 0:
+            logger.warning("GMRES did not converge to {} in {} iterations.".format(self.cfg['tol'], info))
+        return x
+
+    def run(self, *args, **kwargs):
+        default = {'signals': WorkerSignals()}
+        kwargs = {**default, **kwargs}
+        signals = kwargs['signals']
+
+        self.running.set()
+        stime = time()
+        signals.progress.emit(0)
+        signals.status.emit("Assembling harmonic system.")
+        A = self.assemble(signals)
+        if A is None:
+            self.logger.warning("Simulation cancelled.")
+            return
+        logger.debug("Assembled {} unknowns, {} non zeros in {:.2f}s.".format(A.shape[0], A.nnz, time()-stime))
+
+        signals.status.emit("Solving harmonic system.")
+        x = self.solve(A)
+        self.U = dict(zip(KEYS, self.unpack(x)))
+        for key in KEYS:
+            getattr(self.g, key)[...] = self.U[key]
+        self.running.clear()
+        self.finish()
+
+        etime = time()-stime
+        signals.status.emit("Simulation finished in {:.2f}s.".format(etime))
+        signals.progress.emit(100)
+
+    def finish(self):
+        if self.cfg['write_mode'] != 'off':
+            self.write()
+
+    def write(self):
+        '''
+        HDF file of the time domain solvers, frames of the steady state at every step
+        '''
+        t, interval, dtype = self.t, self.syncInterval(), self.precision()
+        logger.info("Writing HDF to file {}".format(self.file))
+        with h5.File(self.file, mode='w') as hdf:
+            for key in KEYS:
+                U = self.U[key]
+                data = hdf.create_dataset(key, U.shape + (t,), chunks=U.shape + (1,) if all(U.shape) else None, dtype=dtype)
+                for t0 in range(0, t, interval):
+                    n = min(interval, t - t0)
+                    data[..., t0:t0+n] = np.imag(U[..., None]*self.z**np.arange(t0, t0+n))
+                hdf.create_dataset(key+'_harmonic', data=U)
+            base_solver.Writer.writeMetadata(hdf, t, self.m, self.g, self.cfg, dtype)
+            hdf.attrs["frequency"] = self.cfg['wave_args']['f']
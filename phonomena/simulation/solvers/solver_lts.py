@@ -0,0 +1,304 @@
+import copy
+import itertools
+import numpy as np
+
+from simulation import base_solver, grid
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    # regions step at most 2**max_level times the global time step
+    'max_level': 3,
+    # the global time step is used unless the regions save this fraction of the work, see saving()
+    'min_saving': 0.15,
+}
+
+# Halo planes and lines around each region, two cover the stress and displacement updates of one step
+HALO = 2
+# Narrower runs of planes or lines are merged into their finer neighbour
+MIN_WIDTH = 4
+# Cells updated in the time of the fixed cost of one step of a region, see saving()
+STEP_OVERHEAD = 3000
+
+def levels(fd, dmin, max_level):
+    '''
+    CFL level of the planes (or lines) 0 .. n-2 along one axis, from the smallest spacing next to each.
+    A plane of level l is stable with 2**l times the time step of spacing dmin.
+    A plane is at most one level above each of the MIN_WIDTH planes before and after it, so levels rise
+    in steps of one through runs of at least MIN_WIDTH planes. Shorter runs left by the spacing take the finer level.
+    '''
+    fd = np.ravel(fd)
+    d = np.copy(fd)
+    d[1:] = np.minimum(fd[1:], fd[:-1])
+    level = np.clip(np.floor(np.log2(d/dmin + 1e-9)), 0, max_level).astype(int)
+    while True:
+        for i in range(1, level.size):
+            level[i] = min(level[i], level[max(i-MIN_WIDTH, 0):i].min()+1)
+        for i in range(level.size-2, -1, -1):
+            level[i] = min(level[i], level[i+1:i+1+MIN_WIDTH].min()+1)
+        runs = runsOf(level)
+        short = [(a, b) for a, b in runs if b-a < MIN_WIDTH and len(runs) > 1]
+        if not short:
+            return level
+        a, b = short[0]
+        neighbours = [level[i] for i in (a-1, b) if 0 <= i < level.size]
+        level[a:b] = min(neighbours)
+
+def runsOf(level):
+    '''
+    (start, stop) of each run of equal values
+    '''
+    edges = [0] + [i for i in range(1, level.size) if level[i] != level[i-1]] + [level.size]
+    return list(zip(edges[:-1], edges[1:]))
+
+def merge(boxes):
+    '''
+    Join the boxes (x, y, level) of the same level sharing a whole face, x and y as (start, stop).
+    Every region adds a fixed cost to each of its steps, see STEP_OVERHEAD
+    '''
+    boxes = list(boxes)
+    while True:
+        for a, b in itertools.permutations(boxes, 2):
+            (xa, ya, la), (xb, yb, lb) = a, b
+            if la != lb:
+                continue
+            if xa == xb and ya[1] == yb[0]:
+                joined = (xa, (ya[0], yb[1]), la)
+            elif ya == yb and xa[1] == xb[0]:
+                joined = ((xa[0], xb[1]), ya, la)
+            else:
+                continue
+            boxes.remove(a)
+            boxes.remove(b)
+            boxes.append(joined)
+            break
+        else:
+            return boxes
+
+def box(a, x, y, shape):
+    '''
+    Coefficient a cut to the planes x = (start, stop) and lines y = (start, stop) of a grid of shape (nx, ny),
+    axes without an extent are kept
+    '''
+    if np.ndim(a) == 0:
+        return a
+    (x0, x1), (y0, y1), (nx, ny) = x, y, shape
+    if a.shape[0] > 1:
+        a = a[x0:a.shape[0]-(nx-x1)]
+    if a.shape[1] > 1:
+        a = a[:,y0:a.shape[1]-(ny-y1)]
+    return np.ascontiguousarray(a)
+
+def intersect(a, b):
+    '''
+    Intersection of two boxes given as ((x0, x1), (y0, y1)), None if empty
+    '''
+    out = tuple((max(p[0], q[0]), min(p[1], q[1])) for p, q in zip(a, b))
+    return out if all(p[0] < p[1] for p in out) else None
+
+
+class Region(base_solver.BaseSolver):
+    '''
+    Box of x planes and y lines stepped with its own time step,
+    stored with HALO planes and lines around it, filled from the neighbouring regions before each step
+    '''
+
+    def __init__(self, solver, x, y, ratio, coef):
+        super().__init__(logger)
+        self.cfg = solver.cfg
+        self.ratio = ratio
+        self.t = 0 # in global time steps
+
+        g = solver.g
+        nx, ny = g.x.size, g.y.size
+        (i0, i1), (j0, j1) = x, y
+        self.first = i0 == 0
+        # planes and lines held by the region, the owned box plus the halo
+        self.lo = (max(i0-HALO, 0), max(j0-HALO, 0))
+        self.hi = (min(i1+HALO, nx), min(j1+HALO, ny))
+        # the last plane and line are owned by the last region along each axis
+        xo = {key: (i0, i1 if i1 < nx-1 else n) for key, n in (('ux', nx-1), ('uy', nx), ('uz', nx))}
+        yo = {key: (j0, j1 if j1 < ny-1 else n) for key, n in (('ux', ny), ('uy', ny-1), ('uz', ny))}
+        self.own = {key: (xo[key], yo[key]) for key in ('ux', 'uy', 'uz')}
+        self.local = {
+            'ux': ((self.lo[0], self.hi[0]-1), (self.lo[1], self.hi[1])),
+            'uy': ((self.lo[0], self.hi[0]), (self.lo[1], self.hi[1]-1)),
+            'uz': ((self.lo[0], self.hi[0]), (self.lo[1], self.hi[1])),
+        }
+
+        self.g = grid.Grid()
+        self.g.x = g.x[self.lo[0]:self.hi[0]]
+        self.g.y = g.y[self.lo[1]:self.hi[1]]
+        self.g.z = g.z
+        self.g.SI_conversion = g.SI_conversion
+        self.g.update(dtype=self.precision())
+
+        cut = lambda a: box(a, (self.lo[0], self.hi[0]), (self.lo[1], self.hi[1]), (nx, ny))
+        self.m = copy.copy(solver.m)
+        self.m.stiffness = {key: cut(value) for key, value in solver.m.stiffness.items()}
+        self.coef = {key: cut(value) for key, value in coef.items() if key not in ('abc', 'rho')}
+        self.coef['abc'] = coef['abc']
+        self.initScratch()
+
+    def slices(self, bounds):
+        '''
+        Local slices of a box in grid indices
+        '''
+        return tuple(slice(a-lo, b-lo) for (a, b), lo in zip(bounds, self.lo))
+
+    def link(self, regions):
+        '''
+        List the parts of the halo owned by each other region
+        '''
+        self.halo = []
+        for other in regions:
+            if other is self:
+                continue
+            for key in ('ux', 'uy', 'uz'):
+                part = intersect(other.own[key], self.local[key])
+                if part is not None:
+                    self.halo.append((other, key, self.slices(part), other.slices(part)))
+
+    def weight(self, t):
+        '''
+        Weight of the current displacement when interpolating it to time t,
+        the old displacement is at self.t - self.ratio
+        '''
+        return (t - (self.t - self.ratio))/self.ratio
+
+    def interpolate(self, key, src, t, out):
+        '''
+        Displacement key at time t into out, linear between the old and current displacement
+        '''
+        u, u_old = getattr(self.g, key)[src], getattr(self.g, key+'_old')[src]
+        w = self.weight(t)
+        if w == 1:
+            out[...] = u
+        else:
+            np.multiply(u_old, 1-w, out=out)
+            out += w*u
+
+    def fill(self, t):
+        for other, key, dst, src in self.halo:
+            other.interpolate(key, src, t, getattr(self.g, key)[dst])
+
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Local time stepping. The x-y plane is split into boxes whose CFL level follows the local
+    spacing, a box of level l runs BaseSolver.step on its own subgrid every 2**l global steps
+    with 2**l times the time step. Coarser boxes are stepped first, finer boxes read them
+    through a halo interpolated linearly in time, see Region. Boxes of the same level are merged,
+    the global time step is kept when the regions would not save cfg['min_saving'] of the work.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "lts"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+        self.regions = None
+
+    def init(self, grid, material, steps):
+        super().init(grid, material, steps)
+        g, m = self.g, self.m
+        if g.periodic_y or g.mirror is not None:
+            # the boxes would need halos wrapping around the unit cell or the mirror plane
+            logger.info("Periodic or mirrored grid, using the global time step.")
+            self.regions = None
+            return
+
+        dmin = min(g.fdx.min(), g.fdy.min())
+        lx = levels(g.fdx, dmin, int(self.cfg['max_level']))
+        ly = levels(g.fdy, dmin, int(self.cfg['max_level']))
+        boxes = merge((x, y, min(lx[x[0]], ly[y[0]], self.stableLevel(x, y))) for x in runsOf(lx) for y in runsOf(ly))
+        if len(boxes) == 1 or all(level == 0 for x, y, level in boxes):
+            logger.info("Spacing allows a single time step level, using the global time step.")
+            self.regions = None
+            return
+        estimate = self.saving(boxes)
+        if estimate < self.cfg['min_saving']:
+            logger.info("Time step levels save an estimated {:.0%} of the work, using the global time step.".format(estimate))
+            self.regions = None
+            return
+
+        # Coefficients depending on the time step, built for each level from the whole mesh
+        dt, coef = m.dt, self.coef
+        coefs = {}
+        for level in sorted({level for x, y, level in boxes}):
+            m.dt = dt*2**level
+            self.initCoefficients()
+            coefs[level] = self.coef
+        m.dt, self.coef = dt, coef
+
+        self.regions = [Region(self, x, y, 2**level, coefs[level]) for x, y, level in boxes]
+        self.time = 0 # in global time steps, the regions are gathered at this time by finish()
+        for region in self.regions:
+            region.link(self.regions)
+        # coarse regions are stepped first, the finer ones interpolate them
+        self.regions.sort(key=lambda region: -region.ratio)
+        logger.info("Time step levels: {}".format(
+            {r: sum(region.ratio == r for region in self.regions) for r in sorted({region.ratio for region in self.regions})}))
+
+    def stableLevel(self, x, y):
+        '''
+        Highest level of the box of planes x = (start, stop) and lines y = (start, stop) whose 3D Courant number
+        v*dt*sqrt(1/dx**2 + 1/dy**2 + 1/dz**2) stays below the one of the finest cell at the global time step.
+        The z spacing is shared by every box and only enters through this bound
+        '''
+        g = self.g
+        dz = g.fdz.min()
+        K = lambda dx, dy: np.sqrt(1/dx**2 + 1/dy**2 + 1/dz**2)
+        fdx, fdy = np.ravel(g.fdx), np.ravel(g.fdy)
+        # spacings next to the planes and lines of the box, as in levels
+        ratio = K(fdx.min(), fdy.min())/K(fdx[max(x[0]-1, 0):x[1]].min(), fdy[max(y[0]-1, 0):y[1]].min())
+        return max(int(np.floor(np.log2(ratio + 1e-9))), 0)
+
+    def saving(self, boxes):
+        '''
+        Estimated fraction of the work of the global time step saved by stepping the boxes (x, y, level)
+        as regions, from the cells of each region including its halo and STEP_OVERHEAD cells per step
+        '''
+        g = self.g
+        nx, ny, nz = g.x.size, g.y.size, g.z.size
+        cells = lambda x, y: (min(x[1]+HALO, nx) - max(x[0]-HALO, 0))*(min(y[1]+HALO, ny) - max(y[0]-HALO, 0))*nz
+        work = sum((cells(x, y) + STEP_OVERHEAD)/2**level for x, y, level in boxes)
+        return 1 - work/(cells((0, nx), (0, ny)) + STEP_OVERHEAD)
+
+    def advance(self, source, t0, n):
+        if self.regions is None:
+            super().advance(source, t0, n)
+            return
+        for t in range(t0, t0+n):
+            for region in self.regions:
+                if t % region.ratio:
+                    continue
+                region.fill(t)
+                if region.first:
+                    region.g.uz[0, :, 0] = source[t]
+                region.step()
+                region.t += region.ratio
+            if self.frames is not None:
+                self.gather(t+1)
+                self.frames.ux[..., t-t0] = self.g.ux
+                self.frames.uy[..., t-t0] = self.g.uy
+                self.frames.uz[..., t-t0] = self.g.uz
+        self.time = t0+n
+
+    def finish(self):
+        '''
+        Without frames the whole grid is only gathered once the run ended
+        '''
+        if self.regions is not None and self.frames is None:
+            self.gather(self.time)
+        super().finish()
+
+    def gather(self, t):
+        '''
+        Displacement of every region at time t into the whole grid
+        '''
+        for region in self.regions:
+            for key, bounds in region.own.items():
+                out = getattr(self.g, key)[tuple(slice(a, b) for a, b in bounds)]
+                region.interpolate(key, region.slices(bounds), t, out)
@@ -1,45 +1,178 @@
 import numpy as np
-import ctypes
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 import sys
 import time
+import weakref
 
-from simulation import base_solver
+from simulation import base_solver, grid, material
 
 import logging
 logger = logging.getLogger(__name__)
 
-cfg = {}
-
-def matrix_memmap(matrix, dtype=ctypes.c_double):
-    return (mp.Array(dtype, matrix.reshape(matrix.size)), matrix.shape)
-
-def matrix_unmap(memmap, shape, dtype=np.float64):
-    m = np.frombuffer(memmap.get_obj(), dtype=dtype)
-    m.shape = shape
-    return m
-
-def value_memmap(value, dtype=ctypes.c_double):
-    return mp.Value(dtype, value)
-
-def value_unmap(memmap):
-    return memmap.value
-
-def worker(i, q, bundle):
-    print("worker {} started".format(i))
-    sys.stdout.flush()
-    for key, value in bundle.items():
-        if type(bundle[key]) == tuple:
-            bundle[key] = matrix_unmap(*bundle[key])
+cfg = {
+    'num_workers': mp.cpu_count(),
+    # seconds a worker may spend on one phase of a time step before the run is aborted
+    'timeout': 60,
+}
+
+# Commands read by the workers from Solver.control, see worker()
+SETUP, ADVANCE, STOP = range(3)
+
+# Seconds between two checks of the other processes while waiting for a command
+POLL = 0.1
+
+# Byte alignment of the arrays packed into a shared memory block
+ALIGN = 64
+
+def share(arrays):
+    '''
+    Copy a dict of arrays into a single new shared memory block
+    Returns the block, its layout {key: (offset, shape, dtype)} and the shared views
+    '''
+    layout, size = {}, 0
+    for key, a in arrays.items():
+        layout[key] = (size, a.shape, a.dtype.str)
+        size += -(-a.nbytes // ALIGN) * ALIGN
+    shm = shared_memory.SharedMemory(create=True, size=max(size, ALIGN))
+    shared = views(shm, layout)
+    for key, a in arrays.items():
+        shared[key][...] = a
+    return shm, layout, shared
+
+def views(shm, layout):
+    '''
+    Numpy views of the arrays of a shared memory block, see share()
+    '''
+    return {key: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        for key, (offset, shape, dtype) in layout.items()}
+
+def release(shm, unlink=False):
+    '''
+    Close a shared memory block, views still held elsewhere keep the mapping alive until released
+    '''
+    if shm is None:
+        return
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    if unlink:
+        shm.unlink()
+
+def stop(workers, control, go):
+    '''
+    Send STOP to the workers and wait for them to exit, see Solver.shutdown()
+    '''
+    control[0] = STOP
+    for g in go:
+        g.release()
+    for w in workers:
+        w.join(timeout=5)
+        if w.is_alive():
+            w.terminate()
 
-    while True:
-        fn = q.get()
-        fn(bundle)
-        q.task_done()
-    print("worker {} started".format(i))
-    sys.stdout.flush()
+def worker(index, control, go, done, step, setup):
+    '''
+    Persistent worker process, owns one x slab of the grid for the whole time step.
+    A command is read from control once go is released and acknowledged through done,
+    the phases of a step are separated by the step barrier shared by all workers.
+    The slabs only exchange their one plane halos through the shared grid arrays.
+    A failure, or a phase not reached by all workers within the timeout, breaks the step barrier.
+    '''
+    solver = base_solver.BaseSolver(logger)
+    shm, arrays, exitcode = None, None, 0
+    try:
+        while True:
+            # the Solver may have been killed while the worker is idle
+            while not go.acquire(timeout=POLL):
+                if not mp.parent_process().is_alive():
+                    raise Exception("Solver process exited")
+            command = control[0]
+            if command == STOP:
+                break
+
+            elif command == SETUP:
+                arrays = None
+                release(shm)
+                message = setup.get()
+                shm = shared_memory.SharedMemory(name=message['name'])
+                arrays = views(shm, message['layout'])
+                solver.cfg['precision'] = message['precision']
+                solver.cfg['bloch_phase'] = message['bloch_phase']
+                solver.g = slabGrid(message, arrays)
+                solver.m = material.Material()
+                solver.m.stiffness = {key[2:]: a for key, a in arrays.items() if key[:2] == 'C.'}
+                solver.coef = {key[5:]: a for key, a in arrays.items() if key[:5] == 'coef.'}
+                solver.coef['abc'] = message['abc']
+                i0, i1 = message['slabs'][index]
+                last = index == len(message['slabs'])-1
+                scratch = solver.scratchBuffers(i0, i1) if i1 > i0 else None
+                timeout = message['timeout']
+
+            elif command == ADVANCE:
+                n, record = control[1], control[2]
+                g, nx = solver.g, solver.g.x.size
+                for s in range(n):
+                    if i0 == 0:
+                        g.uz[0, :, 0] = arrays['source'][s]
+                    # the ghost planes of T4, T5 and uz are never written by the slab kernels
+                    if scratch is not None:
+                        solver.update_T(i0, i1, scratch)
+                        solver.apply_T_ybc(i0, nx if last else i1)
+                    step.wait(timeout)
+                    if scratch is not None:
+                        solver.update_u(i0, i1, scratch)
+                    step.wait(timeout)
+                    # the y and z faces of the last planes wait for the x face, see apply_u_abc_yz
+                    # the y images of a plane are written by the worker applying its absorbing BC
+                    faces = (min(i0, max(nx-3, 0)), nx) if last else (i0, min(i1, nx-3))
+                    if last:
+                        solver.apply_u_abc_x()
+                    solver.apply_u_abc_yz(*faces)
+                    if faces[0] < faces[1]:
+                        solver.apply_u_ybc(*faces)
+                    step.wait(timeout)
+
+                    g.rotate()
+                    if i0 == 0:
+                        g.uz_new[0, :, 0] = 0
+                    if record:
+                        x = slice(i0, nx if last else i1)
+                        arrays['fux'][x,...,s] = g.ux[x]
+                        arrays['fuy'][x,...,s] = g.uy[x]
+                        arrays['fuz'][x,...,s] = g.uz[x]
+            done.release()
+    except Exception as e:
+        logger.error("Worker {} failed: {}".format(index, e))
+        step.abort()
+        exitcode = 1
+    arrays = None
+    release(shm)
+    sys.exit(exitcode)
+
+def slabGrid(message, arrays):
+    '''
+    Grid whose state arrays are the shared views, only the kernels run on it
+    '''
+    g = grid.Grid()
+    g.x, g.y, g.z = message['x'], message['y'], message['z']
+    g.periodic_y, g.mirror = message['periodic_y'], message['mirror']
+    g.ring = 0
+    g.ux_ring = [arrays['ux{}'.format(i)] for i in range(3)]
+    g.uy_ring = [arrays['uy{}'.format(i)] for i in range(3)]
+    g.uz_ring = [arrays['uz{}'.format(i)] for i in range(3)]
+    for key in ('T1', 'T2', 'T3', 'T4', 'T5', 'T6'):
+        setattr(g, key+'_pad', arrays[key])
+    return g
 
 class Solver(base_solver.BaseSolver):
+    '''
+    Domain decomposition over persistent worker processes.
+    Grid, coefficient and frame arrays live in one multiprocessing.shared_memory block,
+    each worker updates its x slab for the whole step and the workers synchronise through barriers.
+    Nothing is pickled while stepping, the workers are reused between runs, see shutdown().
+    '''
 
     def __init__(self):
         super().__init__(logger)
@@ -47,162 +180,145 @@ class Solver(base_solver.BaseSolver):
         self.name = "multiprocess"
         self.description = "<p></p>"
         self.cfg = {**cfg, **self.cfg}
-
-    def init(self, *args, **kwargs):
-        super().init(*args, **kwargs)
-
-        self.worker_queue = mp.JoinableQueue()
         self.workers = []
-        self.bundle = self.pack()
-
-        num_workers = mp.cpu_count()
+        self.shm = None
+
+    def init(self, grid, material, steps):
+        self.startWorkers()
+        super().init(grid, material, steps)
+        self.share()
+
+    def initScratch(self):
+        '''
+        The workers allocate the scratch buffers of their slab
+        '''
+        self.scratch = {}
+
+    def startWorkers(self):
+        num_workers = max(1, int(self.cfg['num_workers']))
+        if len(self.workers) == num_workers:
+            return
+        self.shutdown()
+
+        # the workers share the tracker of this process, which the Solver unlinks the blocks from
+        resource_tracker.ensure_running()
+        # spawned as in the application (see common.configMultiprocessing), forking after numba
+        # started its thread pool or the writer opened the output file is not safe
+        ctx = mp.get_context('spawn')
+        self.control = ctx.Array('q', 3, lock=False)
+        self.go = [ctx.Semaphore(0) for i in range(num_workers)]
+        self.done = ctx.Semaphore(0)
+        self.step_barrier = ctx.Barrier(num_workers)
+        self.setup = ctx.Queue()
+        # stops the workers once the solver is garbage collected or at exit, see shutdown()
+        self.stop_workers = weakref.finalize(self, stop, self.workers, self.control, self.go)
         for i in range(num_workers):
-            self.workers.append(
-                mp.Process(target=worker,
-                        args=(i,
-                              self.worker_queue,
-                              self.bundle)))
-            self.workers[i].daemon = True
-            self.workers[i].start()
-
-    def run(self, *args, **kwargs):
-        super().run(*args, **kwargs)
+            p = ctx.Process(target=worker, args=(i, self.control, self.go[i], self.done, self.step_barrier, self.setup))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+
+    def command(self, *args):
+        '''
+        Run a command on every worker and wait for it to complete.
+        The workers are stopped if one of them exited or did not answer in time, see abort().
+        The barriers are never waited on here, a killed process can leave them locked
+        '''
+        self.control[:len(args)] = args
+        for go in self.go:
+            go.release()
+        # one ADVANCE runs three phases per step
+        deadline = time.time() + self.cfg['timeout']*(3*args[1] if args[0] == ADVANCE else 1)
+        for _ in self.workers:
+            while not self.done.acquire(timeout=POLL):
+                if not all(w.is_alive() for w in self.workers) or time.time() > deadline:
+                    self.abort()
+
+    def abort(self):
+        '''
+        Stop all worker processes and free the shared memory block after a failed command
+        '''
+        exited = ["worker {} exited with code {}".format(i, w.exitcode) for i, w in enumerate(self.workers) if not w.is_alive()]
+        self.stop_workers.detach()
         for w in self.workers:
             w.terminate()
-
-    def pack(self):
-        b = dict()
-        # Shared memory
-        b['T1'] = matrix_memmap(self.g.T1)
-        b['T2'] = matrix_memmap(self.g.T2)
-        b['T3'] = matrix_memmap(self.g.T3)
-        b['T4'] = matrix_memmap(self.g.T4)
-        b['T5'] = matrix_memmap(self.g.T5)
-        b['T6'] = matrix_memmap(self.g.T6)
-
-        b['ux'] = matrix_memmap(self.g.ux)
-        b['uy'] = matrix_memmap(self.g.uy)
-        b['uz'] = matrix_memmap(self.g.uz)
-
-        # Read only
-        b['sdx'] = self.g.sdx
-        b['sdy'] = self.g.sdy
-        b['sdz'] = self.g.sdz
-        b['fdx'] = self.g.fdx
-        b['fdy'] = self.g.fdy
-        b['fdz'] = self.g.fdz
-        b['C'] = self.m.C
-        return b
-
-    def unpack(self):
-        self.g.T1 = matrix_unmap(*self.bundle['T1'])
-        self.g.T2 = matrix_unmap(*self.bundle['T2'])
-        self.g.T3 = matrix_unmap(*self.bundle['T3'])
-        self.g.T4 = matrix_unmap(*self.bundle['T4'])
-        self.g.T5 = matrix_unmap(*self.bundle['T5'])
-        self.g.T6 = matrix_unmap(*self.bundle['T6'])
-
-        self.g.ux = matrix_unmap(*self.bundle['ux'])
-        self.g.uy = matrix_unmap(*self.bundle['uy'])
-        self.g.uz = matrix_unmap(*self.bundle['uz'])
-
-    def update_T(self):
-        self.worker_queue.put(update_T1)
-        self.worker_queue.put(update_T2)
-        self.worker_queue.put(update_T3)
-        self.worker_queue.put(update_T4)
-        self.worker_queue.put(update_T5)
-        self.worker_queue.put(update_T6)
-        self.worker_queue.join()
-        self.unpack()
-
-    def update_T_tfbc(self):
-        self.worker_queue.put(update_T1_tfbc)
-        self.worker_queue.put(update_T2_tfbc)
-        self.worker_queue.put(update_T4_tfbc)
-        self.worker_queue.put(update_T5_tfbc)
-        self.worker_queue.put(update_T6_tfbc)
-        self.g.T3[1:-1,1:-1,0] = 0
-        self.worker_queue.join()
-        self.unpack()
-
-def update_T1(b):
-    b['T1'][1:-1,1:-1,1:-1] = \
-      b['C'][1:-1,1:-1,1:-1,0,0]*(b['ux'][1:,1:-1,1:-1] - b['ux'][:-1,1:-1,1:-1]) \
-    / b['sdx'] \
-    + b['C'][1:-1,1:-1,1:-1,0,1]*(b['uy'][1:-1,1:,1:-1] - b['uy'][1:-1,:-1,1:-1]) \
-    / b['sdy'] \
-    + b['C'][1:-1,1:-1,1:-1,0,2]*(b['uz'][1:-1,1:-1,1:] - b['uz'][1:-1,1:-1,:-1]) \
-    / b['sdz']
-
-def update_T2(b):
-    b['T1'][1:-1,1:-1,1:-1] = \
-      b['C'][1:-1,1:-1,1:-1,1,0]*(b['ux'][1:,1:-1,1:-1] - b['ux'][:-1,1:-1,1:-1]) \
-    / b['sdx'] \
-    + b['C'][1:-1,1:-1,1:-1,1,1]*(b['uy'][1:-1,1:,1:-1] - b['uy'][1:-1,:-1,1:-1]) \
-    / b['sdy'] \
-    + b['C'][1:-1,1:-1,1:-1,1,2]*(b['uz'][1:-1,1:-1,1:] - b['uz'][1:-1,1:-1,:-1]) \
-    / b['sdz']
-
-def update_T3(b):
-    b['T3'][1:-1,1:-1,1:-1] = \
-        b['C'][1:-1,1:-1,1:-1,2,0]*(b['ux'][1:,1:-1,1:-1] - b['ux'][:-1,1:-1,1:-1]) \
-        / b['sdx'] \
-        + b['C'][1:-1,1:-1,1:-1,2,1]*(b['uy'][1:-1,1:,1:-1] - b['uy'][1:-1,:-1,1:-1]) \
-        / b['sdy'] \
-        + b['C'][1:-1,1:-1,1:-1,2,2]*(b['uz'][1:-1,1:-1,1:] - b['uz'][1:-1,1:-1,:-1]) \
-        / b['sdz']
-
-def update_T4(b):
-    b['T4'][1:-1,:,:] = b['C'][1:-1,1:,1:,3,3]*( \
-        (b['uy'][1:-1,:,1:] - b['uy'][1:-1,:,:-1]) \
-        / b['fdz'] \
-        + (b['uz'][1:-1,1:,:] - b['uz'][1:-1,:-1,:]) \
-        / b['fdy']
-    )
-
-def update_T5(b):
-    b['T5'][:,1:-1,:] = b['C'][1:,1:-1,1:,4,4]*( \
-        (b['ux'][:,1:-1,1:] - b['ux'][:,1:-1,:-1]) \
-        / b['fdz'] \
-        + (b['uz'][1:,1:-1,:] - b['uz'][:-1,1:-1,:])
-        / b['fdx']
-    )
-
-def update_T6(b):
-    b['T6'][:,:,1:-1] = b['C'][1:,1:,1:-1,5,5]*( \
-        (b['ux'][:,1:,1:-1] - b['ux'][:,:-1,1:-1]) \
-        / b['fdy'] \
-        + (b['uy'][1:,:,1:-1] - b['uy'][:-1,:,1:-1]) \
-        / b['fdx']
-    )
-
-def update_T1_tfbc(b):
-    b['T1'][1:-1,1:-1,0] = \
-        b['C'][1:-1,1:-1,0,0,0]*(b['ux'][1:,1:-1,0] - b['ux'][:-1,1:-1,0]) / b['sdx'][0,:,:] \
-        + b['C'][1:-1,1:-1,0,0,1]*(b['uy'][1:-1,1:,0] - b['uy'][1:-1,:-1,0]) / b['sdy'][:,0,:] \
-        + b['C'][1:-1,1:-1,0,0,2]*(b['uz'][1:-1,1:-1,0] - 0) / b['sdz'][:,:,0]
-
-def update_T2_tfbc(b):
-    b['T2'][1:-1,1:-1,0] = \
-        b['C'][1:-1,1:-1,0,1,0]*(b['ux'][1:,1:-1,0] - b['ux'][:-1,1:-1,0]) / b['sdx'][0,:,:] \
-        + b['C'][1:-1,1:-1,0,1,1]*(b['uy'][1:-1,1:,0] - b['uy'][1:-1,:-1,0]) / b['sdy'][:,0,:] \
-        + b['C'][1:-1,1:-1,0,1,2]*(b['uz'][1:-1,1:-1,0] - 0) / b['sdz'][:,:,0]
-
-def update_T4_tfbc(b):
-    b['T4'][1:-1,:,0] = \
-        b['C'][1:-1,1:,0,3,3] \
-        * ((b['uy'][1:-1,:,1] - b['uy'][1:-1,:,0]) / b['fdy'][:,0,:] \
-        + (b['uz'][1:-1,1:,0] - b['uz'][1:-1,:-1,0]) / b['fdz'][:,:,0])
-
-def update_T5_tfbc(b):
-    b['T5'][:,1:-1,0] = \
-        b['C'][1:,1:-1,0,4,4] \
-        * ((b['ux'][:,1:-1,1] - b['ux'][:,1:-1,0]) / b['fdx'][0,:,:] \
-        + (b['uz'][1:,1:-1,0] - b['uz'][:-1,1:-1,0]) / b['fdz'][:,:,0])
-
-def update_T6_tfbc(b):
-    b['T6'][:,:,0] = \
-        b['C'][1:,1:,0,5,5] \
-        * ((b['ux'][:,1:,0] - b['ux'][:,:-1,0]) / b['fdx'][0,:,:] \
-        + (b['uy'][1:,:,0] - b['uy'][:-1,:,0]) / b['fdz'][:,:,0])
+            w.join(timeout=5)
+        self.workers = []
+        self.releaseShared()
+        raise Exception("Multiprocess run aborted: {}".format(", ".join(exited) if exited else
+            "the workers did not answer within {} s per phase".format(self.cfg['timeout'])))
+
+    def share(self):
+        '''
+        Move the grid, coefficient and frame arrays into a new shared memory block
+        and hand its layout to the workers
+        '''
+        g, m = self.g, self.m
+        arrays = {}
+        for key in ('ux', 'uy', 'uz'):
+            arrays.update({'{}{}'.format(key, i): u for i, u in enumerate(getattr(g, key+'_ring'))})
+        arrays.update({key: getattr(g, key+'_pad') for key in ('T1', 'T2', 'T3', 'T4', 'T5', 'T6')})
+        arrays.update({'C.'+key: c for key, c in m.stiffness.items()})
+        arrays.update({'coef.'+key: np.asarray(c) for key, c in self.coef.items() if key != 'abc'})
+        arrays['source'] = np.zeros(self.syncInterval(), dtype=self.precision())
+        if self.frames is not None:
+            arrays.update({'f'+key: getattr(self.frames, key) for key in ('ux', 'uy', 'uz')})
+
+        shm, layout, shared = share(arrays)
+        self.releaseShared()
+        self.shm = shm
+        self.free_shm = weakref.finalize(self, release, shm, True)
+
+        # Rebind the arrays of the solver to the shared views
+        g.ux_ring, g.uy_ring, g.uz_ring = ([shared['{}{}'.format(key, i)] for i in range(3)] for key in ('ux', 'uy', 'uz'))
+        for key in ('T1', 'T2', 'T3', 'T4', 'T5', 'T6'):
+            setattr(g, key+'_pad', shared[key])
+        m.stiffness = {key[2:]: a for key, a in shared.items() if key[:2] == 'C.'}
+        self.coef.update({key[5:]: a for key, a in shared.items() if key[:5] == 'coef.'})
+        self.source_buffer = shared['source']
+        if self.frames is not None:
+            self.frames.ux, self.frames.uy, self.frames.uz = shared['fux'], shared['fuy'], shared['fuz']
+
+        # empty slabs are placed past the last plane, see worker()
+        nx = g.x.size
+        planes = np.array_split(np.arange(nx-1), len(self.workers))
+        message = {
+            'name': shm.name,
+            'layout': layout,
+            'precision': self.cfg['precision'],
+            'bloch_phase': self.cfg['bloch_phase'],
+            'periodic_y': g.periodic_y,
+            'mirror': g.mirror,
+            'x': g.x, 'y': g.y, 'z': g.z,
+            'abc': self.coef['abc'],
+            'timeout': self.cfg['timeout'],
+            'slabs': [(int(p[0]), int(p[-1])+1) if p.size else (nx-1, nx-1) for p in planes],
+        }
+        for w in self.workers:
+            self.setup.put(message)
+        self.command(SETUP)
+
+    def advance(self, source, t0, n):
+        '''
+        Run n steps on the workers, the source values of the block are passed through shared memory
+        '''
+        self.source_buffer[:n] = source[t0:t0+n]
+        self.command(ADVANCE, n, self.frames is not None)
+        self.g.rotate(n)
+
+    def shutdown(self):
+        '''
+        Stop the worker processes and free the shared memory block
+        '''
+        if self.workers:
+            self.stop_workers()
+            self.workers = []
+        self.releaseShared()
+
+    def releaseShared(self):
+        '''
+        Free the shared memory block, a new one is allocated by the next init()
+        '''
+        if self.shm is not None:
+            self.free_shm()
+            self.shm = None
@@ -1,6 +1,8 @@
-from numba import njit
+import numpy as np
+from numba import njit, prange
 
 from simulation import base_solver
+from simulation.grid import GHOST
 
 import logging
 logger = logging.getLogger(__name__)
@@ -8,10 +10,17 @@ logger = logging.getLogger(__name__)
 cfg = {
     "numba":{
         "cache": True,
-        "fastmath": True
-    }
+        "fastmath": True,
+        "parallel": True
+    },
+    "fused": True,
+    "tile_size": [1, 0],
+    "sync_interval": 10
 }
 
+# Order of the Material.stiffness arrays passed to the compiled kernels
+STIFFNESS = ('c11', 'c12', 'c13', 'c21', 'c22', 'c23', 'c31', 'c32', 'c33', 'c44', 'c55', 'c66')
+
 class Solver(base_solver.BaseSolver):
 
     def __init__(self):
@@ -33,14 +42,95 @@ class Solver(base_solver.BaseSolver):
     def recompile(self):
         update_T.recompile()
         update_T_tfbc.recompile()
+        stress.recompile()
+        displacement.recompile()
+        absorb_x.recompile()
+        absorb_yz.recompile()
+        fused_step.recompile()
+        advance.recompile()
+
+    def stiffness(self):
+        '''
+        Material.stiffness arrays as tuples, interior followed by z = 0 surface
+        c44 and c55 keep their surface plane, it is overwritten by update_T_tfbc
+        '''
+        st = self.m.stiffness
+        c = tuple(st[key] if key in ('c44', 'c55') else st[key][:,:,1:] for key in STIFFNESS)
+        c_s = tuple(st[key][:,:,0] for key in STIFFNESS if key[1] != '3')
+        return c, c_s
+
+    def kernelArgs(self):
+        '''
+        Arguments of the fused kernels, grid arrays are passed with their ghost layer
+        so that the compiled loops run over contiguous memory
+        '''
+        g = self.g
+        u = (g.ux_pad, g.uy_pad, g.uz_pad)
+        u_old = (g.ux_old_pad, g.uy_old_pad, g.uz_old_pad)
+        u_new = (g.ux_new_pad, g.uy_new_pad, g.uz_new_pad)
+        T = (g.T1_pad, g.T2_pad, g.T3_pad, g.T4_pad, g.T5_pad, g.T6_pad)
+        c = self.coef
+        rsd = (c['rsdx'].ravel(), c['rsdy'].ravel(), c['rsdz'].ravel())
+        rfd = (c['rfdx'].ravel(), c['rfdy'].ravel(), c['rfdz'].ravel())
+        abc = tuple(c['abc'][key] for key in ('clx', 'ctx', 'cly0', 'cty0', 'cly1', 'cty1', 'clz', 'ctz'))
+        return self.m.phase, self.m.phases['c'], c['rho'], abc, u, u_old, u_new, T, rsd, rfd, self.blocks
+
+    def tiles(self):
+        '''
+        Bounds (i0, i1, j0, j1) of the x/y blocks traversed by the fused kernel.
+        tile_size sets the block extent in x and y, 0 spans the whole axis.
+        Small blocks keep the planes around a cell in cache on large meshes.
+        '''
+        nx, ny = self.g.x.size-1, self.g.y.size-1
+        tx, ty = (n if t <= 0 else int(t) for t, n in zip(self.cfg['tile_size'], (nx, ny)))
+        blocks = [(i, min(i+tx, nx), j, min(j+ty, ny)) for i in range(0, nx, tx) for j in range(0, ny, ty)]
+        return np.array(blocks, dtype=np.int64)
+
+    def init(self, *args, **kwargs):
+        super().init(*args, **kwargs)
+        self.blocks = self.tiles()
+
+    def phaseKernels(self):
+        # the fused kernels absorb on every face, periodic and mirrored grids run the per phase updates
+        return self.cfg['fused'] and not self.g.periodic_y and self.g.mirror is None
+
+    def step(self):
+        '''
+        Run the whole time step as a single compiled kernel when "fused" is set,
+        otherwise fall back to the per phase updates of BaseSolver
+        '''
+        if not self.phaseKernels():
+            super().step()
+            return
+
+        fused_step(*self.kernelArgs())
+        self.time_step()
+
+    def advance(self, source, t0, n):
+        '''
+        Run a block of n steps inside compiled code, only returning to python
+        for the writer, progress and cancellation between blocks
+        '''
+        if not self.phaseKernels():
+            super().advance(source, t0, n)
+            return
+
+        if self.frames is not None:
+            frames = (self.frames.ux, self.frames.uy, self.frames.uz)
+        else:
+            # Placeholder buffers of the grid precision, nothing is recorded
+            frames = (np.zeros((0,0,0,0), dtype=self.g.ux.dtype),)*3
+        advance(*self.kernelArgs(), source, t0, n, frames, self.frames is not None)
+        self.g.rotate(n)
 
     def update_T(self):
 
         u = (self.g.ux, self.g.uy, self.g.uz)
-        sd = (self.g.sdx, self.g.sdy, self.g.sdz)
-        fd = (self.g.fdx, self.g.fdy, self.g.fdz)
+        c = self.coef
+        rsd = (c['rsdx'], c['rsdy'], c['rsdz'])
+        rfd = (c['rfdx'], c['rfdy'], c['rfdz'])
 
-        T1, T2, T3, T4, T5, T6 = update_T(self.m.C, u, sd, fd)
+        T1, T2, T3, T4, T5, T6 = update_T(*self.stiffness(), u, rsd, rfd)
         self.g.T1[1:-1,1:-1,1:-1] = T1
         self.g.T2[1:-1,1:-1,1:-1] = T2
         self.g.T3[1:-1,1:-1,1:-1] = T3
@@ -48,13 +138,22 @@ class Solver(base_solver.BaseSolver):
         self.g.T5[:,1:-1,:] = T5
         self.g.T6[:,:,1:-1] = T6
 
+    def update_T_BC(self):
+        '''
+        The surface plane of apply_T_tfbc spans every y line, it is computed before
+        apply_T_ybc so that the periodic or mirror images of the surface are not overwritten
+        '''
+        self.apply_T_tfbc()
+        self.apply_T_ybc()
+
     def apply_T_tfbc(self):
 
         u = (self.g.ux, self.g.uy, self.g.uz)
-        sd = (self.g.sdx, self.g.sdy, self.g.sdz)
-        fd = (self.g.fdx, self.g.fdy, self.g.fdz)
+        c = self.coef
+        rsd = (c['rsdx'], c['rsdy'], c['rsdz'])
+        rfd = (c['rfdx'], c['rfdy'], c['rfdz'])
 
-        T1, T2, T3, T4, T5, T6 = update_T_tfbc(self.m.C, u, sd, fd)
+        T1, T2, T3, T4, T5, T6 = update_T_tfbc(*self.stiffness(), u, rsd, rfd)
 
         self.g.T1[1:-1,1:-1,0] = T1
         self.g.T2[1:-1,1:-1,0] = T2
@@ -62,85 +161,277 @@ class Solver(base_solver.BaseSolver):
         self.g.T4[1:-1,:,0] = T4
         self.g.T5[:,1:-1,0] = T5
         self.g.T6[:,:,0] = T6
+        super().apply_T_tfbc()
 
 
 @njit(cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
-def update_T(C, u, sd, fd):
+def update_T(c, c_s, u, rsd, rfd):
+    c11, c12, c13, c21, c22, c23, c31, c32, c33, c44, c55, c66 = c
     ux, uy, uz = u
-    sdx, sdy, sdz = sd
-    fdx, fdy, fdz = fd
+    rsdx, rsdy, rsdz = rsd
+    rfdx, rfdy, rfdz = rfd
 
     T1 = \
-      C[1:-1,1:-1,1:-1,0,0]*(ux[1:,1:-1,1:-1] - ux[:-1,1:-1,1:-1]) \
-    / sdx \
-    + C[1:-1,1:-1,1:-1,0,1]*(uy[1:-1,1:,1:-1] - uy[1:-1,:-1,1:-1]) \
-    / sdy \
-    + C[1:-1,1:-1,1:-1,0,2]*(uz[1:-1,1:-1,1:] - uz[1:-1,1:-1,:-1]) \
-    / sdz
+      c11*(ux[1:,1:-1,1:-1] - ux[:-1,1:-1,1:-1]) \
+    * rsdx \
+    + c12*(uy[1:-1,1:,1:-1] - uy[1:-1,:-1,1:-1]) \
+    * rsdy \
+    + c13*(uz[1:-1,1:-1,1:] - uz[1:-1,1:-1,:-1]) \
+    * rsdz
 
     T2 = \
-      C[1:-1,1:-1,1:-1,1,0]*(ux[1:,1:-1,1:-1] - ux[:-1,1:-1,1:-1]) \
-    / sdx \
-    + C[1:-1,1:-1,1:-1,1,1]*(uy[1:-1,1:,1:-1] - uy[1:-1,:-1,1:-1]) \
-    / sdy \
-    + C[1:-1,1:-1,1:-1,1,2]*(uz[1:-1,1:-1,1:] - uz[1:-1,1:-1,:-1]) \
-    / sdz
-
-    T3 = C[1:-1,1:-1,1:-1,2,0]*(ux[1:,1:-1,1:-1] - ux[:-1,1:-1,1:-1]) \
-        / sdx \
-        + C[1:-1,1:-1,1:-1,2,1]*(uy[1:-1,1:,1:-1] - uy[1:-1,:-1,1:-1]) \
-        / sdy \
-        + C[1:-1,1:-1,1:-1,2,2]*(uz[1:-1,1:-1,1:] - uz[1:-1,1:-1,:-1]) \
-        / sdz
-
-    T4 = C[1:-1,1:,1:,3,3]*( \
+      c21*(ux[1:,1:-1,1:-1] - ux[:-1,1:-1,1:-1]) \
+    * rsdx \
+    + c22*(uy[1:-1,1:,1:-1] - uy[1:-1,:-1,1:-1]) \
+    * rsdy \
+    + c23*(uz[1:-1,1:-1,1:] - uz[1:-1,1:-1,:-1]) \
+    * rsdz
+
+    T3 = c31*(ux[1:,1:-1,1:-1] - ux[:-1,1:-1,1:-1]) \
+        * rsdx \
+        + c32*(uy[1:-1,1:,1:-1] - uy[1:-1,:-1,1:-1]) \
+        * rsdy \
+        + c33*(uz[1:-1,1:-1,1:] - uz[1:-1,1:-1,:-1]) \
+        * rsdz
+
+    T4 = c44*( \
         (uy[1:-1,:,1:] - uy[1:-1,:,:-1]) \
-        / fdz \
+        * rfdz \
         + (uz[1:-1,1:,:] - uz[1:-1,:-1,:]) \
-        / fdy
+        * rfdy
     )
 
-    T5 = C[1:,1:-1,1:,4,4]*( \
+    T5 = c55*( \
         (ux[:,1:-1,1:] - ux[:,1:-1,:-1]) \
-        / fdz \
+        * rfdz \
         + (uz[1:,1:-1,:] - uz[:-1,1:-1,:])
-        / fdx
+        * rfdx
     )
 
-    T6 = C[1:,1:,1:-1,5,5]*( \
+    T6 = c66*( \
         (ux[:,1:,1:-1] - ux[:,:-1,1:-1]) \
-        / fdy \
+        * rfdy \
         + (uy[1:,:,1:-1] - uy[:-1,:,1:-1]) \
-        / fdx
+        * rfdx
     )
     return T1,T2,T3,T4,T5,T6
 
 @njit(cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
-def update_T_tfbc(C, u, fd, sd):
+def update_T_tfbc(c, c_s, u, rfd, rsd):
+    c11_s, c12_s, c13_s, c21_s, c22_s, c23_s, c44_s, c55_s, c66_s = c_s
     ux, uy, uz = u
-    fdx, fdy, fdz = fd
-    sdx, sdy, sdz = sd
+    rfdx, rfdy, rfdz = rfd
+    rsdx, rsdy, rsdz = rsd
 
-    T1 = C[1:-1,1:-1,0,0,0]*(ux[1:,1:-1,0] - ux[:-1,1:-1,0]) / sdx[0,:,:] \
-        + C[1:-1,1:-1,0,0,1]*(uy[1:-1,1:,0] - uy[1:-1,:-1,0]) / sdy[:,0,:] \
-        + C[1:-1,1:-1,0,0,2]*(uz[1:-1,1:-1,0] - 0) / sdz[:,:,0]
+    T1 = c11_s*(ux[1:,1:-1,0] - ux[:-1,1:-1,0]) * rsdx[0,:,:] \
+        + c12_s*(uy[1:-1,1:,0] - uy[1:-1,:-1,0]) * rsdy[:,0,:] \
+        + c13_s*(uz[1:-1,1:-1,0] - 0) * rsdz[:,:,0]
 
-    T2 = C[1:-1,1:-1,0,1,0]*(ux[1:,1:-1,0] - ux[:-1,1:-1,0]) / sdx[0,:,:] \
-        + C[1:-1,1:-1,0,1,1]*(uy[1:-1,1:,0] - uy[1:-1,:-1,0]) / sdy[:,0,:] \
-        + C[1:-1,1:-1,0,1,2]*(uz[1:-1,1:-1,0] - 0) / sdz[:,:,0]
+    T2 = c21_s*(ux[1:,1:-1,0] - ux[:-1,1:-1,0]) * rsdx[0,:,:] \
+        + c22_s*(uy[1:-1,1:,0] - uy[1:-1,:-1,0]) * rsdy[:,0,:] \
+        + c23_s*(uz[1:-1,1:-1,0] - 0) * rsdz[:,:,0]
 
     T3 = 0
 
-    T4 = C[1:-1,1:,0,3,3] \
-        * ((uy[1:-1,:,1] - uy[1:-1,:,0]) / fdy[:,0,:] \
-        + (uz[1:-1,1:,0] - uz[1:-1,:-1,0]) / fdz[:,:,0])
+    T4 = c44_s \
+        * ((uy[1:-1,:,1] - uy[1:-1,:,0]) * rfdy[:,0,:] \
+        + (uz[1:-1,1:,0] - uz[1:-1,:-1,0]) * rfdz[:,:,0])
 
-    T5 = C[1:,1:-1,0,4,4] \
-        * ((ux[:,1:-1,1] - ux[:,1:-1,0]) / fdx[0,:,:] \
-        + (uz[1:,1:-1,0] - uz[:-1,1:-1,0]) / fdz[:,:,0])
+    T5 = c55_s \
+        * ((ux[:,1:-1,1] - ux[:,1:-1,0]) * rfdx[0,:,:] \
+        + (uz[1:,1:-1,0] - uz[:-1,1:-1,0]) * rfdz[:,:,0])
 
-    T6 = C[1:,1:,0,5,5] \
-        * ((ux[:,1:,0] - ux[:,:-1,0]) / fdx[0,:,:] \
-        + (uy[1:,:,0] - uy[:-1,:,0]) / fdz[:,:,0])
+    T6 = c66_s \
+        * ((ux[:,1:,0] - ux[:,:-1,0]) * rfdx[0,:,:] \
+        + (uy[1:,:,0] - uy[:-1,:,0]) * rfdz[:,:,0])
 
     return T1,T2,T3,T4,T5,T6
+
+@njit(parallel=cfg['numba']['parallel'], cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
+def fused_step(phase, c, rho, abc, u, u_old, u_new, T, rsd, rfd, blocks):
+    '''
+    Single pass equivalent of BaseSolver update_T, update_T_BC, update_u and update_u_BC.
+    Every grid array is updated in place, each cell is visited once per phase.
+    Boundary expressions mirror the reference solver exactly.
+    Material coefficients are looked up per cell from the phase map,
+    c and rho hold the stiffness tensor and dt**2/P of each phase.
+    Grid arrays include the ghost layer, z index k of the grid is stored at k+GHOST.
+    Both passes traverse the x/y blocks (i0, i1, j0, j1) in parallel, see Solver.tiles.
+    '''
+    stress(phase, c, u, T, rsd, rfd, blocks)
+    displacement(phase, rho, u, u_old, u_new, T, rsd, rfd, blocks)
+    # Absorbing boundaries, the x face first as in BaseSolver.apply_u_abc
+    absorb_x(phase, abc, u, u_new)
+    absorb_yz(0, phase.shape[0], phase, abc, u, u_new)
+
+@njit(parallel=cfg['numba']['parallel'], cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
+def stress(phase, c, u, T, rsd, rfd, blocks):
+    '''
+    Stress tensor of the cells in blocks, traction free surface at k = 0
+    '''
+    ux, uy, uz = u
+    T1, T2, T3, T4, T5, T6 = T
+    rsdx, rsdy, rsdz = rsd
+    rfdx, rfdy, rfdz = rfd
+    nz = phase.shape[2]
+
+    for b in prange(blocks.shape[0]):
+        i0, i1, j0, j1 = blocks[b,0], blocks[b,1], blocks[b,2], blocks[b,3]
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                if i > 0 and j > 0:
+                    T1[i,j,GHOST] = c[phase[i,j,0],0,0]*(ux[i,j,GHOST] - ux[i-1,j,GHOST]) * rsdx[0] \
+                        + c[phase[i,j,0],0,1]*(uy[i,j,GHOST] - uy[i,j-1,GHOST]) * rsdy[0] \
+                        + c[phase[i,j,0],0,2]*uz[i,j,GHOST] * rsdz[0]
+                    T2[i,j,GHOST] = c[phase[i,j,0],1,0]*(ux[i,j,GHOST] - ux[i-1,j,GHOST]) * rsdx[0] \
+                        + c[phase[i,j,0],1,1]*(uy[i,j,GHOST] - uy[i,j-1,GHOST]) * rsdy[0] \
+                        + c[phase[i,j,0],1,2]*uz[i,j,GHOST] * rsdz[0]
+                    T3[i,j,GHOST] = 0
+                    for k in range(1, nz-1):
+                        p = phase[i,j,k]
+                        dux = (ux[i,j,k+GHOST] - ux[i-1,j,k+GHOST]) * rsdx[i-1]
+                        duy = (uy[i,j,k+GHOST] - uy[i,j-1,k+GHOST]) * rsdy[j-1]
+                        duz = (uz[i,j,k+GHOST] - uz[i,j,k-1+GHOST]) * rsdz[k-1]
+                        T1[i,j,k+GHOST] = c[p,0,0]*dux + c[p,0,1]*duy + c[p,0,2]*duz
+                        T2[i,j,k+GHOST] = c[p,1,0]*dux + c[p,1,1]*duy + c[p,1,2]*duz
+                        T3[i,j,k+GHOST] = c[p,2,0]*dux + c[p,2,1]*duy + c[p,2,2]*duz
+                if i > 0:
+                    T4[i,j,GHOST] = c[phase[i,j+1,0],3,3] \
+                        * ((uy[i,j,1+GHOST] - uy[i,j,GHOST]) * rfdy[0] + (uz[i,j+1,GHOST] - uz[i,j,GHOST]) * rfdz[0])
+                    for k in range(1, nz-1):
+                        T4[i,j,k+GHOST] = c[phase[i,j+1,k+1],3,3] \
+                            * ((uy[i,j,k+1+GHOST] - uy[i,j,k+GHOST]) * rfdz[k] + (uz[i,j+1,k+GHOST] - uz[i,j,k+GHOST]) * rfdy[j])
+                if j > 0:
+                    T5[i,j,GHOST] = c[phase[i+1,j,0],4,4] \
+                        * ((ux[i,j,1+GHOST] - ux[i,j,GHOST]) * rfdx[0] + (uz[i+1,j,GHOST] - uz[i,j,GHOST]) * rfdz[0])
+                    for k in range(1, nz-1):
+                        T5[i,j,k+GHOST] = c[phase[i+1,j,k+1],4,4] \
+                            * ((ux[i,j,k+1+GHOST] - ux[i,j,k+GHOST]) * rfdz[k] + (uz[i+1,j,k+GHOST] - uz[i,j,k+GHOST]) * rfdx[i])
+                T6[i,j,GHOST] = c[phase[i+1,j+1,0],5,5] \
+                    * ((ux[i,j+1,GHOST] - ux[i,j,GHOST]) * rfdx[0] + (uy[i+1,j,GHOST] - uy[i,j,GHOST]) * rfdz[0])
+                for k in range(1, nz-1):
+                    T6[i,j,k+GHOST] = c[phase[i+1,j+1,k],5,5] \
+                        * ((ux[i,j+1,k+GHOST] - ux[i,j,k+GHOST]) * rfdy[j] + (uy[i+1,j,k+GHOST] - uy[i,j,k+GHOST]) * rfdx[i])
+
+@njit(parallel=cfg['numba']['parallel'], cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
+def displacement(phase, rho, u, u_old, u_new, T, rsd, rfd, blocks):
+    '''
+    Displacement of the cells in blocks, traction free surface at k = 0
+    '''
+    ux, uy, uz = u
+    ux_old, uy_old, uz_old = u_old
+    ux_new, uy_new, uz_new = u_new
+    T1, T2, T3, T4, T5, T6 = T
+    rsdx, rsdy, rsdz = rsd
+    rfdx, rfdy, rfdz = rfd
+    nz = phase.shape[2]
+
+    for b in prange(blocks.shape[0]):
+        i0, i1, j0, j1 = blocks[b,0], blocks[b,1], blocks[b,2], blocks[b,3]
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                if j > 0:
+                    ux_new[i,j,GHOST] = 2*ux[i,j,GHOST] - ux_old[i,j,GHOST] + rho[phase[i+1,j,0]] \
+                        * ((T1[i+1,j,GHOST] - T1[i,j,GHOST]) * rfdx[0] \
+                        + (T6[i,j,GHOST] - T6[i,j-1,GHOST]) * rsdy[0] \
+                        + T5[i,j,GHOST] * rsdz[0])
+                    for k in range(1, nz-1):
+                        ux_new[i,j,k+GHOST] = 2*ux[i,j,k+GHOST] - ux_old[i,j,k+GHOST] + rho[phase[i+1,j,k]] \
+                            * ((T1[i+1,j,k+GHOST] - T1[i,j,k+GHOST]) * rfdx[i] \
+                            + (T6[i,j,k+GHOST] - T6[i,j-1,k+GHOST]) * rsdy[j-1] \
+                            + (T5[i,j,k+GHOST] - T5[i,j,k-1+GHOST]) * rsdz[k-1])
+                if i > 0:
+                    uy_new[i,j,GHOST] = 2*uy[i,j,GHOST] - uy_old[i,j,GHOST] + rho[phase[i,j+1,0]] \
+                        * ((T6[i,j,GHOST] - T6[i-1,j,GHOST]) * rsdx[0] \
+                        + (T2[i,j+1,GHOST] - T2[i,j,GHOST]) * rfdy[0] \
+                        + T4[i,j,GHOST] * rsdz[0])
+                    for k in range(1, nz-1):
+                        uy_new[i,j,k+GHOST] = 2*uy[i,j,k+GHOST] - uy_old[i,j,k+GHOST] + rho[phase[i,j+1,k]] \
+                            * ((T6[i,j,k+GHOST] - T6[i-1,j,k+GHOST]) * rsdx[i-1] \
+                            + (T2[i,j+1,k+GHOST] - T2[i,j,k+GHOST]) * rfdy[j] \
+                            + (T4[i,j,k+GHOST] - T4[i,j,k-1+GHOST]) * rsdz[k-1])
+                if i > 0 and j > 0:
+                    uz_new[i,j,GHOST] = 2*uz[i,j,GHOST] - uz_old[i,j,GHOST] + rho[phase[i,j,0]] \
+                        * ((T5[i,j,GHOST] - T5[i-1,j,GHOST]) * rsdx[0] \
+                        + (T4[i,j,GHOST] - T4[i,j-1,GHOST]) * rsdy[0] \
+                        + T3[i,j,1+GHOST] - T3[i,j,GHOST] * rfdz[0])
+                    for k in range(1, nz-1):
+                        uz_new[i,j,k+GHOST] = 2*uz[i,j,k+GHOST] - uz_old[i,j,k+GHOST] + rho[phase[i,j,k+1]] \
+                            * ((T5[i,j,k+GHOST] - T5[i-1,j,k+GHOST]) * rsdx[i-1] \
+                            + (T4[i,j,k+GHOST] - T4[i,j-1,k+GHOST]) * rsdy[j-1] \
+                            + (T3[i,j,k+1+GHOST] - T3[i,j,k+GHOST]) * rfdz[k])
+
+@njit(cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
+def absorb_x(phase, abc, u, u_new):
+    '''
+    Absorbing boundary on the x max face, reads the two last planes of u_new
+    '''
+    ux, uy, uz = u
+    ux_new, uy_new, uz_new = u_new
+    clx, ctx = abc[0], abc[1]
+    ny, nz = phase.shape[1], phase.shape[2]
+
+    for j in range(ny):
+        for k in range(nz):
+            ux_new[-1,j,k+GHOST] = ux[-2,j,k+GHOST] + clx*(ux_new[-2,j,k+GHOST] - ux[-1,j,k+GHOST])
+            if j < ny-1:
+                uy_new[-1,j,k+GHOST] = uy[-2,j,k+GHOST] + ctx*(uy_new[-2,j,k+GHOST] - uy[-1,j,k+GHOST])
+            if k < nz-1:
+                uz_new[-1,j,k+GHOST] = uz[-2,j,k+GHOST] + ctx*(uz_new[-2,j,k+GHOST] - uz[-1,j,k+GHOST])
+
+@njit(cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
+def absorb_yz(i0, i1, phase, abc, u, u_new):
+    '''
+    Absorbing boundaries on the y and z faces of the planes i0 .. i1-1,
+    each plane only reads itself so applying them plane by plane after absorb_x
+    matches the face by face order of BaseSolver.apply_u_abc
+    '''
+    ux, uy, uz = u
+    ux_new, uy_new, uz_new = u_new
+    cly0, cty0, cly1, cty1, clz, ctz = abc[2], abc[3], abc[4], abc[5], abc[6], abc[7]
+    nx, ny, nz = phase.shape
+
+    for i in range(i0, i1):
+        for k in range(nz):
+            if i < nx-1:
+                ux_new[i,0,k+GHOST] = ux[i,1,k+GHOST] + cty0*(ux_new[i,1,k+GHOST] - ux[i,0,k+GHOST])
+            uy_new[i,0,k+GHOST] = uy[i,1,k+GHOST] + cly0*(uy_new[i,1,k+GHOST] - uy[i,0,k+GHOST])
+            if k < nz-1:
+                uz_new[i,0,k+GHOST] = uz[i,1,k+GHOST] + cty0*(uz_new[i,1,k+GHOST] - uz[i,0,k+GHOST])
+        for k in range(nz):
+            if i < nx-1:
+                ux_new[i,-1,k+GHOST] = ux[i,-2,k+GHOST] + cty1*(ux_new[i,-2,k+GHOST] - ux[i,-1,k+GHOST])
+            uy_new[i,-1,k+GHOST] = uy[i,-2,k+GHOST] + cly1*(uy_new[i,-2,k+GHOST] - uy[i,-1,k+GHOST])
+            if k < nz-1:
+                uz_new[i,-1,k+GHOST] = uz[i,-2,k+GHOST] + cty1*(uz_new[i,-2,k+GHOST] - uz[i,-1,k+GHOST])
+        for j in range(ny):
+            if i < nx-1:
+                ux_new[i,j,-1] = ux[i,j,-2] + ctz*(ux_new[i,j,-2] - ux[i,j,-1])
+            if j < ny-1:
+                uy_new[i,j,-1] = uy[i,j,-2] + ctz*(uy_new[i,j,-2] - uy[i,j,-1])
+            uz_new[i,j,-1] = uz[i,j,-2] + clz*(uz_new[i,j,-2] - uz[i,j,-1])
+
+@njit(parallel=cfg['numba']['parallel'], cache=cfg['numba']['cache'], fastmath=cfg['numba']['fastmath'])
+def advance(phase, c, rho, abc, u, u_old, u_new, T, rsd, rfd, blocks, source, t0, n, frames, record):
+    '''
+    Compiled equivalent of BaseSolver.advance: n fused steps including the source and time step
+    '''
+    ux, uy, uz = u
+    ux_old, uy_old, uz_old = u_old
+    ux_new, uy_new, uz_new = u_new
+    fux, fuy, fuz = frames
+
+    for s in range(n):
+        uz[0,:,GHOST] = source[t0+s]
+        fused_step(phase, c, rho, abc, (ux, uy, uz), (ux_old, uy_old, uz_old), (ux_new, uy_new, uz_new), T, rsd, rfd, blocks)
+
+        # Same buffer rotation as Grid.rotate, see BaseSolver.time_step
+        ux_old, ux, ux_new = ux, ux_new, ux_old
+        uy_old, uy, uy_new = uy, uy_new, uy_old
+        uz_old, uz, uz_new = uz, uz_new, uz_old
+        uz_new[0,:,GHOST] = 0
+
+        if record:
+            fux[:,:,:,s] = ux[:,:,GHOST:]
+            fuy[:,:,:,s] = uy[:,:,GHOST:]
+            fuz[:,:,:,s] = uz[:,:,GHOST:]
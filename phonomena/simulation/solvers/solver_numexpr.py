@@ -0,0 +1,117 @@
+import numexpr
+
+from simulation import base_solver
+from simulation.grid import GHOST
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {'num_threads': numexpr.detect_number_of_cores()}
+
+# Stencil expressions, evaluated in chunks by numexpr without intermediate arrays
+STRESS = "c1*(a1 - a0)*ra + c2*(b1 - b0)*rb + c3*(d1 - d0)*rd"
+SHEAR = "c*((a1 - a0)*ra + (b1 - b0)*rb)"
+DISPLACEMENT = "2*u - u_old + rho*((a1 - a0)*ra + (b1 - b0)*rb + (d1 - d0)*rd)"
+# dt**2/P already folded into ra, rb, rd, see BaseSolver.initCoefficients
+DISPLACEMENT_FOLDED = "2*u - u_old + (a1 - a0)*ra + (b1 - b0)*rb + (d1 - d0)*rd"
+ABSORB = "u_in + c*(u_new_in - u_edge)"
+
+def evaluate(ex, out, **operands):
+    numexpr.evaluate(ex, local_dict=operands, out=out, casting='same_kind')
+    return out
+
+class Solver(base_solver.BaseSolver):
+
+    def __init__(self):
+        super().__init__(logger)
+
+        self.name = "numexpr"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+
+    def init(self, grid, material, steps):
+        numexpr.set_num_threads(int(self.cfg['num_threads']))
+        super().init(grid, material, steps)
+
+    def initScratch(self):
+        '''
+        The numexpr kernels write straight into the grid arrays, no scratch buffers are needed
+        '''
+        self.scratch = {}
+
+    def update_T(self):
+        g, C, c = self.g, self.m.stiffness, self.coef
+        uz = g.uz_pad[:,:,GHOST-1:] # starts at the ghost plane above the surface
+
+        du = {
+            'a1': g.ux[1:,1:-1,:-1], 'a0': g.ux[:-1,1:-1,:-1], 'ra': c['T_ux'],
+            'b1': g.uy[1:-1,1:,:-1], 'b0': g.uy[1:-1,:-1,:-1], 'rb': c['T_uy'],
+            'd1': uz[1:-1,1:-1,1:], 'd0': uz[1:-1,1:-1,:-1], 'rd': c['T_uz'],
+        }
+        for a, T in enumerate((g.T1, g.T2, g.T3)):
+            row = {'c{}'.format(b+1): C['c{}{}'.format(a+1, b+1)] for b in range(3)}
+            evaluate(STRESS, T[1:-1,1:-1,:-1], **row, **du)
+
+        evaluate(SHEAR, g.T4[1:-1,:,:], c=C['c44'],
+            a1=g.uy[1:-1,:,1:], a0=g.uy[1:-1,:,:-1], ra=c['T4_uy'],
+            b1=g.uz[1:-1,1:,:], b0=g.uz[1:-1,:-1,:], rb=c['T4_uz'])
+
+        evaluate(SHEAR, g.T5[:,1:-1,:], c=C['c55'],
+            a1=g.ux[:,1:-1,1:], a0=g.ux[:,1:-1,:-1], ra=c['T5_ux'],
+            b1=g.uz[1:,1:-1,:], b0=g.uz[:-1,1:-1,:], rb=c['T5_uz'])
+
+        evaluate(SHEAR, g.T6[:,:,:-1], c=C['c66'],
+            a1=g.ux[:,1:,:-1], a0=g.ux[:,:-1,:-1], ra=c['T6_ux'],
+            b1=g.uy[1:,:,:-1], b0=g.uy[:-1,:,:-1], rb=c['T6_uy'])
+
+    def update_u(self):
+        g, c = self.g, self.coef
+        # start at the ghost plane above the surface
+        T4, T5 = g.T4_pad[:,:,GHOST-1:], g.T5_pad[:,:,GHOST-1:]
+
+        def leapfrog(out, u, u_old, rho, **operands):
+            if rho is None:
+                return evaluate(DISPLACEMENT_FOLDED, out, u=u, u_old=u_old, **operands)
+            return evaluate(DISPLACEMENT, out, u=u, u_old=u_old, rho=rho, **operands)
+
+        leapfrog(g.ux_new[:,1:-1,:-1], g.ux[:,1:-1,:-1], g.ux_old[:,1:-1,:-1], c.get('ux'),
+            a1=g.T1[1:,1:-1,:-1], a0=g.T1[:-1,1:-1,:-1], ra=c['ux_T1'],
+            b1=g.T6[:,1:,:-1], b0=g.T6[:,:-1,:-1], rb=c['ux_T6'],
+            d1=T5[:,1:-1,1:], d0=T5[:,1:-1,:-1], rd=c['ux_T5'])
+
+        leapfrog(g.uy_new[1:-1,:,:-1], g.uy[1:-1,:,:-1], g.uy_old[1:-1,:,:-1], c.get('uy'),
+            a1=g.T6[1:,:,:-1], a0=g.T6[:-1,:,:-1], ra=c['uy_T6'],
+            b1=g.T2[1:-1,1:,:-1], b0=g.T2[1:-1,:-1,:-1], rb=c['uy_T2'],
+            d1=T4[1:-1,:,1:], d0=T4[1:-1,:,:-1], rd=c['uy_T4'])
+
+        leapfrog(g.uz_new[1:-1,1:-1,:], g.uz[1:-1,1:-1,:], g.uz_old[1:-1,1:-1,:], c.get('uz'),
+            a1=g.T5[1:,1:-1,:], a0=g.T5[:-1,1:-1,:], ra=c['uz_T5'],
+            b1=g.T4[1:-1,1:,:], b0=g.T4[1:-1,:-1,:], rb=c['uz_T4'],
+            d1=g.T3[1:-1,1:-1,1:], d0=g.T3[1:-1,1:-1,:-1], rd=c['uz_T3'])
+
+    def apply_u_abc(self):
+        g, abc = self.g, self.coef['abc']
+        clx, ctx, clz, ctz = abc['clx'], abc['ctx'], abc['clz'], abc['ctz']
+        cly, cty = (abc['cly0'], abc['cly1']), (abc['cty0'], abc['cty1'])
+        absorb = lambda out, u_in, u_new_in, u_edge, c: \
+            evaluate(ABSORB, out, u_in=u_in, u_new_in=u_new_in, u_edge=u_edge, c=c)
+
+        # YZ face
+        absorb(g.ux_new[-1,:,:], g.ux[-2,:,:], g.ux_new[-2,:,:], g.ux[-1,:,:], clx)
+        absorb(g.uy_new[-1,:,:], g.uy[-2,:,:], g.uy_new[-2,:,:], g.uy[-1,:,:], ctx)
+        absorb(g.uz_new[-1,:,:], g.uz[-2,:,:], g.uz_new[-2,:,:], g.uz[-1,:,:], ctx)
+
+        # periodic grids wrap the y faces and mirrored grids the y max face, see BaseSolver.apply_u_ybc
+        if not g.periodic_y:
+            absorb(g.ux_new[:,0,:], g.ux[:,1,:], g.ux_new[:,1,:], g.ux[:,0,:], cty[0])
+            absorb(g.uy_new[:,0,:], g.uy[:,1,:], g.uy_new[:,1,:], g.uy[:,0,:], cly[0])
+            absorb(g.uz_new[:,0,:], g.uz[:,1,:], g.uz_new[:,1,:], g.uz[:,0,:], cty[0])
+
+        if not g.periodic_y and g.mirror is None:
+            absorb(g.ux_new[:,-1,:], g.ux[:,-2,:], g.ux_new[:,-2,:], g.ux[:,-1,:], cty[-1])
+            absorb(g.uy_new[:,-1,:], g.uy[:,-2,:], g.uy_new[:,-2,:], g.uy[:,-1,:], cly[-1])
+            absorb(g.uz_new[:,-1,:], g.uz[:,-2,:], g.uz_new[:,-2,:], g.uz[:,-1,:], cty[-1])
+
+        absorb(g.ux_new[:,:,-1], g.ux[:,:,-2], g.ux_new[:,:,-2], g.ux[:,:,-1], ctz)
+        absorb(g.uy_new[:,:,-1], g.uy[:,:,-2], g.uy_new[:,:,-2], g.uy[:,:,-1], ctz)
+        absorb(g.uz_new[:,:,-1], g.uz[:,:,-2], g.uz_new[:,:,-2], g.uz[:,:,-1], clz)
@@ -0,0 +1,220 @@
+import copy
+import numpy as np
+
+from simulation import base_solver
+from simulation.base_solver import difference, absorb
+from simulation.grid import Grid, GHOST
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    # 'xz': ux and uz in the x-z plane, driven by uz at the surface as the 3D solvers
+    # 'xy': ux and uy in the x-y plane, driven by uy on the x = 0 face
+    'plane': 'xz',
+    # 'strain': no strain along the dropped axis, 'stress': no normal stress along it
+    'approximation': 'strain',
+    # coordinate of the section along the dropped axis, None for y = size_y/2 or z = 0
+    'section': None,
+}
+
+# Axis dropped by each plane
+AXIS = {'xz': 1, 'xy': 2}
+
+def planeStress(c, axis):
+    '''
+    Stiffness tensors c (Voigt notation) reduced for a zero normal stress along axis
+    '''
+    c = np.array(c)
+    c[...,:3,:3] -= c[...,:3,axis,None]*c[...,None,axis,:3]/c[...,axis,axis,None,None]
+    return c
+
+def sectionLine(a, axis):
+    '''
+    Coefficient a of the extruded grid at its middle line along axis, see Solver.init.
+    Coefficients start at line 1 along the dropped axis, per phase tables and singleton axes are kept.
+    '''
+    if np.ndim(a) < 3 or a.shape[axis] == 1:
+        return a
+    return np.ascontiguousarray(np.take(a, [1], axis=axis))
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Plane strain or plane stress solver. Only the two in plane displacements and their three
+    stresses are updated, on a grid of a single line along the dropped axis, so the output keeps
+    the HDF layout of the 3D solvers with a singleton axis.
+    The coefficients are those of BaseSolver on the mesh extruded by one line on either side of
+    the section, the x-z plane strain update matches a 3D run that is invariant along y.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "plane"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+
+    def init(self, grid, material, steps):
+        self.t = copy.deepcopy(steps)
+
+        logger.info("Initializing {} with settings: {}".format(self.logger.name, self.cfg))
+
+        plane, approximation = self.cfg['plane'], self.cfg['approximation']
+        assert plane in AXIS and approximation in ('strain', 'stress')
+        axis = AXIS[plane]
+
+        g = copy.deepcopy(grid)
+        if g.periodic_y or g.mirror_y:
+            logger.warning("Periodic and mirror settings do not apply to the plane solver.")
+            g.periodic_y, g.mirror_y = False, None
+        g.buildMesh()
+        g.updateSpacing()
+
+        # Three lines around the section along the dropped axis, spaced like the finest
+        # in plane spacing so they do not shorten the time step
+        section = self.cfg['section']
+        if section is None:
+            section = g.size_y/2 if plane == 'xz' else 0
+        d = min(g.fdx.min(), (g.fdz if plane == 'xz' else g.fdy).min())/g.SI_conversion
+        lines = section + np.array([-d, 0, d])
+        if plane == 'xz':
+            g.y = lines
+        else:
+            g.z = lines
+        g.updateSpacing()
+
+        m = copy.deepcopy(material)
+        m.grid = g
+        m.update(dtype=self.precision())
+        if approximation == 'stress':
+            m.phases['c'] = planeStress(m.phases['c'], axis)
+            if not m.compact:
+                m.setConstants()
+        m.setStiffness()
+
+        self.g, self.m = g, m
+        self.uniform, self.homogeneous = g.uniform(), m.homogeneous()
+        self.initCoefficients()
+        self.coef = {key: value if key == 'abc' else sectionLine(value, axis) for key, value in self.coef.items()}
+
+        # State arrays and output on the section line only
+        p = Grid()
+        p.x, p.y, p.z = g.x, g.y, g.z
+        if plane == 'xz':
+            p.y = g.y[1:2]
+        else:
+            p.z = g.z[1:2]
+        p.SI_conversion = g.SI_conversion
+        p.update(dtype=self.precision())
+
+        index = tuple(slice(1, 2) if i == axis else slice(None) for i in range(3))
+        self.m = copy.copy(m)
+        self.m.grid = p
+        self.m.phase = np.ascontiguousarray(m.phase[index])
+        if not m.compact:
+            self.m.P, self.m.C = m.P[index], m.C[index]
+        self.m.stiffness = {key: sectionLine(value, axis) for key, value in m.stiffness.items()}
+        self.g = p
+        # the source drives the in plane displacement transverse to x on the plane x = 0
+        self.drive = 'uz' if plane == 'xz' else 'uy'
+
+        self.initScratch()
+        self.initWriter()
+
+    def initScratch(self):
+        nx, ny, nz = self.g.x.size, self.g.y.size, self.g.z.size
+        dtype = self.precision()
+        if self.cfg['plane'] == 'xz':
+            shapes = {
+                'dux': (nx-2, 1, nz-1),
+                'duz': (nx-2, 1, nz-1),
+                'T': (nx-2, 1, nz-1),
+                'T5': (nx-1, 1, nz-1),
+                'ux': (nx-1, 1, nz-1),
+                'uz': (nx-2, 1, nz-1),
+            }
+        else:
+            shapes = {
+                'dux': (nx-2, ny-2, 1),
+                'duy': (nx-2, ny-2, 1),
+                'T': (nx-2, ny-2, 1),
+                'T6': (nx-1, ny-1, 1),
+                'ux': (nx-1, ny-2, 1),
+                'uy': (nx-2, ny-1, 1),
+            }
+        self.scratch = {key: np.zeros(shape, dtype=dtype) for key, shape in shapes.items()}
+
+    def advance(self, source, t0, n):
+        for s in range(n):
+            getattr(self.g, self.drive)[0, :, 0] = source[t0+s]
+            self.step()
+            if self.frames is not None:
+                self.frames.ux[..., s] = self.g.ux
+                self.frames.uy[..., s] = self.g.uy
+                self.frames.uz[..., s] = self.g.uz
+
+    def update_T(self):
+        g, C, c, s = self.g, self.m.stiffness, self.coef, self.scratch
+        if self.cfg['plane'] == 'xz':
+            uz = g.uz_pad[...,GHOST-1:] # starts at the ghost plane above the surface
+            dux = difference(g.ux[1:,:,:-1], g.ux[:-1,:,:-1], c['T_ux'], s['dux'])
+            duz = difference(uz[1:-1,:,1:], uz[1:-1,:,:-1], c['T_uz'], s['duz'])
+            for T, row in ((g.T1, 1), (g.T3, 3)):
+                out = np.multiply(C['c{}1'.format(row)], dux, out=T[1:-1,:,:-1])
+                out += np.multiply(C['c{}3'.format(row)], duz, out=s['T'])
+
+            T5 = difference(g.ux[:,:,1:], g.ux[:,:,:-1], c['T5_ux'], g.T5)
+            T5 += difference(g.uz[1:], g.uz[:-1], c['T5_uz'], s['T5'])
+            T5 *= C['c55']
+        else:
+            dux = difference(g.ux[1:,1:-1], g.ux[:-1,1:-1], c['T_ux'], s['dux'])
+            duy = difference(g.uy[1:-1,1:], g.uy[1:-1,:-1], c['T_uy'], s['duy'])
+            for T, row in ((g.T1, 1), (g.T2, 2)):
+                out = np.multiply(C['c{}1'.format(row)], dux, out=T[1:-1,1:-1])
+                out += np.multiply(C['c{}2'.format(row)], duy, out=s['T'])
+
+            T6 = difference(g.ux[:,1:], g.ux[:,:-1], c['T6_ux'], g.T6)
+            T6 += difference(g.uy[1:], g.uy[:-1], c['T6_uy'], s['T6'])
+            T6 *= C['c66']
+
+    def update_u(self):
+        g, c, s = self.g, self.coef, self.scratch
+        if self.cfg['plane'] == 'xz':
+            T5 = g.T5_pad[...,GHOST-1:] # starts at the ghost plane above the surface
+            ux = difference(g.T1[1:,:,:-1], g.T1[:-1,:,:-1], c['ux_T1'], g.ux_new[:,:,:-1])
+            ux += difference(T5[:,:,1:], T5[:,:,:-1], c['ux_T5'], s['ux'])
+            self.leapfrog(ux, g.ux[:,:,:-1], g.ux_old[:,:,:-1], c.get('ux'), s['ux'])
+
+            uz = difference(g.T5[1:], g.T5[:-1], c['uz_T5'], g.uz_new[1:-1])
+            uz += difference(g.T3[1:-1,:,1:], g.T3[1:-1,:,:-1], c['uz_T3'], s['uz'])
+            self.leapfrog(uz, g.uz[1:-1], g.uz_old[1:-1], c.get('uz'), s['uz'])
+        else:
+            ux = difference(g.T1[1:,1:-1], g.T1[:-1,1:-1], c['ux_T1'], g.ux_new[:,1:-1])
+            ux += difference(g.T6[:,1:], g.T6[:,:-1], c['ux_T6'], s['ux'])
+            self.leapfrog(ux, g.ux[:,1:-1], g.ux_old[:,1:-1], c.get('ux'), s['ux'])
+
+            uy = difference(g.T6[1:], g.T6[:-1], c['uy_T6'], g.uy_new[1:-1])
+            uy += difference(g.T2[1:-1,1:], g.T2[1:-1,:-1], c['uy_T2'], s['uy'])
+            self.leapfrog(uy, g.uy[1:-1], g.uy_old[1:-1], c.get('uy'), s['uy'])
+
+    def apply_u_abc(self):
+        '''
+        Absorbing BC on the x max face and the in plane faces of the dropped axis' neighbours
+        '''
+        g, abc = self.g, self.coef['abc']
+        if self.cfg['plane'] == 'xz':
+            absorb(g.ux_new[-1], g.ux[-2], g.ux_new[-2], g.ux[-1], abc['clx'])
+            absorb(g.uz_new[-1], g.uz[-2], g.uz_new[-2], g.uz[-1], abc['ctx'])
+            absorb(g.ux_new[...,-1], g.ux[...,-2], g.ux_new[...,-2], g.ux[...,-1], abc['ctz'])
+            absorb(g.uz_new[...,-1], g.uz[...,-2], g.uz_new[...,-2], g.uz[...,-1], abc['clz'])
+        else:
+            absorb(g.ux_new[-1], g.ux[-2], g.ux_new[-2], g.ux[-1], abc['clx'])
+            absorb(g.uy_new[-1], g.uy[-2], g.uy_new[-2], g.uy[-1], abc['ctx'])
+            absorb(g.ux_new[:,0], g.ux[:,1], g.ux_new[:,1], g.ux[:,0], abc['cty0'])
+            absorb(g.uy_new[:,0], g.uy[:,1], g.uy_new[:,1], g.uy[:,0], abc['cly0'])
+            absorb(g.ux_new[:,-1], g.ux[:,-2], g.ux_new[:,-2], g.ux[:,-1], abc['cty1'])
+            absorb(g.uy_new[:,-1], g.uy[:,-2], g.uy_new[:,-2], g.uy[:,-1], abc['cly1'])
+
+    def time_step(self):
+        self.g.rotate()
+        # clear the source line left in the recycled buffer, see BaseSolver.time_step
+        getattr(self.g, self.drive+'_new')[0, :, 0] = 0
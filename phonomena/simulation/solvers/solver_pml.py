@@ -0,0 +1,252 @@
+from functools import reduce
+import numpy as np
+
+from simulation import base_solver
+from simulation.base_solver import difference, part, accumulate
+from simulation.grid import GHOST
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    # cells of the layers on the x max, y and z max faces, at most MAX_SHARE of the cells of the axis.
+    # Faces left with less than MIN_CELLS keep the absorbing BC
+    'pml_cells': 10,
+    # reflection coefficient of the layer at normal incidence
+    'pml_reflection': 1e-4,
+    # maximum coordinate stretching, 1 for none
+    'pml_kappa': 1,
+    # maximum frequency shift in units of pi*f of the wave, damps grazing and evanescent waves
+    'pml_alpha': 1,
+    # damping of the differences along the other two axes inside a layer, relative to the layer axis.
+    # Without it the layers grow at late times in strongly anisotropic materials such as GaAs
+    'pml_ratio': 0.1,
+}
+
+# Order of the polynomial damping profile
+ORDER = 2
+
+# Largest share of the cells of an axis covered by the layer of one face,
+# so that the z layer never reaches the surface and the y layers leave the middle of the grid
+MAX_SHARE = 1/4
+
+# Thinnest useful layer, a thinner one in front of its rigid face reflects more than the absorbing BC
+MIN_CELLS = 6
+
+# Positions of the updated blocks of update_T and update_u along x, y and z.
+# 'full' blocks hold the lines 1 .. n-2, 'surface' blocks the lines from the z = 0 surface and 'half' blocks the half lines
+BLOCKS = {
+    'T': ('full', 'full', 'surface'),
+    'T4': ('full', 'half', 'half'),
+    'T5': ('half', 'full', 'half'),
+    'T6': ('half', 'half', 'surface'),
+    'ux': ('half', 'full', 'surface'),
+    'uy': ('full', 'half', 'surface'),
+    'uz': ('full', 'full', 'half'),
+}
+
+# Differences of update_T and update_u, keyed as the coefficients of BaseSolver.initCoefficients:
+# axis and updated block
+DIFFERENCES = {
+    'T_ux': (0, 'T'),
+    'T_uy': (1, 'T'),
+    'T_uz': (2, 'T'),
+    'T4_uy': (2, 'T4'),
+    'T4_uz': (1, 'T4'),
+    'T5_ux': (2, 'T5'),
+    'T5_uz': (0, 'T5'),
+    'T6_ux': (1, 'T6'),
+    'T6_uy': (0, 'T6'),
+    'ux_T1': (0, 'ux'),
+    'ux_T6': (1, 'ux'),
+    'ux_T5': (2, 'ux'),
+    'uy_T6': (0, 'uy'),
+    'uy_T2': (1, 'uy'),
+    'uy_T4': (2, 'uy'),
+    'uz_T5': (0, 'uz'),
+    'uz_T4': (1, 'uz'),
+    'uz_T3': (2, 'uz'),
+}
+
+def positions(L, position):
+    '''
+    Positions of the 'full', 'surface' or 'half' lines of a block along the lines L, see BLOCKS
+    '''
+    return {'full': L[1:-1], 'surface': L[:-1], 'half': (L[1:] + L[:-1])/2}[position]
+
+def profile(L, pos, face, cells, v, R):
+    '''
+    Depth into the layer of cells cells on the face 'min' or 'max' of the lines L at the positions pos,
+    from 0 at its inner edge to 1 at the face, and the damping there
+    '''
+    edge, inner = (L[0], L[cells]) if face == 'min' else (L[-1], L[-1-cells])
+    s = np.clip((pos - inner)/(edge - inner), 0, 1)
+    d = -(ORDER+1)*v*np.log(R)/(2*abs(edge - inner)) * s**ORDER
+    return s, d
+
+def along(a, axis):
+    '''
+    1D array a shaped to broadcast along axis of a block
+    '''
+    return a.reshape(tuple(-1 if i == axis else 1 for i in range(3)))
+
+class Solver(base_solver.BaseSolver):
+    '''
+    Multiaxial convolutional PML. Inside the layers each difference du along an axis is replaced by
+    du/kappa + psi, psi being the recursive convolution of du with the damping profile. The layer of an axis
+    damps the differences along it with the full profile and those along the other axes with pml_ratio of it,
+    a plain C-PML grows at late times in materials as anisotropic as GaAs.
+    The second order kernels of BaseSolver run first, the layers then add the difference of the two
+    to the stresses and displacements. The layers end on rigid faces, see apply_u_abc_x.
+    '''
+
+    def __init__(self):
+        super().__init__(logger)
+        self.name = "pml"
+        self.description = "<p></p>"
+        self.cfg = {**cfg, **self.cfg}
+
+    def init(self, grid, material, steps):
+        super().init(grid, material, steps)
+        self.initLayers()
+
+    def faces(self):
+        '''
+        Faces with a layer along each axis, the y faces of a periodic grid and the mirror plane have none
+        '''
+        g = self.g
+        y = [] if g.periodic_y else ['min'] if g.mirror is not None else ['min', 'max']
+        return (['max'], y, ['max'])
+
+    def layerCells(self, lines):
+        '''
+        Cells of the layers along each axis, pml_cells up to MAX_SHARE of the cells of the axis.
+        An axis without faces, or whose layers would be thinner than MIN_CELLS, has none and keeps the absorbing BC of BaseSolver
+        '''
+        cells = []
+        for name, L, faces in zip('xyz', lines, self.faces()):
+            n = max(int(self.cfg['pml_cells']), 0) if faces else 0
+            cap = int(MAX_SHARE*(L.size-1))
+            if n > cap:
+                logger.warning("Absorbing layers along {} capped to {} cells".format(name, cap))
+                n = cap
+            if 0 < n < MIN_CELLS:
+                logger.warning("Absorbing layers along {} thinner than {} cells, the absorbing BC is kept".format(name, MIN_CELLS))
+                n = 0
+            cells.append(n)
+        return cells
+
+    def initLayers(self):
+        '''
+        Boxes of each difference inside the layers, with their constants and convolution memory.
+        The layers of all faces are split into disjoint boxes, the damping in a box is the sum of the profiles
+        of every layer over it. The damping follows the fastest bulk velocity of the materials, see Material.maxVelocity
+        '''
+        g, m = self.g, self.m
+        lines = [L*g.SI_conversion for L in (g.x, g.y, g.z)]
+        v, dt = m.maxVelocity(), m.dt
+        R, kappa, ratio = self.cfg['pml_reflection'], self.cfg['pml_kappa'], self.cfg['pml_ratio']
+        alpha = self.cfg['pml_alpha']*np.pi*self.cfg['wave_args']['f']
+        self.cells = cells = self.layerCells(lines)
+        dtype, state = self.precision(), self.stateType()
+
+        self.layers = {}
+        for key, (axis, block) in DIFFERENCES.items():
+            pos = [positions(L, p) for L, p in zip(lines, BLOCKS[block])]
+            layers = [(i, *profile(lines[i], pos[i], face, cells[i], v, R))
+                      for i, faces in enumerate(self.faces()) if cells[i] > 0 for face in faces]
+            self.layers[key] = []
+            # what is left of the block once the boxes of the previous layers are cut out
+            rest = [slice(0, p.size) for p in pos]
+            for i, s, _ in layers:
+                inside = np.flatnonzero(s > 0)
+                if inside.size == 0:
+                    continue
+                lo, hi = max(inside[0], rest[i].start), min(inside[-1]+1, rest[i].stop)
+                if hi <= lo or any(r.stop <= r.start for r in rest):
+                    continue
+                region = tuple(slice(lo, hi) if j == i else r for j, r in enumerate(rest))
+                rest[i] = slice(hi, rest[i].stop) if lo == rest[i].start else slice(rest[i].start, lo)
+
+                d = sum(along(dj[region[j]], j)*(1 if j == axis else ratio) for j, _, dj in layers)
+                k = 1 + (kappa - 1)*sum(along(sj[region[j]], j)**ORDER for j, sj, _ in layers if j == axis)
+                al = alpha*(1 - reduce(np.maximum, [along(sj[region[j]], j) for j, sj, _ in layers]))
+                if not np.any(d):
+                    continue
+                b = np.exp(-(d/k + al)*dt)
+                a = np.divide(d*(b - 1), k*(d + k*al), out=np.zeros(np.broadcast(d, k, al).shape), where=d > 0)
+                constants = [np.ascontiguousarray(c, dtype=dtype) for c in (a, b, 1/k - 1)]
+                # memory of the convolution, the difference and scratch space of the box
+                box = tuple(r.stop - r.start for r in region)
+                buffers = [np.zeros(box, dtype=state) for i in range(3)]
+                self.layers[key].append((axis, region, constants, buffers))
+
+    def corrections(self, a, key):
+        '''
+        Correction of the difference key of the window a in each box of the layers, see initLayers.
+        Yields the region of the updated block, the correction over it and a free scratch buffer of the same shape
+        '''
+        r = self.coef[key]
+        kappa = self.cfg['pml_kappa'] != 1
+        for axis, region, (ca, cb, ck), (psi, du, tmp) in self.layers[key]:
+            s = region[axis]
+            hi = a[tuple(slice(s.start+1, s.stop+1) if i == axis else region[i] for i in range(3))]
+            lo = a[region]
+            difference(hi, lo, part(r, region), du)
+            psi *= cb
+            psi += np.multiply(ca, du, out=tmp)
+            if kappa:
+                du *= ck
+                du += psi
+            else:
+                du[...] = psi
+            yield region, du, tmp
+
+    def apply_u_abc_x(self):
+        '''
+        The layers end on rigid faces: the displacements along a face are never updated and stay zero,
+        the normal displacement sees no stress beyond it. Ending a layer with the first order absorbing BC
+        makes it grow at late times, only the faces without a layer keep it
+        '''
+        if self.cells[0] == 0:
+            super().apply_u_abc_x()
+
+    def apply_u_abc_y(self, i0=0, i1=None):
+        if self.cells[1] == 0:
+            super().apply_u_abc_y(i0, i1)
+
+    def apply_u_abc_z(self, i0=0, i1=None):
+        if self.cells[2] == 0:
+            super().apply_u_abc_z(i0, i1)
+
+    def update_T(self):
+        super().update_T()
+        g, C = self.g, self.m.stiffness
+        uz = g.uz_pad[...,GHOST-1:] # starts at the ghost plane above the surface
+
+        for key, a, col in (('T_ux', g.ux[:,1:-1,:-1], 1), ('T_uy', g.uy[1:-1,:,:-1], 2), ('T_uz', uz[1:-1,1:-1,:], 3)):
+            for region, corr, tmp in self.corrections(a, key):
+                for T, row in ((g.T1, 1), (g.T2, 2), (g.T3, 3)):
+                    accumulate(T[1:-1,1:-1,:-1][region], part(C['c{}{}'.format(row, col)], region), corr, tmp)
+
+        for T, c, terms in (
+                (g.T4[1:-1,:,:], C['c44'], (('T4_uy', g.uy[1:-1,:,:]), ('T4_uz', g.uz[1:-1,:,:]))),
+                (g.T5[:,1:-1,:], C['c55'], (('T5_ux', g.ux[:,1:-1,:]), ('T5_uz', g.uz[:,1:-1,:]))),
+                (g.T6[:,:,:-1], C['c66'], (('T6_ux', g.ux[:,:,:-1]), ('T6_uy', g.uy[:,:,:-1])))):
+            for key, a in terms:
+                for region, corr, tmp in self.corrections(a, key):
+                    accumulate(T[region], part(c, region), corr, tmp)
+
+    def update_u(self):
+        super().update_u()
+        g, c = self.g, self.coef
+        # start at the ghost plane above the surface
+        T4, T5 = g.T4_pad[...,GHOST-1:], g.T5_pad[...,GHOST-1:]
+
+        for u, r, terms in (
+                (g.ux_new[:,1:-1,:-1], c.get('ux'), (('ux_T1', g.T1[:,1:-1,:-1]), ('ux_T6', g.T6[:,:,:-1]), ('ux_T5', T5[:,1:-1,:]))),
+                (g.uy_new[1:-1,:,:-1], c.get('uy'), (('uy_T6', g.T6[:,:,:-1]), ('uy_T2', g.T2[1:-1,:,:-1]), ('uy_T4', T4[1:-1,:,:]))),
+                (g.uz_new[1:-1,1:-1,:], c.get('uz'), (('uz_T5', g.T5[:,1:-1,:]), ('uz_T4', g.T4[1:-1,:,:]), ('uz_T3', g.T3[1:-1,1:-1,:])))):
+            for key, a in terms:
+                for region, corr, tmp in self.corrections(a, key):
+                    accumulate(u[region], part(r, region), corr, tmp)
@@ -1,5 +1,6 @@
 import time
 import tempfile, shutil, os
+import copy
 from pathlib import Path
 import threading, queue
 import multiprocessing as mp
@@ -215,9 +216,17 @@ class Solver(base_solver.BaseSolver):
         global cfg
         cfg = self.cfg
 
+        # The server rebuilds the state and per cell arrays in BaseSolver.init,
+        # only the mesh, the phase map and per phase tables need to be sent
+        grid = copy.copy(grid)
         grid.buildMesh()
-        grid.update()
+        grid.updateSpacing()
+        grid.clearState()
+        material = copy.copy(material)
+        material.grid = grid
         material.update()
+        material.C, material.P, material.stiffness = None, None, {}
+        material.grid = None
 
         self.client = Client()
         self.client.send_obj(grid, 'grid.dill')
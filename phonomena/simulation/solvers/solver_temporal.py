@@ -0,0 +1,131 @@
+import numpy as np
+from numba import njit
+
+from simulation.grid import GHOST
+from . import solver_numba
+from .solver_numba import stress, displacement, absorb_x, absorb_yz
+
+import logging
+logger = logging.getLogger(__name__)
+
+cfg = {
+    "time_block": 4,
+    "tile_size": [1, 16]
+}
+
+# Planes between the fronts of two consecutive steps of a block,
+# the x face absorbing boundary of a step is only complete once its front reaches the last plane
+LAG = 3
+
+numba_cfg = solver_numba.cfg['numba']
+
+class Solver(solver_numba.Solver):
+    '''
+    Temporal blocking on top of the fused numba kernels.
+    Blocks of time_block steps are swept over the x planes as skewed wavefronts,
+    so a plane is advanced through every step of the block while it is still in cache.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.logger = logger
+        self.name = "temporal"
+        self.description = "<p></p>"
+        self.cfg = {**self.cfg, **cfg}
+
+    def recompile(self):
+        super().recompile()
+        record.recompile()
+        sweep.recompile()
+
+    def init(self, *args, **kwargs):
+        super().init(*args, **kwargs)
+        if self.g.periodic_y or self.g.mirror is not None:
+            raise Exception("Temporal blocking does not support periodic or mirrored grids.")
+        self.planes = self.planeBlocks()
+
+    def planeBlocks(self):
+        '''
+        Blocks of each x plane, indexed by plane. The wavefront advances one plane at a time,
+        so only the y extent of tile_size applies, the blocks of a plane run in parallel.
+        '''
+        nx, ny = self.g.x.size-1, self.g.y.size-1
+        ty = ny if self.cfg['tile_size'][1] <= 0 else int(self.cfg['tile_size'][1])
+        planes = [[(i, i+1, j, min(j+ty, ny)) for j in range(0, ny, ty)] for i in range(nx)]
+        return np.array(planes, dtype=np.int64)
+
+    def phaseKernels(self):
+        return True
+
+    def advance(self, source, t0, n):
+        '''
+        Run the n steps between writer calls in blocks of time_block steps
+        '''
+        if self.frames is not None:
+            frames = (self.frames.ux, self.frames.uy, self.frames.uz)
+        else:
+            frames = (np.zeros((0,0,0,0), dtype=self.g.ux.dtype),)*3
+        args = self.kernelArgs()[:-1]
+
+        block = max(1, int(self.cfg['time_block']))
+        for s0 in range(0, n, block):
+            m = min(block, n - s0)
+            sweep(*args, self.planes, source, t0+s0, s0, m, frames, self.frames is not None)
+            self.g.rotate(m)
+            # the rotated ring is passed to the next block
+            args = self.kernelArgs()[:-1]
+
+
+@njit(cache=numba_cfg['cache'], fastmath=numba_cfg['fastmath'])
+def record(i, s, u, frames):
+    '''
+    Copy x plane i of u to frame s
+    '''
+    ux, uy, uz = u
+    fux, fuy, fuz = frames
+    if i < ux.shape[0]:
+        fux[i,:,:,s] = ux[i,:,GHOST:]
+    fuy[i,:,:,s] = uy[i,:,GHOST:]
+    fuz[i,:,:,s] = uz[i,:,GHOST:]
+
+@njit(parallel=numba_cfg['parallel'], cache=numba_cfg['cache'], fastmath=numba_cfg['fastmath'])
+def sweep(phase, c, rho, abc, u, u_old, u_new, T, rsd, rfd, planes, source, t0, f0, n, frames, record_frames):
+    '''
+    n steps of solver_numba.advance as a wavefront over the x planes.
+    At front f step s updates the stress of plane p = f - LAG*s and the displacement of plane p-1,
+    so every plane a step reads has already been completed by the previous step,
+    and the previous step is done reading the buffers a step overwrites.
+    The displacement ring of step s is (cur, new, old) = ring[s%3], ring[(s+1)%3], ring[(s+2)%3],
+    the stress is kept in a single buffer. Frames are recorded from frame f0 on.
+    '''
+    nx = phase.shape[0]
+    ring = (u, u_new, u_old)
+
+    for f in range(nx + LAG*(n-1)):
+        for s in range(n):
+            p = f - LAG*s
+            if p < 0 or p > nx-1:
+                continue
+            cur, new, old = ring[s%3], ring[(s+1)%3], ring[(s+2)%3]
+
+            if p == 0:
+                # Same source handling and uz_new reset as solver_numba.advance
+                new[2][0,:,GHOST] = 0
+                cur[2][0,:,GHOST] = source[t0+s]
+            if p < nx-1:
+                stress(phase, c, cur, T, rsd, rfd, planes[p])
+            if p > 0:
+                displacement(phase, rho, cur, old, new, T, rsd, rfd, planes[p-1])
+                # the y and z faces of the last planes wait for the x face, see absorb_yz
+                if p-1 < nx-3:
+                    absorb_yz(p-1, p, phase, abc, cur, new)
+                    if record_frames:
+                        record(p-1, f0+s, new, frames)
+            if p == nx-1:
+                absorb_x(phase, abc, cur, new)
+                absorb_yz(max(nx-3, 0), nx, phase, abc, cur, new)
+                if record_frames:
+                    for i in range(max(nx-3, 0), nx):
+                        record(i, f0+s, new, frames)
+
+    ring[(n+1)%3][2][0,:,GHOST] = 0
@@ -1,144 +1,86 @@
-import threading
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
+import numpy as np
+import weakref
 
 from simulation import base_solver
 
 import logging
 logger = logging.getLogger(__name__)
 
-cfg = {'num_threads': 6}
+cfg = {'num_threads': cpu_count()}
 
 class Solver(base_solver.BaseSolver):
+    '''
+    Splits the grid into x slabs, one per thread, and runs the numpy kernels of BaseSolver
+    on every slab in parallel, including the boundary conditions of the planes of a slab.
+    NumPy releases the GIL inside the kernels. The thread pool is kept between runs, see shutdown().
+    '''
 
     def __init__(self):
         super().__init__(logger)
         self.name = "threading"
         self.description = "<p></p>"
         self.cfg = {**cfg, **self.cfg}
+        self.pool = None
+        self.num_threads = 0
 
     def init(self, grid, material, steps):
-        cfg = self.cfg
-
-        self.threads = []
-        self.worker_queue = Queue()
-        for i in range(cfg['num_threads']):
-            t = threading.Thread(target=Solver.worker, args=(i, self.worker_queue))
-            t.daemon = True
-            t.start()
-            self.threads.append(t)
-
+        num_threads = max(1, int(self.cfg['num_threads']))
+        if self.pool is None or self.num_threads != num_threads:
+            self.shutdown()
+            self.pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="solver_threading")
+            # stops the threads once the solver is garbage collected or at exit, see shutdown()
+            self.stop_pool = weakref.finalize(self, self.pool.shutdown)
+            self.num_threads = num_threads
         super().init(grid, material, steps)
 
-    @staticmethod
-    def worker(i, q):
-        while True:
-            fn, args = q.get()
-            fn(*args)
-            q.task_done()
-            #print("{}: task done".format(i))
-
+    def shutdown(self):
+        '''
+        Stop the worker threads, a new pool is started by the next init()
+        '''
+        if self.pool is not None:
+            self.stop_pool()
+            self.pool = None
+        self.num_threads = 0
+
+    def initScratch(self):
+        '''
+        One slab of x planes per thread, each with its own scratch buffers
+        '''
+        planes = np.array_split(np.arange(self.g.x.size-1), self.num_threads)
+        self.slabs = [(p[0], p[-1]+1, self.scratchBuffers(p[0], p[-1]+1)) for p in planes if p.size]
+        # the boundary planes of a slab, the last one also owns the x max plane
+        nx = self.g.x.size
+        self.faces = [(i0, i1) for i0, i1, _ in self.slabs[:-1]] + [(self.slabs[-1][0], nx)]
+
+    def parallel(self, kernel):
+        '''
+        Run kernel(i0, i1, scratch) on every slab and wait for all of them
+        '''
+        for _ in self.pool.map(lambda slab: kernel(*slab), self.slabs):
+            pass
 
     def update_T(self):
-
-        def T1(g, m):
-            g.T1[1:-1,1:-1,1:-1] = \
-              m.C[1:-1,1:-1,1:-1,0,0]*(g.ux[1:,1:-1,1:-1] - g.ux[:-1,1:-1,1:-1]) \
-            / g.sdx \
-            + m.C[1:-1,1:-1,1:-1,0,1]*(g.uy[1:-1,1:,1:-1] - g.uy[1:-1,:-1,1:-1]) \
-            / g.sdy \
-            + m.C[1:-1,1:-1,1:-1,0,2]*(g.uz[1:-1,1:-1,1:] - g.uz[1:-1,1:-1,:-1]) \
-            / g.sdz
-
-        def T2(g, m):
-            g.T2[1:-1,1:-1,1:-1] = \
-              m.C[1:-1,1:-1,1:-1,1,0]*(g.ux[1:,1:-1,1:-1] - g.ux[:-1,1:-1,1:-1]) \
-            / g.sdx \
-            + m.C[1:-1,1:-1,1:-1,1,1]*(g.uy[1:-1,1:,1:-1] - g.uy[1:-1,:-1,1:-1]) \
-            / g.sdy \
-            + m.C[1:-1,1:-1,1:-1,1,2]*(g.uz[1:-1,1:-1,1:] - g.uz[1:-1,1:-1,:-1]) \
-            / g.sdz
-
-        def T3(g, m):
-            g.T3[1:-1,1:-1,1:-1] = \
-                m.C[1:-1,1:-1,1:-1,2,0]*(g.ux[1:,1:-1,1:-1] - g.ux[:-1,1:-1,1:-1]) \
-                / g.sdx \
-                + m.C[1:-1,1:-1,1:-1,2,1]*(g.uy[1:-1,1:,1:-1] - g.uy[1:-1,:-1,1:-1]) \
-                / g.sdy \
-                + m.C[1:-1,1:-1,1:-1,2,2]*(g.uz[1:-1,1:-1,1:] - g.uz[1:-1,1:-1,:-1]) \
-                / g.sdz
-
-        def T4(g, m):
-            g.T4[1:-1,:,:] = m.C[1:-1,1:,1:,3,3]*( \
-                (g.uy[1:-1,:,1:] - g.uy[1:-1,:,:-1]) \
-                / g.fdz \
-                + (g.uz[1:-1,1:,:] - g.uz[1:-1,:-1,:]) \
-                / g.fdy
-            )
-
-        def T5(g, m):
-            g.T5[:,1:-1,:] = m.C[1:,1:-1,1:,4,4]*( \
-                (g.ux[:,1:-1,1:] - g.ux[:,1:-1,:-1]) \
-                / g.fdz \
-                + (g.uz[1:,1:-1,:] - g.uz[:-1,1:-1,:])
-                / g.fdx
-            )
-
-        def T6(g, m):
-            g.T6[:,:,1:-1] = m.C[1:,1:,1:-1,5,5]*( \
-                (g.ux[:,1:,1:-1] - g.ux[:,:-1,1:-1]) \
-                / g.fdy \
-                + (g.uy[1:,:,1:-1] - g.uy[:-1,:,1:-1]) \
-                / g.fdx
-            )
-
-        self.worker_queue.put((T1, (self.g, self.m)))
-        self.worker_queue.put((T2, (self.g, self.m)))
-        self.worker_queue.put((T3, (self.g, self.m)))
-        self.worker_queue.put((T4, (self.g, self.m)))
-        self.worker_queue.put((T5, (self.g, self.m)))
-        self.worker_queue.put((T6, (self.g, self.m)))
-        self.worker_queue.join()
-        assert self.worker_queue.empty()
-
-
-    def apply_T_tfbc(self):
-
-        def T1(g, m):
-            g.T1[1:-1,1:-1,0] = \
-                m.C[1:-1,1:-1,0,0,0]*(g.ux[1:,1:-1,0] - g.ux[:-1,1:-1,0]) / g.sdx[0,:,:] \
-                + m.C[1:-1,1:-1,0,0,1]*(g.uy[1:-1,1:,0] - g.uy[1:-1,:-1,0]) / g.sdy[:,0,:] \
-                + m.C[1:-1,1:-1,0,0,2]*(g.uz[1:-1,1:-1,0] - 0) / g.sdz[:,:,0]
-
-        def T2(g, m):
-            g.T2[1:-1,1:-1,0] = \
-                m.C[1:-1,1:-1,0,1,0]*(g.ux[1:,1:-1,0] - g.ux[:-1,1:-1,0]) / g.sdx[0,:,:] \
-                + m.C[1:-1,1:-1,0,1,1]*(g.uy[1:-1,1:,0] - g.uy[1:-1,:-1,0]) / g.sdy[:,0,:] \
-                + m.C[1:-1,1:-1,0,1,2]*(g.uz[1:-1,1:-1,0] - 0) / g.sdz[:,:,0]
-
-        def T4(g, m):
-            g.T4[1:-1,:,0] = \
-                m.C[1:-1,1:,0,3,3] \
-                * ((g.uy[1:-1,:,1] - g.uy[1:-1,:,0]) / g.fdy[:,0,:] \
-                + (g.uz[1:-1,1:,0] - g.uz[1:-1,:-1,0]) / g.fdz[:,:,0])
-
-        def T5(g, m):
-            g.T5[:,1:-1,0] = \
-                m.C[1:,1:-1,0,4,4] \
-                * ((g.ux[:,1:-1,1] - g.ux[:,1:-1,0]) / g.fdx[0,:,:] \
-                + (g.uz[1:,1:-1,0] - g.uz[:-1,1:-1,0]) / g.fdz[:,:,0])
-
-        def T6(g, m):
-            g.T6[:,:,0] = \
-                m.C[1:,1:,0,5,5] \
-                * ((g.ux[:,1:,0] - g.ux[:,:-1,0]) / g.fdx[0,:,:] \
-                + (g.uy[1:,:,0] - g.uy[:-1,:,0]) / g.fdz[:,:,0])
-
-        self.worker_queue.put((T1, (self.g, self.m)))
-        self.worker_queue.put((T2, (self.g, self.m)))
-        self.worker_queue.put((T4, (self.g, self.m)))
-        self.worker_queue.put((T5, (self.g, self.m)))
-        self.worker_queue.put((T6, (self.g, self.m)))
-        self.g.T3[1:-1,1:-1,0] = 0
-        self.worker_queue.join()
-        assert self.worker_queue.empty()
+        self.parallel(super().update_T)
+
+    def update_u(self):
+        self.parallel(super().update_u)
+
+    def update_T_BC(self):
+        for _ in self.pool.map(lambda face: self.apply_T_ybc(*face), self.faces):
+            pass
+        self.apply_T_tfbc()
+
+    def update_u_BC(self):
+        '''
+        The x max face reads the planes -2 and -1 before their y and z faces are absorbed,
+        see apply_u_abc_yz, the slabs then apply the y and z faces and images of their planes
+        '''
+        self.apply_u_tfbc()
+        self.apply_u_abc_x()
+        def faces(i0, i1):
+            self.apply_u_abc_yz(i0, i1)
+            self.apply_u_ybc(i0, i1)
+        for _ in self.pool.map(lambda face: faces(*face), self.faces):
+            pass
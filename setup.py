@@ -6,7 +6,7 @@ def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
 if __name__ == '__main__':
-    packages = ['matplotlib', 'PyQt5', 'numpy', 'h5py', 'numba', 'requests', 'dill', 'PyInstaller']
+    packages = ['matplotlib', 'PyQt5', 'numpy', 'h5py', 'numba', 'numexpr', 'scipy', 'requests', 'dill', 'PyInstaller']
 
     subprocess.check_call([sys.executable, "-m", "pip", "install", "--upgrade", "pip"])
 
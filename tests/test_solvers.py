@@ -3,6 +3,10 @@ if __name__ == "__main__":
     from pathlib import Path
     import sys
     from time import time
+    import copy
+    import gc
+    import importlib.util
+    import numpy as np
 
     import test_setup
 
@@ -29,6 +33,521 @@ if __name__ == "__main__":
             s.test()
             print(time()-t1)
 
+        def test_compact(self):
+            t1 = time()
+            from phonomena.simulation.base_solver import TestDefaults
+            for name in ("solver_default", "solver_numba"):
+                results = []
+                for compact in (False, True):
+                    m = copy.deepcopy(TestDefaults.m)
+                    m.compact = compact
+                    s = common.importSolver(name)
+                    s.cfg['write_mode'] = 'off'
+                    s.init(grid=TestDefaults.g, material=m, steps=10)
+                    s.run()
+                    results.append(s.g.ux)
+                self.assertTrue(np.allclose(*results, rtol=0, atol=1e-12*np.abs(results[0]).max()))
+            print(time()-t1)
+
+        def test_tiled(self):
+            t1 = time()
+            from phonomena.simulation.base_solver import TestDefaults
+            results = []
+            for tile_size in ([1, 0], [2, 3], [0, 0]):
+                s = common.importSolver("solver_numba")
+                s.cfg.update({'write_mode': 'off', 'fused': True, 'tile_size': tile_size})
+                s.init(grid=TestDefaults.g, material=TestDefaults.m, steps=10)
+                s.run()
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            for result in results[1:]:
+                self.assertTrue(np.array_equal(results[0], result))
+            print(time()-t1)
+
+        def test_temporal(self):
+            t1 = time()
+            from phonomena.simulation.base_solver import TestDefaults
+            results = []
+            for name, cfg in (("solver_numba", {}), ("solver_temporal", {'time_block': 3}), ("solver_temporal", {'time_block': 4, 'tile_size': [1, 0]})):
+                s = common.importSolver(name)
+                s.cfg.update({'write_mode': 'off', **cfg})
+                s.init(grid=TestDefaults.g, material=TestDefaults.m, steps=10)
+                s.run()
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            for result in results[1:]:
+                self.assertTrue(np.array_equal(results[0], result))
+            common.findSolvers()
+            self.assertIn("temporal", common.solver_dict)
+            print(time()-t1)
+
+        def test_specialized(self):
+            t1 = time()
+            from phonomena.simulation.base_solver import TestDefaults
+            results = []
+            for name in ("solver_default", "solver_numba"):
+                s = common.importSolver(name)
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+                s.init(grid=TestDefaults.g, material=TestDefaults.m, steps=10)
+                s.run()
+                self.assertTrue(s.uniform and s.homogeneous)
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+                if name == "solver_default":
+                    self.assertEqual(s.m.stiffness['c11'].shape[:2], (1, 1))
+                    self.assertNotIn('ux', s.coef)
+            self.assertTrue(np.allclose(*results, rtol=0, atol=1e-12*np.abs(results[0]).max()))
+            print(time()-t1)
+
+        def test_active_region(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            results = []
+            for active in (False, True):
+                s = common.importSolver("solver_default")
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'active_region': active})
+                s.init(grid=g, material=m, steps=20)
+                s.run()
+                if active:
+                    self.assertLess(s.front, s.g.x.size-1)
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            self.assertTrue(np.allclose(*results, rtol=0, atol=1e-6*np.abs(results[0]).max()))
+            print(time()-t1)
+
+        def test_periodic(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            g.periodic_y = True
+            for phase in (0, np.pi/3):
+                s = common.importSolver("solver_default")
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'active_region': False, 'bloch_phase': phase})
+                s.init(grid=g, material=m, steps=100)
+                s.run()
+                self.assertAlmostEqual(s.g.y[-1] - s.g.y[1], g.size_y)
+                self.assertEqual(np.iscomplexobj(s.g.ux), phase != 0)
+                bloch = np.exp(1j*phase)
+                for u in (s.g.ux, s.g.uz):
+                    self.assertTrue(np.allclose(u[:,0], u[:,-2]/bloch))
+                    self.assertTrue(np.allclose(u[:,-1], u[:,1]*bloch))
+                self.assertTrue(np.allclose(s.g.uy[:,0], s.g.uy[:,-1]/bloch))
+                self.assertGreater(np.abs(s.g.uz).max(), 0)
+                reference = np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)])
+                # the numba solver runs the per phase updates on a periodic grid, fused or not
+                for fused in (True, False):
+                    s = common.importSolver("solver_numba")
+                    s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'bloch_phase': phase, 'fused': fused})
+                    s.init(grid=g, material=m, steps=100)
+                    s.run()
+                    result = np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)])
+                    self.assertTrue(np.allclose(result, reference, rtol=0, atol=1e-9*np.abs(reference).max()))
+            # the numba cfg is shared by the next instances
+            s.cfg.update({'bloch_phase': 0, 'fused': True})
+            print(time()-t1)
+
+        def test_mirror(self):
+            t1 = time()
+            from simulation import analysis
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            # uniform mesh, the half mesh matches the lower half of the whole mesh. The material is uniform
+            # as the whole mesh is not mirror symmetric across inclusions, see Grid.mirrorMode, the y faces
+            # then make the wave depend on y. A larger time step lets it reach the mirror plane
+            g.min_d = 1
+            m.setSecondary(m.primary_key)
+            m.c_max = 0.3
+            results = []
+            for mirror in (None, 'auto'):
+                g.mirror_y = mirror
+                s = common.importSolver("solver_default")
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'active_region': False, 'bloch_phase': 0})
+                s.init(grid=g, material=m, steps=40)
+                s.run()
+                results.append(copy.deepcopy(s.g))
+            full, half = results
+            self.assertEqual(half.mirror, 'symmetric')
+            self.assertEqual(full.y.size, 2*half.y.size - 3)
+            # the odd uy does not vanish next to the mirror plane
+            self.assertGreater(np.abs(half.uy[:,-3:]).max(), 1e-2*np.abs(half.uz).max())
+            for key, sign in (('ux', 1), ('uy', -1), ('uz', 1)):
+                u_full, u_half = getattr(full, key), getattr(half, key)
+                self.assertTrue(np.allclose(u_full[:,:u_half.shape[1]], u_half, atol=1e-9*np.abs(u_full).max()))
+                u = analysis.MirrorDataset(u_half, sign, key == 'uy')
+                self.assertEqual(u.shape, u_full.shape)
+                self.assertTrue(np.allclose(u[:], u_full, atol=1e-9*np.abs(u_full).max()))
+                self.assertTrue(np.allclose(u[:,::-3,1], u_full[:,::-3,1], atol=1e-9*np.abs(u_full).max()))
+            print(time()-t1)
+
+        def test_plane(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            # uniform mesh and material, a periodic 3D run is then invariant along y.
+            # A larger time step lets the wave reach the absorbing x max and z max faces
+            g.min_d = 1
+            m.setSecondary(m.primary_key)
+            m.c_max = 0.3
+            g.periodic_y = True
+            s = common.importSolver("solver_default")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'active_region': False, 'bloch_phase': 0})
+            s.init(grid=g, material=m, steps=100)
+            s.run()
+            full = copy.deepcopy(s.g)
+            g.periodic_y = False
+            self.assertGreater(np.abs(full.uz[-2]).max(), 1e-3*np.abs(full.uz).max())
+
+            s = common.importSolver("solver_plane")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+            s.init(grid=g, material=m, steps=100)
+            s.run()
+            self.assertEqual(s.g.y.size, 1)
+            for key in ('ux', 'uz'):
+                u_full, u = getattr(full, key), getattr(s.g, key)
+                self.assertTrue(np.allclose(u[:,0], u_full[:,1], atol=1e-9*np.abs(u_full).max()))
+
+            for plane, approximation in (('xz', 'stress'), ('xy', 'strain'), ('xy', 'stress')):
+                s.cfg.update({'plane': plane, 'approximation': approximation})
+                s.init(grid=g, material=m, steps=100)
+                s.run()
+                u = s.g.uz if plane == 'xz' else s.g.uy
+                self.assertTrue(np.isfinite(u).all() and np.abs(u).max() > 0)
+            print(time()-t1)
+
+        def test_fourth(self):
+            t1 = time()
+            s = common.importSolver("solver_fourth")
+            fourth = sys.modules[type(s).__module__]
+            # exact for cubics on a non uniform mesh
+            L = np.cumsum(np.linspace(1, 2, 9))
+            H = (L[1:] + L[:-1])/2
+            p = lambda x: x**3 - 2*x**2 + x
+            dp = lambda x: 3*x**2 - 4*x + 1
+            src = np.stack([L[k:k+4] for k in range(6)], axis=1)
+            w = fourth.lagrange(src, H[1:7])
+            self.assertTrue(np.allclose((w*p(src)).sum(axis=0), dp(H[1:7])))
+            # uniform correction of the second order stencil
+            fh, hf = fourth.corrections(np.arange(8)*0.5)
+            for e in (fh, hf):
+                self.assertTrue(np.allclose(e, np.array([[1], [-3], [3], [-1]])/12))
+
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+            s.init(grid=g, material=m, steps=40)
+            s.run()
+            u = np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)])
+            self.assertTrue(np.isfinite(u).all() and np.abs(u).max() > 0)
+            print(time()-t1)
+
+        def test_pml(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            results = []
+            for name, cells in (("solver_default", None), ("solver_pml", 0), ("solver_pml", 6)):
+                s = common.importSolver(name)
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+                if cells is not None:
+                    s.cfg.update({'pml_cells': cells, 'pml_kappa': 2})
+                s.init(grid=g, material=m, steps=40)
+                s.run()
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            # without layers the kernels are those of BaseSolver
+            self.assertTrue(np.allclose(results[1], results[0]))
+            self.assertTrue(sum(len(boxes) for boxes in s.layers.values()) > 0)
+            self.assertTrue(np.isfinite(results[2]).all() and np.abs(results[2]).max() > 0)
+
+            # once the pulse has hit the x max and z max faces, the layers are closer than the absorbing BC to a
+            # reference on a larger grid. The grid is periodic along y, so the source line is the same on both
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'pml.json'))[1:]
+            cells, steps = 6, 280
+            large = copy.deepcopy(g)
+            large.size_x, large.size_z = g.size_x + 30, g.size_z + 30
+            results = {}
+            for name, grid in (("reference", large), ("solver_default", g), ("solver_pml", g)):
+                s = common.importSolver("solver_default" if name == "reference" else name)
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'wave': 'ricker',
+                              'wave_args': {'f': 400, 'source_delay': 0.004}, 'pml_cells': cells})
+                s.init(grid=grid, material=m, steps=steps)
+                s.run()
+                results[name] = (s.g.ux, s.g.uy, s.g.uz)
+            self.assertEqual(s.cells, [cells, 0, cells])
+            # the x and z layers are left out
+            nx, nz = s.g.x.size - cells, s.g.z.size - cells
+            window = lambda u: u[1:nx, :, :nz]
+            reference = [window(u) for u in results['reference']]
+            scale = max(np.abs(u).max() for u in reference)
+            errors = {}
+            for name in ("solver_default", "solver_pml"):
+                errors[name] = max(np.abs(window(u) - r).max() for u, r in zip(results[name], reference))/scale
+                print("{} max relative error: {:.2e}".format(name, errors[name]))
+            self.assertLess(errors['solver_pml'], 0.5*errors['solver_default'])
+
+            # on the mesh of the default settings the y and z layers would be thinner than MIN_CELLS, those faces keep
+            # the absorbing BC. Against a reference grid extended beyond the x max face, the x layer is no worse
+            # than the absorbing BC, and it stays bounded on the long run where a plain C-PML grew without limit
+            g, m = common.loadSettings(Path(__file__).resolve().parents[1].joinpath('data', 'default.json'))[1:]
+            extra, steps = 30, 1000
+            large = copy.deepcopy(g)
+            large.size_x = g.size_x + extra
+            results = {}
+            for name, grid in (("reference", large), ("solver_default", g), ("solver_pml", g)):
+                s = common.importSolver("solver_default" if name == "reference" else name)
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'wave': 'sin', 'wave_args': {'f': 100}})
+                s.init(grid=grid, material=m, steps=steps)
+                s.run()
+                results[name] = (s.g.ux, s.g.uy, s.g.uz)
+            self.assertEqual(s.cells, [7, 0, 0])
+            # the same window outside the x layer for both
+            cx = s.cells[0]
+            errors = {}
+            for name in ("solver_default", "solver_pml"):
+                u = [a[1:-cx] for a in results[name]]
+                reference = [b[1:a.shape[0]-cx] for a, b in zip(results[name], results['reference'])]
+                scale = max(np.abs(b).max() for b in reference)
+                errors[name] = max(np.abs(a - b).max() for a, b in zip(u, reference))/scale
+                print("{} max relative error: {:.2e}".format(name, errors[name]))
+            self.assertLess(errors['solver_pml'], errors['solver_default'])
+            # the response stays at the level of the absorbing BC, a plain C-PML grew well past it
+            amplitude = {name: max(np.abs(u).max() for u in results[name]) for name in ("solver_default", "solver_pml")}
+            self.assertLess(amplitude['solver_pml'], 1.1*amplitude['solver_default'])
+            print(time()-t1)
+
+        def test_harmonic(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            # every probe runs the kernels once, keep the mesh small
+            g.min_d, g.size_x, g.size_y = 1, 12, 8
+            s = common.importSolver("solver_harmonic")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'wave': 'sin', 'wave_args': {'f': 1e6}})
+            s.init(grid=g, material=m, steps=10)
+            s.running.set()
+            A = s.assemble()
+            s.running.clear()
+            rng = np.random.default_rng(0)
+            v = rng.standard_normal(A.shape[0]) + 1j*rng.standard_normal(A.shape[0])
+            self.assertTrue(np.allclose(A @ v, s.apply(v)))
+
+            results = []
+            for method in ('direct', 'iterative'):
+                s.cfg['method'] = method
+                s.init(grid=g, material=m, steps=10)
+                s.run()
+                x = np.concatenate([s.U[key].ravel() for key in ('ux', 'uy', 'uz')])
+                b = np.zeros_like(x)
+                b[s.drive] = 1
+                self.assertTrue(np.allclose(s.apply(x), b, atol=1e-6))
+                results.append(x)
+            self.assertTrue(np.allclose(results[1], results[0], atol=1e-6*np.abs(results[0]).max()))
+
+            # the steady state is a fixed point of the time domain solver: started from it at step 0
+            # and driven by the same sin wave, it is Im(U z**n) at step n
+            U, z, steps = s.U, s.z, 50
+            r = common.importSolver("solver_default")
+            r.cfg.update({'write_mode': 'off', 'precision': 'float64', 'wave': 'sin', 'wave_args': {'f': 1e6}})
+            r.init(grid=g, material=m, steps=steps)
+            for key in ('ux', 'uy', 'uz'):
+                getattr(r.g, key)[...] = np.imag(U[key])
+                getattr(r.g, key+'_old')[...] = np.imag(U[key]/z)
+            r.run()
+            # the source line is not part of the state left by the last step
+            expected = np.concatenate([np.imag(U[key]*z**steps)[1 if key == 'uz' else 0:].ravel() for key in ('ux', 'uy', 'uz')])
+            result = np.concatenate([getattr(r.g, key)[1 if key == 'uz' else 0:].ravel() for key in ('ux', 'uy', 'uz')])
+            self.assertTrue(np.allclose(result, expected, rtol=0, atol=1e-8*np.abs(expected).max()))
+            print(time()-t1)
+
+        def test_lts(self):
+            t1 = time()
+            # a single inclusion in the far corner leaves most of the grid, including the driven plane x = 0, coarse along x and y.
+            # The delayed Ricker wavelet is resolved by the coarsest time step, a step source is not
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'lts.json'))[1:]
+            results = []
+            for name in ("solver_default", "solver_lts"):
+                s = common.importSolver(name)
+                s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'wave_args': {'f': 100, 'source_delay': 0.012}})
+                s.init(grid=g, material=m, steps=200)
+                s.run()
+                # the source line is overwritten by the source
+                results.append((s.g.ux, s.g.uy, s.g.uz[1:]))
+            self.assertIsNotNone(s.regions)
+            self.assertGreater(len({region.ratio for region in s.regions}), 1)
+            # the coarsest region carries the wave
+            coarse = max(s.regions, key=lambda region: region.ratio)
+            uz = s.g.uz[tuple(slice(a, b) for a, b in coarse.own['uz'])]
+            self.assertGreater(np.abs(uz).max(), 0.1*np.abs(s.g.uz).max())
+            for key, expected, result in zip(('ux', 'uy', 'uz'), *results):
+                err = np.abs(result - expected).max()/np.abs(expected).max()
+                print("lts {} max relative error: {:.2e}".format(key, err))
+                self.assertLess(err, 1e-2)
+            # the global time step is used when the estimated saving is marginal
+            s.cfg['min_saving'] = 0.9
+            s.init(grid=g, material=m, steps=20)
+            self.assertIsNone(s.regions)
+            print(time()-t1)
+
+        def test_threading(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            results = []
+            s = common.importSolver("solver_default")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+            s.init(grid=g, material=m, steps=20)
+            s.run()
+            results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            s = common.importSolver("solver_threading")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'num_threads': 3})
+            for run in range(2):
+                s.init(grid=g, material=m, steps=20)
+                pool = s.pool if run == 0 else pool
+                self.assertIs(s.pool, pool)
+                self.assertEqual(len(s.slabs), 3)
+                s.run()
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            for result in results[1:]:
+                self.assertTrue(np.array_equal(results[0], result))
+            # the slabs also apply the y images of their planes
+            g.periodic_y = True
+            results = []
+            for name in ("solver_default", "solver_threading"):
+                r = s if name == "solver_threading" else common.importSolver(name)
+                r.cfg.update({'write_mode': 'off', 'precision': 'float64', 'active_region': False, 'bloch_phase': np.pi/3})
+                r.init(grid=g, material=m, steps=20)
+                r.run()
+                results.append(np.concatenate([u.ravel() for u in (r.g.ux, r.g.uy, r.g.uz)]))
+            pool = s.pool
+            s.shutdown()
+            self.assertIsNone(s.pool)
+            with self.assertRaises(RuntimeError):
+                pool.submit(print)
+            self.assertTrue(np.array_equal(results[0], results[1]))
+            # nothing else keeps a solver alive, dropping it stops its pool
+            s.init(grid=g, material=m, steps=20)
+            pool, stop_pool = s.pool, s.stop_pool
+            del s, r
+            gc.collect()
+            self.assertFalse(stop_pool.alive)
+            with self.assertRaises(RuntimeError):
+                pool.submit(print)
+            print(time()-t1)
+
+        def test_multiprocess(self):
+            t1 = time()
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            results = []
+            s = common.importSolver("solver_default")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+            s.init(grid=g, material=m, steps=20)
+            s.run()
+            results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            s = common.importSolver("solver_multiprocess")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64', 'num_workers': 3})
+            for run in range(2):
+                s.init(grid=g, material=m, steps=20)
+                workers = s.workers if run == 0 else workers
+                self.assertEqual(s.workers, workers)
+                s.run()
+                results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+            # a dead worker aborts the next command instead of blocking the barriers
+            s.init(grid=g, material=m, steps=20)
+            s.workers[1].kill()
+            s.workers[1].join()
+            with self.assertRaises(Exception):
+                s.run()
+            self.assertEqual(s.workers, [])
+            s.shutdown()
+            # dropping a solver stops its workers
+            s.init(grid=g, material=m, steps=20)
+            workers = s.workers
+            del s
+            gc.collect()
+            self.assertFalse(any(w.is_alive() for w in workers))
+            for result in results[1:]:
+                self.assertTrue(np.allclose(results[0], result, rtol=0, atol=1e-12*np.abs(results[0]).max()))
+            print(time()-t1)
+
+        def test_distributed(self):
+            t1 = time()
+            import h5py as h5
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            s = common.importSolver("solver_default")
+            s.cfg.update({'write_mode': 'off', 'precision': 'float64'})
+            s.init(grid=g, material=m, steps=20)
+            s.run()
+            expected = [np.copy(u) for u in (s.g.ux, s.g.uy, s.g.uz)]
+            s = common.importSolver("solver_distributed")
+            ranks = ['localhost:{}'.format(port) for port in range(6100, 6103)]
+            s.cfg.update({'write_mode': 'thread', 'precision': 'float64', 'sync_interval': 6, 'ranks': ranks})
+            for run in range(2):
+                s.init(grid=g, material=m, steps=20)
+                links = s.links if run == 0 else links
+                self.assertEqual(s.links, links)
+                s.run()
+                with h5.File(s.file, mode='r') as hdf:
+                    for key, u in zip(('ux', 'uy', 'uz'), expected):
+                        self.assertTrue(np.allclose(hdf[key][..., -1], u, rtol=0, atol=1e-12*np.abs(u).max()))
+            s.shutdown()
+            # the SETUP message is sent as JSON and raw array data, objects are refused
+            module = sys.modules[type(s).__module__]
+            message = {'x': s.g.x, 'dt': s.m.dt, 'abc': s.absorbingCoefficients(), 'slabs': [(0, 2)], 'file': None}
+            result = module.unpack(module.pack(message))
+            self.assertTrue(np.array_equal(result['x'], message['x']))
+            self.assertEqual(result['abc'], message['abc'])
+            self.assertEqual((result['dt'], result['slabs'], result['file']), (message['dt'], [[0, 2]], None))
+            with self.assertRaises(Exception):
+                module.pack({'grid': s.g})
+            print(time()-t1)
+
+        def test_ensemble(self):
+            t1 = time()
+            import h5py as h5
+            g, m = common.loadSettings(Path(__file__).resolve().parent.joinpath('data', 'nonuniform.json'))[1:]
+            members = [{}, {'wave': 'sin', 'wave_args': {'f': 150}}, {'secondary': 'GaAs'}]
+            s = common.importSolver("solver_ensemble")
+            s.cfg.update({'write_mode': 'thread', 'precision': 'float64', 'sync_interval': 4, 'members': members})
+            s.init(grid=g, material=m, steps=20)
+            s.run()
+            self.assertEqual(s.g.ux.shape[0], len(members))
+            for i, member in enumerate(members):
+                material = copy.deepcopy(m)
+                material.setSecondary(member.get('secondary', m.secondary_key))
+                r = common.importSolver("solver_default")
+                r.cfg.update({'write_mode': 'off', 'precision': 'float64', **member})
+                r.init(grid=g, material=material, steps=20)
+                r.run()
+                with h5.File(s.files[i], mode='r') as hdf:
+                    for key in ('ux', 'uy', 'uz'):
+                        u = getattr(r.g, key)
+                        # a homogeneous reference folds dt**2/rho into its coefficients, the ensemble does not,
+                        # so the two round differently
+                        self.assertTrue(np.allclose(getattr(s.g, key)[i], u, rtol=0, atol=1e-9*np.abs(u).max()))
+                        self.assertTrue(np.array_equal(hdf[key][..., -1], getattr(s.g, key)[i]))
+            print(time()-t1)
+
+        @unittest.skipUnless(importlib.util.find_spec('numexpr'), "numexpr is not installed")
+        def test_numexpr(self):
+            t1 = time()
+            for config in sorted(Path(__file__).resolve().parent.joinpath('data').glob('*.json')):
+                g, m = common.loadSettings(config)[1:]
+                results = []
+                for name in ("solver_default", "solver_numexpr"):
+                    s = common.importSolver(name)
+                    s.cfg.update({'write_mode': 'off', 'wave': 'ricker', 'precision': 'float64'})
+                    s.init(grid=g, material=m, steps=20)
+                    s.run()
+                    results.append(np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)]))
+                self.assertTrue(np.allclose(*results, rtol=0, atol=1e-12*np.abs(results[0]).max()))
+            print(time()-t1)
+
+        def test_precision(self):
+            t1 = time()
+            for config in sorted(Path(__file__).resolve().parent.joinpath('data').glob('*.json')):
+                g, m = common.loadSettings(config)[1:]
+                for name in ("solver_default", "solver_numba"):
+                    results = {}
+                    for precision in ('float64', 'float32'):
+                        s = common.importSolver(name)
+                        s.cfg.update({'write_mode': 'off', 'wave': 'ricker', 'precision': precision})
+                        s.init(grid=g, material=m, steps=100)
+                        s.run()
+                        results[precision] = np.concatenate([u.ravel() for u in (s.g.ux, s.g.uy, s.g.uz)])
+                    self.assertEqual(results['float32'].dtype, np.float32)
+                    err = np.abs(results['float32'] - results['float64']).max()/np.abs(results['float64']).max()
+                    print("{} {} float32 max relative error: {:.2e}".format(config.name, name, err))
+                    self.assertLess(err, 1e-4)
+            print(time()-t1)
+
 
 if __name__ == '__main__':
     unittest.main()